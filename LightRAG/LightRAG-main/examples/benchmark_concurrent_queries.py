@@ -0,0 +1,138 @@
+"""
+Benchmark concurrent LightRAG queries against a simulated LLM.
+
+The LLM and embedding functions are stubs with a fixed latency, so the numbers
+only reflect LightRAG's own overhead: with N queries in flight the wall time should
+stay close to a single query as long as N <= llm_model_max_async, instead of
+growing with N because queries wait on each other or on cache file writes.
+
+    python examples/benchmark_concurrent_queries.py --queries 32 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from lightrag import LightRAG, QueryParam
+from lightrag.utils import EmbeddingFunc
+
+WORKING_DIR = "./benchmark_concurrent_queries"
+
+DOCUMENT = (
+    "Alice met Bob in Paris while Carol was studying in Rome. "
+    "Bob and Dave later travelled to Berlin with Alice, "
+    "and Carol wrote to Dave about the trip."
+)
+
+LLM_LATENCY = 0.5
+
+
+async def mock_llm_func(
+    prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
+) -> str:
+    await asyncio.sleep(LLM_LATENCY)
+    if keyword_extraction:
+        return json.dumps(
+            {
+                "high_level_keywords": ["travel", "friendship"],
+                "low_level_keywords": ["Alice", "Bob"],
+            }
+        )
+    if "-Real Data-" in prompt:
+        names = ["Alice", "Bob", "Carol", "Dave"]
+        records = [
+            f'("entity"<|>"{name}"<|>"person"<|>"{name} is one of the travellers.")'
+            for name in names
+        ]
+        records += [
+            f'("relationship"<|>"{a}"<|>"{b}"<|>"{a} travelled with {b}"<|>"travel"<|>1)'
+            for a, b in zip(names, names[1:])
+        ]
+        return "##".join(records) + "<|COMPLETE|>"
+    if "Answer YES | NO" in prompt:
+        return "NO"
+    return f"Answer to: {prompt}"
+
+
+async def mock_embedding_func(texts: list[str]) -> np.ndarray:
+    rng = np.random.default_rng(abs(hash(tuple(texts))) % (2**32))
+    return rng.random((len(texts), 64))
+
+
+async def run_queries(rag: LightRAG, n: int, mode: str, concurrent: bool) -> float:
+    # distinct questions, so every query misses the LLM cache
+    questions = [f"Where did the travellers go? (#{i} {time.time()})" for i in range(n)]
+    start = time.perf_counter()
+    if concurrent:
+        await asyncio.gather(
+            *[rag.aquery(q, param=QueryParam(mode=mode)) for q in questions]
+        )
+    else:
+        for q in questions:
+            await rag.aquery(q, param=QueryParam(mode=mode))
+    return time.perf_counter() - start
+
+
+async def main(args):
+    global LLM_LATENCY
+
+    if os.path.exists(WORKING_DIR):
+        shutil.rmtree(WORKING_DIR)
+    os.mkdir(WORKING_DIR)
+
+    rag = LightRAG(
+        working_dir=WORKING_DIR,
+        llm_model_func=mock_llm_func,
+        llm_model_max_async=args.llm_max_async,
+        embedding_func=EmbeddingFunc(
+            embedding_dim=64, max_token_size=8192, func=mock_embedding_func
+        ),
+    )
+    LLM_LATENCY = 0.0
+    await rag.ainsert(DOCUMENT)
+    LLM_LATENCY = args.latency
+
+    cache_writes = 0
+    cache_index_done = rag.llm_response_cache.index_done_callback
+
+    async def counting_index_done():
+        nonlocal cache_writes
+        cache_writes += 1
+        await cache_index_done()
+
+    rag.llm_response_cache.index_done_callback = counting_index_done
+
+    # kg modes make two LLM calls per query (keywords, answer), naive makes one
+    llm_calls = 1 if args.mode == "naive" else 2
+    ideal = llm_calls * args.latency * -(-args.queries // args.llm_max_async)
+
+    print(
+        f"{args.queries} {args.mode} queries, {args.latency:.2f}s simulated LLM latency"
+    )
+    sequential = await run_queries(rag, args.queries, args.mode, concurrent=False)
+    print(f"  sequential: {sequential:7.2f}s")
+    cache_writes = 0
+    concurrent = await run_queries(rag, args.queries, args.mode, concurrent=True)
+    print(f"  concurrent: {concurrent:7.2f}s  (LLM-bound ideal {ideal:.2f}s)")
+    print(f"  speedup:    {sequential / concurrent:7.2f}x")
+    await rag.aflush()
+    print(f"  LLM cache file writes during the concurrent run: {cache_writes}")
+
+    if concurrent > ideal * 1.5 + 0.5:
+        raise SystemExit("concurrent queries did not scale with LLM concurrency")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queries", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--llm-max-async", type=int, default=16)
+    parser.add_argument(
+        "--mode", default="hybrid", choices=["naive", "local", "global", "hybrid"]
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,120 @@
+"""
+Micro-benchmark of the extraction record parser.
+
+Parses synthetic LLM extraction responses with lightrag.record_parser and with
+the previous implementation (a regex compiled per split, re.search per record,
+clean_str per field, all through coroutines), and checks both give the same
+entities and relationships on well-formed input.
+
+    python examples/benchmark_record_parser.py --responses 2000 --records 40
+"""
+
+import argparse
+import asyncio
+import re
+import time
+from collections import defaultdict
+
+from lightrag.prompt import PROMPTS
+from lightrag.record_parser import parse_extraction_records
+from lightrag.utils import clean_str, is_float_regex
+
+TUPLE = PROMPTS["DEFAULT_TUPLE_DELIMITER"]
+RECORD = PROMPTS["DEFAULT_RECORD_DELIMITER"]
+COMPLETE = PROMPTS["DEFAULT_COMPLETION_DELIMITER"]
+
+
+def make_response(i: int, records: int) -> str:
+    names = [f"Person {i}-{j}" for j in range(records // 2 + 1)]
+    out = [
+        f'("entity"{TUPLE}"{name}"{TUPLE}"person"{TUPLE}"{name} works at Acme &amp; Co.")'
+        for name in names
+    ]
+    out += [
+        f'("relationship"{TUPLE}"{a}"{TUPLE}"{b}"{TUPLE}"{a} knows {b}"'
+        f'{TUPLE}"colleagues, work"{TUPLE}{j % 9 + 1})'
+        for j, (a, b) in enumerate(zip(names, names[1:]))
+    ]
+    return f"\n{RECORD}\n".join(out[:records]) + f"\n{COMPLETE}"
+
+
+def legacy_split(content: str, markers: list[str]) -> list[str]:
+    results = re.split("|".join(re.escape(marker) for marker in markers), content)
+    return [r.strip() for r in results if r.strip()]
+
+
+async def legacy_parse(content: str, chunk_key: str):
+    """The parser as it was inlined in extract_entities"""
+
+    async def _entity(attrs):
+        if len(attrs) < 4 or attrs[0] != '"entity"':
+            return None
+        name = clean_str(attrs[1].upper())
+        if not name.strip():
+            return None
+        return dict(
+            entity_name=name,
+            entity_type=clean_str(attrs[2].upper()),
+            description=clean_str(attrs[3]),
+            source_id=chunk_key,
+        )
+
+    async def _relation(attrs):
+        if len(attrs) < 5 or attrs[0] != '"relationship"':
+            return None
+        return dict(
+            src_id=clean_str(attrs[1].upper()),
+            tgt_id=clean_str(attrs[2].upper()),
+            weight=float(attrs[-1]) if is_float_regex(attrs[-1]) else 1.0,
+            description=clean_str(attrs[3]),
+            keywords=clean_str(attrs[4]),
+            source_id=chunk_key,
+        )
+
+    nodes, edges = defaultdict(list), defaultdict(list)
+    for record in legacy_split(content, [RECORD, COMPLETE]):
+        record = re.search(r"\((.*)\)", record)
+        if record is None:
+            continue
+        attrs = legacy_split(record.group(1), [TUPLE])
+        entity = await _entity(attrs)
+        if entity is not None:
+            nodes[entity["entity_name"]].append(entity)
+            continue
+        relation = await _relation(attrs)
+        if relation is not None:
+            edges[(relation["src_id"], relation["tgt_id"])].append(relation)
+    return dict(nodes), dict(edges)
+
+
+async def run_legacy(responses):
+    return [await legacy_parse(r, f"chunk-{i}") for i, r in enumerate(responses)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--responses", type=int, default=2000)
+    parser.add_argument("--records", type=int, default=40)
+    args = parser.parse_args()
+    responses = [make_response(i, args.records) for i in range(args.responses)]
+
+    start = time.perf_counter()
+    legacy = asyncio.run(run_legacy(responses))
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parsed = [
+        parse_extraction_records(r, f"chunk-{i}") for i, r in enumerate(responses)
+    ]
+    parsed_time = time.perf_counter() - start
+
+    assert parsed == legacy, "parsers disagree on well-formed input"
+    records = args.responses * args.records
+    print(f"{records} records in {args.responses} responses")
+    print(f"legacy parser: {legacy_time:.3f}s ({records / legacy_time:,.0f} records/s)")
+    print(f"record_parser: {parsed_time:.3f}s ({records / parsed_time:,.0f} records/s)")
+    print(f"speedup: {legacy_time / parsed_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
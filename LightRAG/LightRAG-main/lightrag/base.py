@@ -3,7 +3,8 @@ from typing import TypedDict, Union, Literal, Generic, TypeVar
 
 import numpy as np
 
-from .utils import EmbeddingFunc
+from .prompt import GRAPH_FIELD_SEP
+from .utils import EmbeddingFunc, split_string_by_multi_markers
 
 TextChunkSchema = TypedDict(
     "TextChunkSchema",
@@ -19,6 +20,8 @@ class QueryParam:
     only_need_context: bool = False
     only_need_prompt: bool = False
     response_type: str = "Multiple Paragraphs"
+    # Return the answer as an async iterator of text pieces instead of a string
+    stream: bool = False
     # Number of top-k items to retrieve; corresponds to entities in "local" mode and relationships in "global" mode.
     top_k: int = 60
     # Number of document chunks to retrieve.
@@ -29,6 +32,256 @@ class QueryParam:
     max_token_for_global_context: int = 4000
     # Number of tokens for the entity descriptions
     max_token_for_local_context: int = 4000
+    # Total number of tokens for entities, relationships and chunks together. When set,
+    # the three budgets above are replaced by one budget shared between the sections.
+    max_token_for_context: Union[int, None] = None
+    # Relative weight of each section when sharing max_token_for_context
+    context_section_weights: dict = field(
+        default_factory=lambda: {"entities": 1.0, "relations": 1.0, "chunks": 1.0}
+    )
+    # Duplicate the keyword extraction and answer LLM calls that are slower than usual
+    # (needs llm_model_func to be a MultiModel's, see MultiModel; the other llm
+    # funcs of lightrag.llm ignore it)
+    hedge: bool = False
+
+
+@dataclass
+class DocumentInsertStatus:
+    """Progress of one document of a batch insert"""
+
+    doc_id: str
+    # documents with a lower priority value are processed first
+    priority: float = 0.0
+    status: Literal[
+        "pending", "chunking", "extracting", "merging", "done", "skipped", "failed"
+    ] = "pending"
+    chunks: int = 0
+    chunks_done: int = 0
+    entities: int = 0
+    relations: int = 0
+    llm_calls: int = 0
+    # estimated with tiktoken, LLM cache hits included
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # seconds spent per stage, plus "total"
+    timings: dict = field(default_factory=dict)
+    error: Union[str, None] = None
+
+
+@dataclass
+class GleaningStats:
+    """LLM calls of the gleaning rounds of entity extraction, see AdaptiveGleaningPolicy"""
+
+    chunks: int = 0
+    glean_calls: int = 0
+    if_loop_calls: int = 0
+    # calls the fixed policy would have made for sure that the adaptive one didn't
+    # (a lower bound, the fixed policy's later rounds depend on the LLM's answers)
+    calls_saved: int = 0
+    # rounds the adaptive policy skipped or ended gleaning before
+    skipped_rounds: int = 0
+    # skipped rounds run anyway to measure what skipping loses
+    audited_skips: int = 0
+    audited_new_elements: int = 0
+    # distinct entities and relations extracted from the chunks
+    extracted_elements: int = 0
+
+    def merge(self, other: "GleaningStats"):
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def estimated_recall_lost(self) -> Union[float, None]:
+        """Share of entities and relations the skipped rounds would have added,
+        extrapolated from the audited ones; None without audits"""
+        if not self.audited_skips:
+            return None
+        missed = (
+            self.audited_new_elements
+            / self.audited_skips
+            * (self.skipped_rounds - self.audited_skips)
+        )
+        total = self.extracted_elements + missed
+        return missed / total if total else 0.0
+
+
+@dataclass
+class LLMUsageStats:
+    """Tokens of the LLM calls, as reported by the providers.
+
+    Only calls that reached a provider are counted, not LLM cache hits.
+    """
+
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # calls whose provider reports the prompt tokens it served from its prefix
+    # cache, their prompt tokens and the cached ones
+    cache_reporting_calls: int = 0
+    cache_reporting_prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+
+    def record(
+        self,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_prompt_tokens: Union[int, None] = None,
+    ):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        if cached_prompt_tokens is not None:
+            self.cache_reporting_calls += 1
+            self.cache_reporting_prompt_tokens += prompt_tokens
+            self.cached_prompt_tokens += cached_prompt_tokens
+
+    @property
+    def cached_prompt_ratio(self) -> Union[float, None]:
+        """Share of the prompt tokens served from the prefix cache, over the calls
+        that report it; None if none does"""
+        if not self.cache_reporting_calls:
+            return None
+        return self.cached_prompt_tokens / max(self.cache_reporting_prompt_tokens, 1)
+
+
+@dataclass
+class HedgingStats:
+    """Duplicated (hedged) LLM calls of MultiModel"""
+
+    # calls made with hedge=True
+    calls: int = 0
+    # duplicates sent because a call was slower than the hedging deadline
+    hedges_fired: int = 0
+    # duplicates that answered before the call they duplicated
+    hedges_won: int = 0
+    # calls past the deadline that weren't duplicated, for the spend cap or
+    # because no model could take the duplicate
+    hedges_skipped: int = 0
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedges_fired / self.calls if self.calls else 0.0
+
+    @property
+    def win_rate(self) -> Union[float, None]:
+        """Share of the duplicates that won, None if none was sent"""
+        return self.hedges_won / self.hedges_fired if self.hedges_fired else None
+
+
+@dataclass
+class ContextEntity:
+    entity_name: str
+    entity_type: str
+    description: str
+    # node degree in the knowledge graph
+    rank: int
+    # retrieval relevance, higher is better
+    score: float = 0.0
+
+
+@dataclass
+class ContextRelation:
+    src_id: str
+    tgt_id: str
+    description: str
+    keywords: str
+    weight: float
+    # sum of the endpoint degrees in the knowledge graph
+    rank: int
+    score: float = 0.0
+
+
+@dataclass
+class ContextChunk:
+    chunk_id: str
+    content: str
+    score: float = 0.0
+
+
+@dataclass
+class QueryContext:
+    """Entities, relations and source chunks retrieved for a query, before rendering"""
+
+    entities: list[ContextEntity] = field(default_factory=list)
+    relations: list[ContextRelation] = field(default_factory=list)
+    chunks: list[ContextChunk] = field(default_factory=list)
+
+
+class GraphNodeRecord:
+    """Merged attributes of a graph node.
+
+    The fields stored as GRAPH_FIELD_SEP-joined strings in node data are kept as
+    lists here, so merges don't split and join them again.
+    """
+
+    __slots__ = ("entity_type", "descriptions", "source_ids")
+
+    def __init__(
+        self, entity_type: str, descriptions: list[str], source_ids: list[str]
+    ):
+        self.entity_type = entity_type
+        self.descriptions = descriptions
+        self.source_ids = source_ids
+
+    @classmethod
+    def from_node_data(cls, node_data: dict) -> "GraphNodeRecord":
+        return cls(
+            entity_type=node_data.get("entity_type", '"UNKNOWN"'),
+            descriptions=split_string_by_multi_markers(
+                node_data.get("description", ""), [GRAPH_FIELD_SEP]
+            ),
+            source_ids=split_string_by_multi_markers(
+                node_data.get("source_id", ""), [GRAPH_FIELD_SEP]
+            ),
+        )
+
+    def to_node_data(self) -> dict:
+        return dict(
+            entity_type=self.entity_type,
+            description=GRAPH_FIELD_SEP.join(self.descriptions),
+            source_id=GRAPH_FIELD_SEP.join(self.source_ids),
+        )
+
+
+class GraphEdgeRecord:
+    """Merged attributes of a graph edge, see GraphNodeRecord"""
+
+    __slots__ = ("weight", "descriptions", "keywords", "source_ids")
+
+    def __init__(
+        self,
+        weight: float,
+        descriptions: list[str],
+        keywords: list[str],
+        source_ids: list[str],
+    ):
+        self.weight = weight
+        self.descriptions = descriptions
+        self.keywords = keywords
+        self.source_ids = source_ids
+
+    @classmethod
+    def from_edge_data(cls, edge_data: dict) -> "GraphEdgeRecord":
+        return cls(
+            weight=float(edge_data.get("weight", 1.0)),
+            descriptions=split_string_by_multi_markers(
+                edge_data.get("description", ""), [GRAPH_FIELD_SEP]
+            ),
+            keywords=split_string_by_multi_markers(
+                edge_data.get("keywords", ""), [GRAPH_FIELD_SEP]
+            ),
+            source_ids=split_string_by_multi_markers(
+                edge_data.get("source_id", ""), [GRAPH_FIELD_SEP]
+            ),
+        )
+
+    def to_edge_data(self) -> dict:
+        return dict(
+            weight=self.weight,
+            description=GRAPH_FIELD_SEP.join(self.descriptions),
+            keywords=GRAPH_FIELD_SEP.join(self.keywords),
+            source_id=GRAPH_FIELD_SEP.join(self.source_ids),
+        )
 
 
 @dataclass
@@ -59,6 +312,10 @@ class BaseVectorStorage(StorageNameSpace):
         """
         raise NotImplementedError
 
+    async def delete(self, ids: list[str]):
+        """delete the vectors with the given ids, unknown ids are ignored"""
+        raise NotImplementedError
+
 
 @dataclass
 class BaseKVStorage(Generic[T], StorageNameSpace):
@@ -82,6 +339,10 @@ class BaseKVStorage(Generic[T], StorageNameSpace):
     async def upsert(self, data: dict[str, T]):
         raise NotImplementedError
 
+    async def delete(self, ids: list[str]):
+        """delete the given keys, unknown keys are ignored"""
+        raise NotImplementedError
+
     async def drop(self):
         raise NotImplementedError
 
@@ -105,6 +366,10 @@ class BaseGraphStorage(StorageNameSpace):
     async def get_node(self, node_id: str) -> Union[dict, None]:
         raise NotImplementedError
 
+    async def node_ids(self) -> list[str]:
+        """ids of all the nodes in the graph"""
+        raise NotImplementedError
+
     async def get_edge(
         self, source_node_id: str, target_node_id: str
     ) -> Union[dict, None]:
@@ -123,8 +388,36 @@ class BaseGraphStorage(StorageNameSpace):
     ):
         raise NotImplementedError
 
+    async def get_node_record(self, node_id: str) -> Union[GraphNodeRecord, None]:
+        """node attributes with the joined fields as lists, for merging"""
+        node_data = await self.get_node(node_id)
+        return None if node_data is None else GraphNodeRecord.from_node_data(node_data)
+
+    async def get_edge_record(
+        self, source_node_id: str, target_node_id: str
+    ) -> Union[GraphEdgeRecord, None]:
+        edge_data = await self.get_edge(source_node_id, target_node_id)
+        return None if edge_data is None else GraphEdgeRecord.from_edge_data(edge_data)
+
+    async def upsert_node_record(self, node_id: str, record: GraphNodeRecord):
+        await self.upsert_node(node_id, node_data=record.to_node_data())
+
+    async def upsert_edge_record(
+        self, source_node_id: str, target_node_id: str, record: GraphEdgeRecord
+    ):
+        await self.upsert_edge(
+            source_node_id, target_node_id, edge_data=record.to_edge_data()
+        )
+
     async def delete_node(self, node_id: str):
         raise NotImplementedError
 
+    async def delete_edge(self, source_node_id: str, target_node_id: str):
+        raise NotImplementedError
+
+    async def rebuild_degrees(self):
+        """recompute the stored node degrees from the edges currently in the graph"""
+        raise NotImplementedError
+
     async def embed_nodes(self, algorithm: str) -> tuple[np.ndarray, list[str]]:
         raise NotImplementedError("Node embedding is not used in lightrag.")
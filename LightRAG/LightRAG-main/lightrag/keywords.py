@@ -0,0 +1,182 @@
+"""Query keyword extraction without an LLM call.
+
+kg_query needs low-level keywords (entities) to search the entities and
+high-level keywords (themes) to search the relations. By default the LLM writes
+them, which costs a call before the answer call. LocalKeywordExtractor takes
+the entity names of the graph that appear in the query as low-level keywords,
+and the keywords of the relations nearest to the query as high-level ones.
+
+Entity names are matched with a trie over their words, so a query is scanned
+once whatever the number of entities, and the trie is updated in place when
+entities are added or removed.
+"""
+
+import asyncio
+import dataclasses
+import re
+from collections import Counter
+
+from .base import BaseGraphStorage, BaseVectorStorage, QueryParam
+from .storage import ProvenanceIndex
+
+_WORD = re.compile(r"\w+")
+# the value of a trie node that ends a name
+_NAMES = "\0names"
+
+
+def _words(text: str) -> list[str]:
+    return _WORD.findall(text.casefold())
+
+
+class EntityNameTrie:
+    """Entity names by their words, to find the ones that appear in a text.
+
+    Names are compared case-insensitively, on whole words, ignoring punctuation,
+    so "ALICE SMITH" and '"Alice Smith"' are the same name.
+    """
+
+    def __init__(self):
+        self._root: dict = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, name: str):
+        words = _words(name)
+        if not words:
+            return
+        node = self._root
+        for word in words:
+            node = node.setdefault(word, {})
+        names = node.setdefault(_NAMES, set())
+        if name not in names:
+            names.add(name)
+            self._size += 1
+
+    def remove(self, name: str):
+        words = _words(name)
+        path = [self._root]
+        for word in words:
+            node = path[-1].get(word)
+            if node is None:
+                return
+            path.append(node)
+        names = path[-1].get(_NAMES)
+        if not words or not names or name not in names:
+            return
+        names.discard(name)
+        self._size -= 1
+        if not names:
+            del path[-1][_NAMES]
+        # drop the nodes no other name goes through
+        for word, (parent, node) in zip(
+            reversed(words), reversed(list(zip(path, path[1:])))
+        ):
+            if node:
+                break
+            del parent[word]
+
+    def find(self, text: str) -> list[str]:
+        """The names in text, in order of appearance; where names overlap, the
+        longest one starting first wins"""
+        words = _words(text)
+        found = []
+        i = 0
+        while i < len(words):
+            node, match, end = self._root, None, i
+            for j in range(i, len(words)):
+                node = node.get(words[j])
+                if node is None:
+                    break
+                if _NAMES in node:
+                    match, end = node[_NAMES], j + 1
+            if match is None:
+                i += 1
+                continue
+            found.extend(sorted(match))
+            i = end
+        return found
+
+
+@dataclasses.dataclass
+class LocalKeywordExtractor:
+    """Query keywords from the graph instead of the LLM.
+
+    The low-level keywords are the nodes of knowledge_graph_inst whose names are
+    in the query, the high-level ones the most common keywords of the
+    relation_top_k relations nearest to the query in relationships_vdb. When the
+    query names no entity, or the nearest relations have no keywords, the query
+    itself is used, which the vector search then matches by meaning.
+
+    Every insert or delete of an entity goes through provenance_index, so the
+    node names are only read again from the graph when its entities change.
+    """
+
+    provenance_index: ProvenanceIndex
+    knowledge_graph_inst: BaseGraphStorage
+    relationships_vdb: BaseVectorStorage
+    # shorter names (e.g. "A", "IT") match too many queries
+    min_name_length: int = 3
+    max_entities: int = 20
+    relation_top_k: int = 10
+    max_relation_keywords: int = 10
+
+    def __post_init__(self):
+        self._trie = EntityNameTrie()
+        self._names: set[str] = set()
+        self._version = None
+
+    async def _sync_entities(self):
+        version = self.provenance_index.entities_version
+        if version == self._version:
+            return
+        names = {
+            name
+            for name in await self.knowledge_graph_inst.node_ids()
+            if len(name.strip("\"'").strip()) >= self.min_name_length
+        }
+        for name in self._names - names:
+            self._trie.remove(name)
+        for name in names - self._names:
+            self._trie.add(name)
+        self._names = names
+        self._version = version
+
+    async def low_level_keywords(self, query: str) -> list[str]:
+        await self._sync_entities()
+        names = list(dict.fromkeys(self._trie.find(query)))[: self.max_entities]
+        return [name.strip("\"'") for name in names]
+
+    async def high_level_keywords(self, query: str) -> list[str]:
+        results = await self.relationships_vdb.query(query, top_k=self.relation_top_k)
+        records = await asyncio.gather(
+            *[
+                self.knowledge_graph_inst.get_edge_record(r["src_id"], r["tgt_id"])
+                for r in results
+            ]
+        )
+        scores = Counter()
+        spellings = {}
+        # nearer relations weigh more
+        for rank, record in enumerate(records):
+            if record is None:
+                continue
+            for keywords in record.keywords:
+                for keyword in keywords.split(","):
+                    keyword = keyword.strip().strip("\"'")
+                    if keyword:
+                        spellings.setdefault(keyword.casefold(), keyword)
+                        scores[keyword.casefold()] += 1 / (rank + 1)
+        return [spellings[k] for k, _ in scores.most_common(self.max_relation_keywords)]
+
+    async def extract(
+        self, query: str, query_param: QueryParam
+    ) -> tuple[list[str], list[str]]:
+        """The (high-level, low-level) keywords of a query"""
+        hl_keywords, ll_keywords = [], []
+        if query_param.mode in ["local", "hybrid"]:
+            ll_keywords = await self.low_level_keywords(query) or [query]
+        if query_param.mode in ["global", "hybrid"]:
+            hl_keywords = await self.high_level_keywords(query) or [query]
+        return hl_keywords, ll_keywords
@@ -109,9 +109,11 @@ class Neo4JStorage(BaseGraphStorage):
         entity_name_label = node_id.strip('"')
 
         async with self._driver.session() as session:
+            # degree is maintained on the node by upsert_edge/delete_node, the
+            # COUNT fallback only runs for nodes written before it existed
             query = f"""
                 MATCH (n:`{entity_name_label}`)
-                RETURN COUNT{{ (n)--() }} AS totalEdgeCount
+                RETURN coalesce(n.degree, COUNT {{ (n)--() }}) AS totalEdgeCount
             """
             result = await session.run(query)
             record = await result.single()
@@ -127,18 +129,24 @@ class Neo4JStorage(BaseGraphStorage):
     async def edge_degree(self, src_id: str, tgt_id: str) -> int:
         entity_name_label_source = src_id.strip('"')
         entity_name_label_target = tgt_id.strip('"')
-        src_degree = await self.node_degree(entity_name_label_source)
-        trg_degree = await self.node_degree(entity_name_label_target)
 
-        # Convert None to 0 for addition
-        src_degree = 0 if src_degree is None else src_degree
-        trg_degree = 0 if trg_degree is None else trg_degree
-
-        degrees = int(src_degree) + int(trg_degree)
-        logger.debug(
-            f"{inspect.currentframe().f_code.co_name}:query:src_Degree+trg_degree:result:{degrees}"
-        )
-        return degrees
+        async with self._driver.session() as session:
+            query = f"""
+                OPTIONAL MATCH (a:`{entity_name_label_source}`)
+                OPTIONAL MATCH (b:`{entity_name_label_target}`)
+                RETURN
+                    CASE WHEN a IS NULL THEN 0
+                        ELSE coalesce(a.degree, COUNT {{ (a)--() }}) END
+                    + CASE WHEN b IS NULL THEN 0
+                        ELSE coalesce(b.degree, COUNT {{ (b)--() }}) END AS degrees
+            """
+            result = await session.run(query)
+            record = await result.single()
+            degrees = int(record["degrees"]) if record else 0
+            logger.debug(
+                f"{inspect.currentframe().f_code.co_name}:query:{query}:result:{degrees}"
+            )
+            return degrees
 
     async def get_edge(
         self, source_node_id: str, target_node_id: str
@@ -274,12 +282,21 @@ class Neo4JStorage(BaseGraphStorage):
         edge_properties = edge_data
 
         async def _do_upsert_edge(tx: AsyncManagedTransaction):
+            # only a newly created relationship changes the endpoint degrees
             query = f"""
             MATCH (source:`{source_node_label}`)
             WITH source
             MATCH (target:`{target_node_label}`)
+            OPTIONAL MATCH (source)-[existing:DIRECTED]->(target)
+            WITH source, target, count(existing) = 0 AS is_new
             MERGE (source)-[r:DIRECTED]->(target)
             SET r += $properties
+            FOREACH (_ IN CASE WHEN is_new THEN [1] ELSE [] END |
+                SET source.degree = CASE WHEN source.degree IS NULL
+                    THEN COUNT {{ (source)--() }} ELSE source.degree + 1 END
+                SET target.degree = CASE WHEN target.degree IS NULL
+                    THEN COUNT {{ (target)--() }} ELSE target.degree + 1 END
+            )
             RETURN r
             """
             await tx.run(query, properties=edge_properties)
@@ -294,5 +311,83 @@ class Neo4JStorage(BaseGraphStorage):
             logger.error(f"Error during edge upsert: {str(e)}")
             raise
 
+    async def delete_node(self, node_id: str):
+        """
+        Delete a node and its relationships, decrementing the stored degree of its neighbours.
+
+        Args:
+            node_id: The unique identifier for the node (used as label)
+        """
+        label = node_id.strip('"')
+
+        async def _do_delete(tx: AsyncManagedTransaction):
+            await tx.run(
+                f"""
+                MATCH (n:`{label}`)-[r]-(m)
+                WHERE m <> n
+                WITH m, count(r) AS removed
+                SET m.degree = coalesce(m.degree, COUNT {{ (m)--() }}) - removed
+                """
+            )
+            await tx.run(f"MATCH (n:`{label}`) DETACH DELETE n")
+            logger.debug(f"Deleted node with label '{label}'")
+
+        try:
+            async with self._driver.session() as session:
+                await session.execute_write(_do_delete)
+        except Exception as e:
+            logger.error(f"Error during node deletion: {str(e)}")
+            raise
+
+    async def delete_edge(self, source_node_id: str, target_node_id: str):
+        """
+        Delete the relationships between two nodes, decrementing the stored degree of both.
+
+        Args:
+            source_node_id (str): Label of the source node
+            target_node_id (str): Label of the target node
+        """
+        source_node_label = source_node_id.strip('"')
+        target_node_label = target_node_id.strip('"')
+
+        async def _do_delete_edge(tx: AsyncManagedTransaction):
+            await tx.run(
+                f"""
+                MATCH (source:`{source_node_label}`)-[r]-(target:`{target_node_label}`)
+                WITH source, target, collect(r) AS rels
+                SET source.degree = coalesce(source.degree, COUNT {{ (source)--() }}) - size(rels)
+                SET target.degree = coalesce(target.degree, COUNT {{ (target)--() }}) - size(rels)
+                FOREACH (r IN rels | DELETE r)
+                """
+            )
+            logger.debug(
+                f"Deleted edge between '{source_node_label}' and '{target_node_label}'"
+            )
+
+        try:
+            async with self._driver.session() as session:
+                await session.execute_write(_do_delete_edge)
+        except Exception as e:
+            logger.error(f"Error during edge deletion: {str(e)}")
+            raise
+
+    async def node_ids(self) -> list[str]:
+        # nodes are labelled with their entity name
+        async with self._driver.session() as session:
+            result = await session.run(
+                "MATCH (n) UNWIND labels(n) AS label RETURN DISTINCT label"
+            )
+            return [f'"{record["label"]}"' async for record in result]
+
+    async def rebuild_degrees(self):
+        """Recompute the stored degree property of every node from its relationships."""
+
+        async def _do_rebuild(tx: AsyncManagedTransaction):
+            await tx.run("MATCH (n) SET n.degree = COUNT { (n)--() }")
+
+        async with self._driver.session() as session:
+            await session.execute_write(_do_rebuild)
+        logger.info("Rebuilt stored node degrees in Neo4j")
+
     async def _node2vec_embed(self):
         print("Implemented but never called.")
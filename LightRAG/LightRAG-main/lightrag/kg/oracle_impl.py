@@ -1,4 +1,5 @@
 import asyncio
+import json
 
 # import html
 # import os
@@ -111,9 +112,33 @@ class OracleDB:
                 except Exception as e:
                     logger.error(f"Failed to create table {k} in Oracle database")
                     logger.error(f"Oracle database error: {e}")
+        await self._add_node_degree_column()
 
         logger.info("Finished check all tables in Oracle database")
 
+    async def _add_node_degree_column(self):
+        """为旧版本创建的节点表添加degree列,并计算已有节点的度"""
+        res = await self.query(
+            SQL_TEMPLATES["has_column"],
+            {"table_name": "LIGHTRAG_GRAPH_NODES", "column_name": "DEGREE"},
+        )
+        if res is not None:
+            return
+        try:
+            await self.execute(SQL_TEMPLATES["add_node_degree_column"])
+            workspaces = await self.query(
+                SQL_TEMPLATES["get_node_workspaces"], multirows=True
+            )
+            for row in workspaces or []:
+                await self.execute(
+                    SQL_TEMPLATES["rebuild_node_degrees"],
+                    {"workspace": row["workspace"]},
+                )
+            logger.info("Added the degree column to LIGHTRAG_GRAPH_NODES")
+        except Exception as e:
+            logger.error("Failed to add the degree column to LIGHTRAG_GRAPH_NODES")
+            logger.error(f"Oracle database error: {e}")
+
     async def query(
         self, sql: str, params: dict = None, multirows: bool = False
     ) -> Union[dict, None]:
@@ -182,13 +207,15 @@ class OracleKVStorage(BaseKVStorage):
         if res:
             data = res  # {"data":res}
             # print (data)
-            return data
+            return self._decode_row(data)
         else:
             return None
 
     # Query by id
     async def get_by_ids(self, ids: list[str], fields=None) -> Union[list[dict], None]:
-        """根据 id 获取 doc_chunks 数据"""
+        """根据 id 获取 doc_chunks 数据, 结果与 ids 一一对应, 不存在的为 None"""
+        if not ids:
+            return []
         SQL = SQL_TEMPLATES["get_by_ids_" + self.namespace].format(
             ids=",".join([f"'{id}'" for id in ids])
         )
@@ -196,12 +223,14 @@ class OracleKVStorage(BaseKVStorage):
         # print("get_by_ids:"+SQL)
         # print(params)
         res = await self.db.query(SQL, params, multirows=True)
-        if res:
-            data = res  # [{"data":i} for i in res]
-            # print(data)
-            return data
-        else:
-            return None
+        rows = {row["id"]: self._decode_row(row) for row in res or []}
+        return [rows.get(id) for id in ids]
+
+    def _decode_row(self, row: dict) -> dict:
+        # chunk extraction records are stored as one JSON document per chunk
+        if self.namespace == "chunk_extractions":
+            return json.loads(row["extraction"])
+        return row
 
     async def filter_keys(self, keys: list[str]) -> set[str]:
         """过滤掉重复内容"""
@@ -278,10 +307,33 @@ class OracleKVStorage(BaseKVStorage):
                 }
                 # print(merge_sql)
                 await self.db.execute(merge_sql, data)
+
+        if self.namespace == "chunk_extractions":
+            for k, v in left_data.items():
+                merge_sql = SQL_TEMPLATES["merge_chunk_extraction"]
+                data = {
+                    "check_id": k,
+                    "id": k,
+                    "extraction": json.dumps(v, ensure_ascii=False),
+                    "workspace": self.db.workspace,
+                }
+                await self.db.execute(merge_sql, data)
         return left_data
 
+    async def delete(self, ids: list[str]):
+        """按 id 删除数据"""
+        for id in ids:
+            self._data.pop(id, None)
+        if not ids or self.namespace not in N_T:
+            return
+        SQL = SQL_TEMPLATES["delete_by_ids"].format(
+            table_name=N_T[self.namespace], ids=",".join([f"'{id}'" for id in ids])
+        )
+        params = {"workspace": self.db.workspace}
+        await self.db.execute(SQL, params)
+
     async def index_done_callback(self):
-        if self.namespace in ["full_docs", "text_chunks"]:
+        if self.namespace in ["full_docs", "text_chunks", "chunk_extractions"]:
             logger.info("full doc and chunk data had been saved into oracle db!")
 
 
@@ -296,6 +348,10 @@ class OracleVectorDBStorage(BaseVectorStorage):
         """向向量数据库中插入数据"""
         pass
 
+    async def delete(self, ids: list[str]):
+        """向量保存在图和文本块表中, 随节点、边和文本块一起删除"""
+        pass
+
     async def index_done_callback(self):
         pass
 
@@ -342,15 +398,8 @@ class OracleGraphStorage(BaseGraphStorage):
         logger.debug(f"entity_name:{entity_name}, entity_type:{entity_type}")
 
         content = entity_name + description
-        contents = [content]
-        batches = [
-            contents[i : i + self._max_batch_size]
-            for i in range(0, len(contents), self._max_batch_size)
-        ]
-        embeddings_list = await asyncio.gather(
-            *[self.embedding_func(batch) for batch in batches]
-        )
-        embeddings = np.concatenate(embeddings_list)
+        # concurrent upserts are batched by the shared EmbeddingBatcher
+        embeddings = await self.embedding_func([content])
         content_vector = embeddings[0]
         merge_sql = SQL_TEMPLATES["merge_node"]
         data = {
@@ -380,17 +429,11 @@ class OracleGraphStorage(BaseGraphStorage):
         logger.debug(
             f"source_name:{source_name}, target_name:{target_name}, keywords: {keywords}"
         )
+        is_new_edge = not await self.has_edge(source_name, target_name)
 
         content = keywords + source_name + target_name + description
-        contents = [content]
-        batches = [
-            contents[i : i + self._max_batch_size]
-            for i in range(0, len(contents), self._max_batch_size)
-        ]
-        embeddings_list = await asyncio.gather(
-            *[self.embedding_func(batch) for batch in batches]
-        )
-        embeddings = np.concatenate(embeddings_list)
+        # concurrent upserts are batched by the shared EmbeddingBatcher
+        embeddings = await self.embedding_func([content])
         content_vector = embeddings[0]
         merge_sql = SQL_TEMPLATES["merge_edge"]
         data = {
@@ -407,6 +450,55 @@ class OracleGraphStorage(BaseGraphStorage):
         # print(merge_sql)
         await self.db.execute(merge_sql, data)
         # self._graph.add_edge(source_node_id, target_node_id, **edge_data)
+        if is_new_edge:
+            for node_name in [source_name, target_name]:
+                await self._update_node_degree(node_name, 1)
+
+    async def _update_node_degree(self, node_id: str, delta: int):
+        """更新节点存储的度"""
+        SQL = SQL_TEMPLATES["update_node_degree"]
+        params = {"workspace": self.db.workspace, "node_id": node_id, "delta": delta}
+        await self.db.execute(SQL, params)
+
+    async def delete_node(self, node_id: str):
+        """删除节点及其所有边, 并更新邻居节点的度"""
+        SQL = SQL_TEMPLATES["get_node_neighbours"]
+        params = {"workspace": self.db.workspace, "node_id": node_id}
+        res = await self.db.query(sql=SQL, params=params, multirows=True)
+        for edge in res or []:
+            for node_name in [edge["source_name"], edge["target_name"]]:
+                if node_name != node_id:
+                    await self._update_node_degree(node_name, -1)
+        await self.db.execute(SQL_TEMPLATES["delete_node_edges"], params)
+        await self.db.execute(SQL_TEMPLATES["delete_node"], params)
+        logger.info(f"Node {node_id} deleted from the graph.")
+
+    async def delete_edge(self, source_node_id: str, target_node_id: str):
+        """删除两个节点之间的边, 并更新两端节点的度"""
+        if not await self.has_edge(source_node_id, target_node_id):
+            return
+        params = {
+            "workspace": self.db.workspace,
+            "source_node_id": source_node_id,
+            "target_node_id": target_node_id,
+        }
+        await self.db.execute(SQL_TEMPLATES["delete_edge"], params)
+        for node_name in [source_node_id, target_node_id]:
+            await self._update_node_degree(node_name, -1)
+
+    async def rebuild_degrees(self):
+        """根据边表重新计算所有节点存储的度"""
+        SQL = SQL_TEMPLATES["rebuild_node_degrees"]
+        params = {"workspace": self.db.workspace}
+        await self.db.execute(SQL, params)
+        logger.info("Rebuilt stored node degrees in Oracle graph")
+
+    async def node_ids(self) -> list[str]:
+        """所有节点的名称"""
+        SQL = SQL_TEMPLATES["get_node_names"]
+        params = {"workspace": self.db.workspace}
+        res = await self.db.query(SQL, params, multirows=True)
+        return [row["name"] for row in res or []]
 
     async def embed_nodes(self, algorithm: str) -> tuple[np.ndarray, list[str]]:
         """为节点生成向量"""
@@ -479,9 +571,17 @@ class OracleGraphStorage(BaseGraphStorage):
 
     async def edge_degree(self, src_id: str, tgt_id: str) -> int:
         """根据源和目标节点id获取边的度"""
-        degree = await self.node_degree(src_id) + await self.node_degree(tgt_id)
-        # print("Edge degree",degree)
-        return degree
+        SQL = SQL_TEMPLATES["edge_degree"]
+        params = {
+            "workspace": self.db.workspace,
+            "source_node_id": src_id,
+            "target_node_id": tgt_id,
+        }
+        res = await self.db.query(SQL, params)
+        if res:
+            return res["degree"]
+        else:
+            return 0
 
     async def get_node(self, node_id: str) -> Union[dict, None]:
         """根据节点id获取节点数据"""
@@ -559,6 +659,7 @@ N_T = {
     "chunks": "LIGHTRAG_DOC_CHUNKS",
     "entities": "LIGHTRAG_GRAPH_NODES",
     "relationships": "LIGHTRAG_GRAPH_EDGES",
+    "chunk_extractions": "LIGHTRAG_CHUNK_EXTRACTIONS",
 }
 
 TABLES = {
@@ -596,6 +697,7 @@ TABLES = {
                     source_chunk_id varchar(256),
                     content CLOB,
                     content_vector VECTOR,
+                    degree NUMBER DEFAULT 0,
                     createtime TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updatetime TIMESTAMP DEFAULT NULL
                     )"""
@@ -616,6 +718,15 @@ TABLES = {
                     updatetime TIMESTAMP DEFAULT NULL
                     )"""
     },
+    "LIGHTRAG_CHUNK_EXTRACTIONS": {
+        "ddl": """CREATE TABLE LIGHTRAG_CHUNK_EXTRACTIONS (
+                    id varchar(256) PRIMARY KEY,
+                    workspace varchar(1024),
+                    extraction CLOB,
+                    createtime TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updatetime TIMESTAMP DEFAULT NULL
+                    )"""
+    },
     "LIGHTRAG_LLM_CACHE": {
         "ddl": """CREATE TABLE LIGHTRAG_LLM_CACHE (
                     id varchar(256) PRIMARY KEY,
@@ -650,7 +761,10 @@ SQL_TEMPLATES = {
     "get_by_id_text_chunks": "select ID,TOKENS,NVL(content,'') as content,CHUNK_ORDER_INDEX,FULL_DOC_ID from LIGHTRAG_DOC_CHUNKS where workspace=:workspace and ID=:id",
     "get_by_ids_full_docs": "select ID,NVL(content,'') as content from LIGHTRAG_DOC_FULL where workspace=:workspace and ID in ({ids})",
     "get_by_ids_text_chunks": "select ID,TOKENS,NVL(content,'') as content,CHUNK_ORDER_INDEX,FULL_DOC_ID  from LIGHTRAG_DOC_CHUNKS where workspace=:workspace and ID in ({ids})",
+    "get_by_id_chunk_extractions": "select ID,extraction from LIGHTRAG_CHUNK_EXTRACTIONS where workspace=:workspace and ID=:id",
+    "get_by_ids_chunk_extractions": "select ID,extraction from LIGHTRAG_CHUNK_EXTRACTIONS where workspace=:workspace and ID in ({ids})",
     "filter_keys": "select id from {table_name} where workspace=:workspace and id in ({ids})",
+    "delete_by_ids": "delete from {table_name} where workspace=:workspace and id in ({ids})",
     "merge_doc_full": """ MERGE INTO LIGHTRAG_DOC_FULL a
                     USING DUAL
                     ON (a.id = :check_id)
@@ -663,6 +777,12 @@ SQL_TEMPLATES = {
                     WHEN NOT MATCHED THEN
                     INSERT(id,content,workspace,tokens,chunk_order_index,full_doc_id,content_vector)
                     values (:id,:content,:workspace,:tokens,:chunk_order_index,:full_doc_id,:content_vector) """,
+    "merge_chunk_extraction": """MERGE INTO LIGHTRAG_CHUNK_EXTRACTIONS a
+                    USING DUAL
+                    ON (a.id = :check_id)
+                    WHEN NOT MATCHED THEN
+                    INSERT(id,extraction,workspace) values(:id,:extraction,:workspace)
+                    """,
     # SQL for VectorStorage
     "entities": """SELECT name as entity_name FROM
         (SELECT id,name,VECTOR_DISTANCE(content_vector,vector(:embedding_string,{dimension},{dtype}),COSINE) as distance
@@ -686,11 +806,35 @@ SQL_TEMPLATES = {
         WHERE e.workspace=:workspace and a.workspace=:workspace and b.workspace=:workspace
         AND a.name=:source_node_id AND b.name=:target_node_id
         COLUMNS (e.source_name,e.target_name)  )""",
-    "node_degree": """SELECT count(1) as degree FROM GRAPH_TABLE (lightrag_graph
-        MATCH (a)-[e]->(b)
-        WHERE a.workspace=:workspace and a.workspace=:workspace and b.workspace=:workspace
-        AND a.name=:node_id or b.name = :node_id
-        COLUMNS (a.name))""",
+    "node_degree": """SELECT NVL(MAX(degree), 0) as degree FROM LIGHTRAG_GRAPH_NODES
+        WHERE workspace=:workspace AND name=:node_id""",
+    "edge_degree": """SELECT NVL(MAX(CASE WHEN name=:source_node_id THEN degree END), 0)
+        + NVL(MAX(CASE WHEN name=:target_node_id THEN degree END), 0) as degree
+        FROM LIGHTRAG_GRAPH_NODES
+        WHERE workspace=:workspace AND name IN (:source_node_id, :target_node_id)""",
+    "update_node_degree": """UPDATE LIGHTRAG_GRAPH_NODES SET degree = NVL(degree, 0) + :delta
+        WHERE workspace=:workspace AND name=:node_id""",
+    "get_node_names": """SELECT name FROM LIGHTRAG_GRAPH_NODES
+        WHERE workspace=:workspace""",
+    "has_column": """SELECT column_name FROM USER_TAB_COLUMNS
+        WHERE table_name=:table_name AND column_name=:column_name""",
+    "add_node_degree_column": "ALTER TABLE LIGHTRAG_GRAPH_NODES ADD (degree NUMBER DEFAULT 0)",
+    "get_node_workspaces": "SELECT DISTINCT workspace FROM LIGHTRAG_GRAPH_NODES",
+    "rebuild_node_degrees": """UPDATE LIGHTRAG_GRAPH_NODES n SET degree = (
+            SELECT count(1) FROM (
+                SELECT DISTINCT source_name, target_name FROM LIGHTRAG_GRAPH_EDGES
+                WHERE workspace=:workspace) e
+            WHERE e.source_name = n.name OR e.target_name = n.name)
+        WHERE n.workspace=:workspace""",
+    "get_node_neighbours": """SELECT DISTINCT source_name, target_name FROM LIGHTRAG_GRAPH_EDGES
+        WHERE workspace=:workspace AND (source_name=:node_id OR target_name=:node_id)""",
+    "delete_node_edges": """DELETE FROM LIGHTRAG_GRAPH_EDGES
+        WHERE workspace=:workspace AND (source_name=:node_id OR target_name=:node_id)""",
+    "delete_edge": """DELETE FROM LIGHTRAG_GRAPH_EDGES
+        WHERE workspace=:workspace AND ((source_name=:source_node_id AND target_name=:target_node_id)
+            OR (source_name=:target_node_id AND target_name=:source_node_id))""",
+    "delete_node": """DELETE FROM LIGHTRAG_GRAPH_NODES
+        WHERE workspace=:workspace AND name=:node_id""",
     "get_node": """SELECT t1.name,t2.entity_type,t2.source_chunk_id as source_id,NVL(t2.description,'') AS description
         FROM GRAPH_TABLE (lightrag_graph
         MATCH (a)
@@ -1,36 +1,51 @@
 import asyncio
 import os
+import time
 from tqdm.asyncio import tqdm as tqdm_async
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass, field, replace
 from datetime import datetime
 from functools import partial
-from typing import Type, cast
+from typing import AsyncIterator, Callable, Iterator, Type, Union
 
 from .llm import (
+    close_shared_clients,
     gpt_4o_mini_complete,
     openai_embedding,
 )
 from .operate import (
     chunking_by_token_size,
+    entity_lock_key,
     extract_entities,
+    extract_graph_elements,
+    group_graph_elements_by_chunk,
+    merge_graph_elements,
+    relation_lock_key,
+    remove_chunk_contributions,
     # local_query,global_query,hybrid_query,
     kg_query,
     naive_query,
 )
 
 from .utils import (
+    EmbeddingBatcher,
     EmbeddingFunc,
+    KeyedLock,
     compute_mdhash_id,
+    encode_string_by_tiktoken,
     limit_async_func_call,
     convert_response_to_json,
     logger,
     set_logger,
+    split_string_by_multi_markers,
 )
+from .prompt import GRAPH_FIELD_SEP
 from .base import (
     BaseGraphStorage,
     BaseKVStorage,
     BaseVectorStorage,
-    StorageNameSpace,
+    DocumentInsertStatus,
+    GleaningStats,
+    LLMUsageStats,
     QueryParam,
 )
 
@@ -38,7 +53,11 @@ from .storage import (
     JsonKVStorage,
     NanoVectorDBStorage,
     NetworkXStorage,
+    ProvenanceIndex,
+    StorageFlushScheduler,
 )
+from .workers import ExtractionWorkerPool
+from .keywords import LocalKeywordExtractor
 
 from .kg.neo4j_impl import Neo4JStorage
 
@@ -96,7 +115,33 @@ class LightRAG:
 
     # entity extraction
     entity_extract_max_gleaning: int = 1
+    # "fixed" runs entity_extract_max_gleaning rounds, asking the LLM between rounds
+    # whether to go on; "adaptive" skips rounds that are unlikely to find more, see
+    # AdaptiveGleaningPolicy for entity_extract_gleaning_params. The calls saved and
+    # the estimated recall lost are logged and summed up in gleaning_stats
+    entity_extract_gleaning: str = "fixed"
+    entity_extract_gleaning_params: dict = field(default_factory=dict)
+    # extract up to this many consecutive chunks with one LLM request, as long as
+    # their text fits in half of what llm_model_max_token_size leaves after the
+    # prompt; 1 sends a request per chunk. insert_batch only packs chunks of the
+    # same document, ainsert the chunks of all its documents
+    entity_extract_pack_chunks: int = 1
     entity_summary_to_max_tokens: int = 500
+    # insert_batch chunks and extracts this many documents at once, the others
+    # wait in priority order
+    insert_batch_max_async: int = 4
+    # run the LLM extraction and parsing of chunks in this many worker processes,
+    # merging stays in this process; 0 extracts on the event loop. The workers call
+    # llm_model_func (which must then be picklable) without the LLM response cache
+    insert_worker_processes: int = 0
+    insert_worker_start_method: str = "spawn"
+
+    # query keywords: "llm" asks llm_model_func for them, "local" takes the entity
+    # names found in the query and the keywords of the relations nearest to it,
+    # saving an LLM call per query, see LocalKeywordExtractor for
+    # keyword_extraction_params
+    keyword_extraction: str = "llm"
+    keyword_extraction_params: dict = field(default_factory=dict)
 
     # node embedding
     node_embedding_algorithm: str = "node2vec"
@@ -115,6 +160,10 @@ class LightRAG:
     embedding_func: EmbeddingFunc = field(default_factory=lambda: openai_embedding)
     embedding_batch_num: int = 32
     embedding_func_max_async: int = 16
+    # embedding calls of all the storages share a queue, sent to embedding_func in
+    # batches of embedding_batch_num texts, or after waiting this many seconds for
+    # a batch to fill up; 0 calls embedding_func directly
+    embedding_batch_max_wait: float = 0.01
 
     # LLM
     llm_model_func: callable = gpt_4o_mini_complete  # hf_model_complete#
@@ -127,6 +176,16 @@ class LightRAG:
     vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
 
     enable_llm_cache: bool = True
+    # storage writes after inserts and queries are coalesced and done in the
+    # background, at most once per interval (seconds) or as soon as max_pending
+    # updates piled up; 0 writes after every operation
+    storage_flush_interval: float = 1.0
+    storage_flush_max_pending: int = 100
+    # file-backed storages journal updates made between flushes and replay them on
+    # load, so a crash loses neither those updates nor the last flushed state;
+    # storage_wal_fsync also syncs every journal append to disk (slower)
+    enable_storage_wal: bool = True
+    storage_wal_fsync: bool = False
 
     # extension
     addon_params: dict = field(default_factory=dict)
@@ -158,6 +217,10 @@ class LightRAG:
             logger.info(f"Creating working directory {self.working_dir}")
             os.makedirs(self.working_dir)
 
+        self._flush_scheduler = StorageFlushScheduler(
+            flush_interval=self.storage_flush_interval,
+            max_pending=self.storage_flush_max_pending,
+        )
         self.llm_response_cache = (
             self.key_string_value_json_storage_cls(
                 namespace="llm_response_cache",
@@ -171,6 +234,12 @@ class LightRAG:
         self.embedding_func = limit_async_func_call(self.embedding_func_max_async)(
             self.embedding_func
         )
+        if self.embedding_batch_max_wait > 0:
+            self.embedding_func = EmbeddingBatcher(
+                self.embedding_func,
+                max_batch_size=self.embedding_batch_num,
+                max_wait=self.embedding_batch_max_wait,
+            )
 
         ####
         # add embedding func by walter
@@ -185,9 +254,24 @@ class LightRAG:
             global_config=asdict(self),
             embedding_func=self.embedding_func,
         )
+        # what each chunk contributed to the graph (descriptions, types, keywords,
+        # weights), used to merge the elements again without it when its document
+        # is deleted or updated; provenance_index says which elements these are
+        self.chunk_extractions = self.key_string_value_json_storage_cls(
+            namespace="chunk_extractions",
+            global_config=asdict(self),
+            embedding_func=None,
+        )
         self.chunk_entity_relation_graph = self.graph_storage_cls(
             namespace="chunk_entity_relation", global_config=asdict(self)
         )
+        # chunk <-> entity/relation sources of the graph above
+        self.provenance_index = ProvenanceIndex(
+            namespace="chunk_entity_relation", global_config=asdict(self)
+        )
+        # per entity/relation locks shared by all inserts and deletes, so they can
+        # merge into the graph concurrently
+        self._graph_locks = KeyedLock()
         ####
         # add embedding func by walter over
         ####
@@ -210,10 +294,28 @@ class LightRAG:
             embedding_func=self.embedding_func,
         )
 
+        if self.keyword_extraction == "local":
+            self.keyword_extractor = LocalKeywordExtractor(
+                self.provenance_index,
+                self.chunk_entity_relation_graph,
+                self.relationships_vdb,
+                **self.keyword_extraction_params,
+            )
+        elif self.keyword_extraction == "llm":
+            self.keyword_extractor = None
+        else:
+            raise ValueError(f"Unknown keyword_extraction {self.keyword_extraction}")
+
+        self._worker_pool = None
+        self.gleaning_stats = GleaningStats()
+        # tokens reported by the LLM providers, including prefix cache hits
+        self.llm_usage = LLMUsageStats()
+        self._worker_llm_model_func = self.llm_model_func
         self.llm_model_func = limit_async_func_call(self.llm_model_max_async)(
             partial(
                 self.llm_model_func,
                 hashing_kv=self.llm_response_cache,
+                llm_usage=self.llm_usage,
                 **self.llm_model_kwargs,
             )
         )
@@ -235,7 +337,9 @@ class LightRAG:
 
     def insert(self, string_or_strings):
         loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.ainsert(string_or_strings))
+        result = loop.run_until_complete(self.ainsert(string_or_strings))
+        loop.run_until_complete(self.aflush())
+        return result
 
     async def ainsert(self, string_or_strings):
         update_storage = False
@@ -259,18 +363,8 @@ class LightRAG:
             for doc_key, doc in tqdm_async(
                 new_docs.items(), desc="Chunking documents", unit="doc"
             ):
-                chunks = {
-                    compute_mdhash_id(dp["content"], prefix="chunk-"): {
-                        **dp,
-                        "full_doc_id": doc_key,
-                    }
-                    for dp in chunking_by_token_size(
-                        doc["content"],
-                        overlap_token_size=self.chunk_overlap_token_size,
-                        max_token_size=self.chunk_token_size,
-                        tiktoken_model=self.tiktoken_model_name,
-                    )
-                }
+                chunks = self._chunk_document(doc_key, doc["content"])
+                doc["chunk_ids"] = list(chunks.keys())
                 inserting_chunks.update(chunks)
             _add_chunk_keys = await self.text_chunks.filter_keys(
                 list(inserting_chunks.keys())
@@ -292,6 +386,11 @@ class LightRAG:
                 entity_vdb=self.entities_vdb,
                 relationships_vdb=self.relationships_vdb,
                 global_config=asdict(self),
+                chunk_extractions=self.chunk_extractions,
+                provenance_index=self.provenance_index,
+                graph_locks=self._graph_locks,
+                worker_pool=self._get_worker_pool(),
+                gleaning_stats=self.gleaning_stats,
             )
             if maybe_new_kg is None:
                 logger.warning("No new entities and relationships found")
@@ -304,25 +403,231 @@ class LightRAG:
             if update_storage:
                 await self._insert_done()
 
+    def _get_worker_pool(self) -> Union[ExtractionWorkerPool, None]:
+        if self.insert_worker_processes <= 0:
+            return None
+        if self._worker_pool is None:
+            worker_config = {k: v for k, v in asdict(self).items() if not callable(v)}
+            worker_config["llm_model_func"] = self._worker_llm_model_func
+            # the LLM concurrency limit is shared between the workers
+            worker_config["llm_model_max_async"] = max(
+                1, self.llm_model_max_async // self.insert_worker_processes
+            )
+            self._worker_pool = ExtractionWorkerPool(
+                self.insert_worker_processes,
+                worker_config,
+                start_method=self.insert_worker_start_method,
+            )
+        return self._worker_pool
+
+    def _chunk_document(self, doc_id: str, content: str) -> dict[str, dict]:
+        return {
+            compute_mdhash_id(dp["content"], prefix="chunk-"): {
+                **dp,
+                "full_doc_id": doc_id,
+            }
+            for dp in chunking_by_token_size(
+                content,
+                overlap_token_size=self.chunk_overlap_token_size,
+                max_token_size=self.chunk_token_size,
+                tiktoken_model=self.tiktoken_model_name,
+            )
+        }
+
     async def _insert_done(self):
-        tasks = []
-        for storage_inst in [
+        await self._flush_scheduler.mark_dirty(
             self.full_docs,
             self.text_chunks,
+            self.chunk_extractions,
             self.llm_response_cache,
             self.entities_vdb,
             self.relationships_vdb,
             self.chunks_vdb,
             self.chunk_entity_relation_graph,
-        ]:
-            if storage_inst is None:
+            self.provenance_index,
+        )
+
+    def insert_batch(
+        self,
+        documents: list[str],
+        priorities: list[float] = None,
+        on_progress: Callable[[DocumentInsertStatus], None] = None,
+    ) -> list[DocumentInsertStatus]:
+        loop = always_get_an_event_loop()
+        result = loop.run_until_complete(
+            self.ainsert_batch(documents, priorities, on_progress)
+        )
+        loop.run_until_complete(self.aflush())
+        return result
+
+    async def ainsert_batch(
+        self,
+        documents: list[str],
+        priorities: list[float] = None,
+        on_progress: Callable[[DocumentInsertStatus], None] = None,
+    ) -> list[DocumentInsertStatus]:
+        """Insert documents as independent units and report on each of them.
+
+        Up to insert_batch_max_async documents are processed at once, the others wait
+        in order of priority (lowest first; by default the document length, so short
+        documents finish first). Each document's chunks, entities and relationships
+        are committed as soon as it is done, so it can be queried before the rest of
+        the batch finishes. on_progress is called with the document's status after
+        every stage and every extracted chunk.
+
+        As each document is extracted on its own, entity_extract_pack_chunks only
+        packs chunks of the same document here; ainsert packs the chunks of all its
+        documents, including single-chunk ones.
+        """
+        docs: dict[str, tuple[str, DocumentInsertStatus]] = {}
+        for i, content in enumerate(documents):
+            content = content.strip()
+            doc_id = compute_mdhash_id(content, prefix="doc-")
+            if doc_id in docs:
                 continue
-            tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
-        await asyncio.gather(*tasks)
+            priority = priorities[i] if priorities is not None else len(content)
+            docs[doc_id] = (
+                content,
+                DocumentInsertStatus(doc_id=doc_id, priority=priority),
+            )
+
+        new_doc_ids = await self.full_docs.filter_keys(list(docs.keys()))
+        queue = asyncio.PriorityQueue()
+        for order, (doc_id, (_, status)) in enumerate(docs.items()):
+            if doc_id in new_doc_ids:
+                queue.put_nowait((status.priority, order, doc_id))
+            else:
+                status.status = "skipped"
+                if on_progress is not None:
+                    on_progress(status)
+        logger.info(
+            f"[New Docs] inserting {queue.qsize()} docs, {len(docs) - queue.qsize()} already in the storage"
+        )
+
+        async def _worker():
+            while not queue.empty():
+                _, _, doc_id = queue.get_nowait()
+                content, status = docs[doc_id]
+                await self._insert_document(doc_id, content, status, on_progress)
+
+        await asyncio.gather(
+            *[_worker() for _ in range(min(self.insert_batch_max_async, queue.qsize()))]
+        )
+        return [status for _, status in docs.values()]
+
+    async def _insert_document(
+        self,
+        doc_id: str,
+        content: str,
+        status: DocumentInsertStatus,
+        on_progress: Callable[[DocumentInsertStatus], None] = None,
+    ):
+        start = stage_start = time.perf_counter()
+
+        def _enter_stage(stage: str):
+            nonlocal stage_start
+            now = time.perf_counter()
+            if status.status not in ("pending", stage):
+                status.timings[status.status] = now - stage_start
+            stage_start = now
+            status.status = stage
+            if stage in ("done", "failed", "skipped"):
+                status.timings["total"] = now - start
+            if on_progress is not None:
+                on_progress(status)
+
+        def _chunk_done(chunk_key: str):
+            status.chunks_done += 1
+            if on_progress is not None:
+                on_progress(status)
+
+        try:
+            _enter_stage("chunking")
+            chunks = self._chunk_document(doc_id, content)
+            doc = {"content": content, "chunk_ids": list(chunks.keys())}
+            new_chunk_keys = await self.text_chunks.filter_keys(list(chunks.keys()))
+            chunks = {k: v for k, v in chunks.items() if k in new_chunk_keys}
+            status.chunks = len(chunks)
+            if not chunks:
+                # nothing to extract, e.g. an update that only removed text
+                await self.full_docs.upsert({doc_id: doc})
+                await self._insert_done()
+                _enter_stage("done")
+                return
+
+            _enter_stage("extracting")
+            global_config = asdict(self)
+            global_config["llm_model_func"] = self._count_llm_usage(status)
+            # LLM usage is only counted for extraction in this process
+            maybe_nodes, maybe_edges = await extract_graph_elements(
+                chunks,
+                global_config,
+                show_progress=False,
+                on_chunk_done=_chunk_done,
+                worker_pool=self._get_worker_pool(),
+                gleaning_stats=self.gleaning_stats,
+            )
+
+            _enter_stage("merging")
+            # documents sharing entities merge concurrently, each entity and
+            # relation is locked while it is merged
+            entities, relationships = await merge_graph_elements(
+                maybe_nodes,
+                maybe_edges,
+                self.chunk_entity_relation_graph,
+                self.entities_vdb,
+                self.relationships_vdb,
+                global_config,
+                show_progress=False,
+                provenance_index=self.provenance_index,
+                graph_locks=self._graph_locks,
+            )
+            status.entities = len(entities)
+            status.relations = len(relationships)
+            if not entities or not relationships:
+                # like ainsert, the document is not stored so it can be retried
+                raise ValueError("no entities or relationships were extracted")
+            await self.chunk_extractions.upsert(
+                group_graph_elements_by_chunk(chunks.keys(), maybe_nodes, maybe_edges)
+            )
+            await self.full_docs.upsert({doc_id: doc})
+            await self.text_chunks.upsert(chunks)
+            # the chunk texts are stored first so vector hits always resolve
+            await self.chunks_vdb.upsert(chunks)
+            await self._insert_done()
+            _enter_stage("done")
+        except Exception as e:
+            logger.error(f"Failed to insert document {doc_id}: {e}")
+            status.error = f"{type(e).__name__}: {e}"
+            _enter_stage("failed")
+
+    def _count_llm_usage(self, status: DocumentInsertStatus):
+        """Wrap the LLM func so the calls it makes are accounted to one document"""
+        llm_model_func = self.llm_model_func
+        model_name = self.tiktoken_model_name
+
+        def _tokens(content) -> int:
+            return len(encode_string_by_tiktoken(content, model_name=model_name))
+
+        async def counted_llm_model_func(prompt, **kwargs):
+            response = await llm_model_func(prompt, **kwargs)
+            status.llm_calls += 1
+            status.prompt_tokens += _tokens(prompt)
+            if kwargs.get("system_prompt"):
+                status.prompt_tokens += _tokens(kwargs["system_prompt"])
+            for message in kwargs.get("history_messages") or []:
+                status.prompt_tokens += _tokens(message["content"])
+            if isinstance(response, str):
+                status.completion_tokens += _tokens(response)
+            return response
+
+        return counted_llm_model_func
 
     def insert_custom_kg(self, custom_kg: dict):
         loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.ainsert_custom_kg(custom_kg))
+        result = loop.run_until_complete(self.ainsert_custom_kg(custom_kg))
+        loop.run_until_complete(self.aflush())
+        return result
 
     async def ainsert_custom_kg(self, custom_kg: dict):
         update_storage = False
@@ -342,9 +647,14 @@ class LightRAG:
                     "source_id": source_id,
                 }
                 # Insert node data into the knowledge graph
-                await self.chunk_entity_relation_graph.upsert_node(
-                    entity_name, node_data=node_data
-                )
+                async with self._graph_locks.lock(entity_lock_key(entity_name)):
+                    await self.chunk_entity_relation_graph.upsert_node(
+                        entity_name, node_data=node_data
+                    )
+                    self.provenance_index.set_entity_chunk_ids(
+                        entity_name,
+                        split_string_by_multi_markers(source_id, [GRAPH_FIELD_SEP]),
+                    )
                 node_data["entity_name"] = entity_name
                 all_entities_data.append(node_data)
                 update_storage = True
@@ -360,30 +670,47 @@ class LightRAG:
                 source_id = relationship_data["source_id"]
 
                 # Check if nodes exist in the knowledge graph
-                for need_insert_id in [src_id, tgt_id]:
-                    if not (
-                        await self.chunk_entity_relation_graph.has_node(need_insert_id)
-                    ):
-                        await self.chunk_entity_relation_graph.upsert_node(
-                            need_insert_id,
-                            node_data={
-                                "source_id": source_id,
-                                "description": "UNKNOWN",
-                                "entity_type": "UNKNOWN",
-                            },
-                        )
+                async with self._graph_locks.lock(
+                    entity_lock_key(src_id), entity_lock_key(tgt_id)
+                ):
+                    for need_insert_id in [src_id, tgt_id]:
+                        if not (
+                            await self.chunk_entity_relation_graph.has_node(
+                                need_insert_id
+                            )
+                        ):
+                            await self.chunk_entity_relation_graph.upsert_node(
+                                need_insert_id,
+                                node_data={
+                                    "source_id": source_id,
+                                    "description": "UNKNOWN",
+                                    "entity_type": "UNKNOWN",
+                                },
+                            )
+                            self.provenance_index.set_entity_chunk_ids(
+                                need_insert_id,
+                                split_string_by_multi_markers(
+                                    source_id, [GRAPH_FIELD_SEP]
+                                ),
+                            )
 
                 # Insert edge into the knowledge graph
-                await self.chunk_entity_relation_graph.upsert_edge(
-                    src_id,
-                    tgt_id,
-                    edge_data={
-                        "weight": weight,
-                        "description": description,
-                        "keywords": keywords,
-                        "source_id": source_id,
-                    },
-                )
+                async with self._graph_locks.lock(relation_lock_key(src_id, tgt_id)):
+                    await self.chunk_entity_relation_graph.upsert_edge(
+                        src_id,
+                        tgt_id,
+                        edge_data={
+                            "weight": weight,
+                            "description": description,
+                            "keywords": keywords,
+                            "source_id": source_id,
+                        },
+                    )
+                    self.provenance_index.set_relation_chunk_ids(
+                        src_id,
+                        tgt_id,
+                        split_string_by_multi_markers(source_id, [GRAPH_FIELD_SEP]),
+                    )
                 edge_data = {
                     "src_id": src_id,
                     "tgt_id": tgt_id,
@@ -422,11 +749,50 @@ class LightRAG:
             if update_storage:
                 await self._insert_done()
 
-    def query(self, query: str, param: QueryParam = QueryParam()):
+    def query(self, query: str, param: QueryParam = None):
         loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.aquery(query, param))
+        response = loop.run_until_complete(self.aquery(query, param))
+        loop.run_until_complete(self.aflush())
+        return response
 
-    async def aquery(self, query: str, param: QueryParam = QueryParam()):
+    async def aquery(self, query: str, param: QueryParam = None):
+        # each query works on its own copy, so callers may reuse or change
+        # their QueryParam while earlier queries are still running
+        param = replace(param) if param is not None else QueryParam()
+        response = await self._run_query(query, param)
+        await self._query_done()
+        return response
+
+    def query_stream(self, query: str, param: QueryParam = None) -> Iterator[str]:
+        loop = always_get_an_event_loop()
+        pieces = self.aquery_stream(query, param)
+        while True:
+            try:
+                yield loop.run_until_complete(pieces.__anext__())
+            except StopAsyncIteration:
+                break
+        loop.run_until_complete(self.aflush())
+
+    async def aquery_stream(
+        self, query: str, param: QueryParam = None
+    ) -> AsyncIterator[str]:
+        """Yield the answer piece by piece as the LLM produces it.
+
+        Cached answers are replayed as a stream as well. Answers that never reach
+        the LLM (only_need_context, failed keyword extraction, ...) are yielded whole.
+        """
+        param = replace(param or QueryParam(), stream=True)
+        response = await self._run_query(query, param)
+        try:
+            if isinstance(response, str):
+                yield response
+            else:
+                async for piece in response:
+                    yield piece
+        finally:
+            await self._query_done()
+
+    async def _run_query(self, query: str, param: QueryParam):
         if param.mode in ["local", "global", "hybrid"]:
             response = await kg_query(
                 query,
@@ -436,6 +802,8 @@ class LightRAG:
                 self.text_chunks,
                 param,
                 asdict(self),
+                provenance_index=self.provenance_index,
+                keyword_extractor=self.keyword_extractor,
             )
         elif param.mode == "naive":
             response = await naive_query(
@@ -447,28 +815,31 @@ class LightRAG:
             )
         else:
             raise ValueError(f"Unknown mode {param.mode}")
-        await self._query_done()
         return response
 
     async def _query_done(self):
-        tasks = []
-        for storage_inst in [self.llm_response_cache]:
-            if storage_inst is None:
-                continue
-            tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
-        await asyncio.gather(*tasks)
+        await self._flush_scheduler.mark_dirty(self.llm_response_cache)
 
     def delete_by_entity(self, entity_name: str):
         loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.adelete_by_entity(entity_name))
+        result = loop.run_until_complete(self.adelete_by_entity(entity_name))
+        loop.run_until_complete(self.aflush())
+        return result
 
     async def adelete_by_entity(self, entity_name: str):
         entity_name = f'"{entity_name.upper()}"'
 
         try:
-            await self.entities_vdb.delete_entity(entity_name)
-            await self.relationships_vdb.delete_relation(entity_name)
-            await self.chunk_entity_relation_graph.delete_node(entity_name)
+            async with self._graph_locks.lock(entity_lock_key(entity_name)):
+                await self.entities_vdb.delete_entity(entity_name)
+                await self.relationships_vdb.delete_relation(entity_name)
+                for src_id, tgt_id in (
+                    await self.chunk_entity_relation_graph.get_node_edges(entity_name)
+                    or []
+                ):
+                    self.provenance_index.set_relation_chunk_ids(src_id, tgt_id, [])
+                self.provenance_index.set_entity_chunk_ids(entity_name, [])
+                await self.chunk_entity_relation_graph.delete_node(entity_name)
 
             logger.info(
                 f"Entity '{entity_name}' and its relationships have been deleted."
@@ -477,14 +848,172 @@ class LightRAG:
         except Exception as e:
             logger.error(f"Error while deleting entity '{entity_name}': {e}")
 
+    def delete_document(self, doc_id: str):
+        loop = always_get_an_event_loop()
+        result = loop.run_until_complete(self.adelete_document(doc_id))
+        loop.run_until_complete(self.aflush())
+        return result
+
+    async def adelete_document(self, doc_id: str) -> bool:
+        """Remove a document, its chunks and what they contributed to the graph.
+
+        doc_id is the id the document was inserted under (see DocumentInsertStatus,
+        or compute_mdhash_id(content.strip(), prefix="doc-")). Entities and relations
+        also found in other documents are kept and merged again without this one.
+        Returns False if the document is not in the storage.
+        """
+        doc = await self.full_docs.get_by_id(doc_id)
+        if doc is None:
+            logger.warning(f"Document {doc_id} not found for deletion")
+            return False
+        chunk_ids = await self._document_chunk_ids(doc_id, doc)
+        stats = await self._remove_chunks(chunk_ids)
+        await self.full_docs.delete([doc_id])
+        logger.info(f"Deleted document {doc_id} with {len(chunk_ids)} chunks: {stats}")
+        await self._insert_done()
+        return True
+
+    def update_document(self, doc_id: str, content: str):
+        loop = always_get_an_event_loop()
+        result = loop.run_until_complete(self.aupdate_document(doc_id, content))
+        loop.run_until_complete(self.aflush())
+        return result
+
+    async def aupdate_document(self, doc_id: str, content: str) -> DocumentInsertStatus:
+        """Replace a document with a new version of its content.
+
+        Chunks the two versions have in common keep their embeddings and graph
+        contributions; only removed chunks are taken out of the graph and only new
+        ones are extracted. The document gets the id of its new content, returned in
+        the status. If the new version fails, the old one is left as it was.
+        """
+        content = content.strip()
+        new_doc_id = compute_mdhash_id(content, prefix="doc-")
+        status = DocumentInsertStatus(doc_id=new_doc_id)
+        if new_doc_id == doc_id:
+            status.status = "skipped"
+            return status
+        doc = await self.full_docs.get_by_id(doc_id)
+        if doc is None:
+            logger.warning(f"Document {doc_id} not found, inserting it as a new one")
+            old_chunk_ids = []
+        else:
+            old_chunk_ids = await self._document_chunk_ids(doc_id, doc)
+        if await self.full_docs.get_by_id(new_doc_id) is not None:
+            # the new content is already stored as another document
+            if doc is not None:
+                await self.adelete_document(doc_id)
+            status.status = "skipped"
+            return status
+
+        new_chunks = self._chunk_document(new_doc_id, content)
+        kept_chunk_ids = [k for k in old_chunk_ids if k in new_chunks]
+        # the new version is stored first (its kept chunks are already stored, so
+        # they aren't extracted again), so a failed extraction leaves the old one
+        # as it was
+        await self._insert_document(new_doc_id, content, status)
+        if status.status != "done":
+            return status
+        stats = await self._remove_chunks(
+            [k for k in old_chunk_ids if k not in new_chunks]
+        )
+        logger.info(
+            f"Updated document {doc_id} -> {new_doc_id}, kept {len(kept_chunk_ids)} chunks: {stats}"
+        )
+        # kept chunks move to the new version, their graph contributions stay
+        await self.text_chunks.delete(kept_chunk_ids)
+        await self.text_chunks.upsert({k: new_chunks[k] for k in kept_chunk_ids})
+        if doc is not None:
+            await self.full_docs.delete([doc_id])
+        await self._insert_done()
+        return status
+
+    async def _document_chunk_ids(self, doc_id: str, doc: dict) -> list[str]:
+        """Ids of the stored chunks that belong to a document"""
+        # documents inserted before chunk_ids were recorded are chunked again,
+        # which gives the same ids as long as the chunking settings are unchanged
+        chunk_ids = doc.get("chunk_ids") or list(
+            self._chunk_document(doc_id, doc["content"]).keys()
+        )
+        chunks = await self.text_chunks.get_by_ids(chunk_ids)
+        # a chunk shared with an earlier document stays with that document
+        return [
+            chunk_id
+            for chunk_id, chunk in zip(chunk_ids, chunks)
+            if chunk is not None and chunk["full_doc_id"] == doc_id
+        ]
+
+    async def _remove_chunks(self, chunk_ids: list[str]) -> dict[str, int]:
+        if not chunk_ids:
+            return {}
+        records = dict(
+            zip(chunk_ids, await self.chunk_extractions.get_by_ids(chunk_ids))
+        )
+        missing = [k for k, record in records.items() if record is None]
+        if missing:
+            # chunks inserted before their extraction was recorded; extracting
+            # them again is served from the LLM cache when it is enabled
+            logger.info(f"Re-extracting {len(missing)} chunks without a record")
+            chunks = dict(zip(missing, await self.text_chunks.get_by_ids(missing)))
+            maybe_nodes, maybe_edges = await extract_graph_elements(
+                chunks, asdict(self), show_progress=False
+            )
+            records.update(
+                group_graph_elements_by_chunk(missing, maybe_nodes, maybe_edges)
+            )
+        stats = await remove_chunk_contributions(
+            records,
+            self.chunk_entity_relation_graph,
+            self.entities_vdb,
+            self.relationships_vdb,
+            self.chunk_extractions,
+            asdict(self),
+            provenance_index=self.provenance_index,
+            graph_locks=self._graph_locks,
+        )
+        await self.chunks_vdb.delete(chunk_ids)
+        await self.text_chunks.delete(chunk_ids)
+        await self.chunk_extractions.delete(chunk_ids)
+        return stats
+
+    def rebuild_degrees(self):
+        loop = always_get_an_event_loop()
+        result = loop.run_until_complete(self.arebuild_degrees())
+        loop.run_until_complete(self.aflush())
+        return result
+
+    async def arebuild_degrees(self):
+        """Recompute the stored node degrees used for ranking, e.g. after a bulk import"""
+        await self.chunk_entity_relation_graph.rebuild_degrees()
+        await self._flush_scheduler.mark_dirty(self.chunk_entity_relation_graph)
+
     async def _delete_by_entity_done(self):
-        tasks = []
-        for storage_inst in [
+        await self._flush_scheduler.mark_dirty(
             self.entities_vdb,
             self.relationships_vdb,
             self.chunk_entity_relation_graph,
-        ]:
-            if storage_inst is None:
-                continue
-            tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
-        await asyncio.gather(*tasks)
+            self.provenance_index,
+        )
+
+    def flush(self):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.aflush())
+
+    async def aflush(self):
+        """Write all pending storage updates now instead of waiting for the background flush"""
+        await self._flush_scheduler.flush()
+
+    def close(self):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.aclose())
+
+    async def aclose(self):
+        """Flush pending storage updates and release storage and embedding API
+        connections"""
+        await self.aflush()
+        await close_shared_clients()
+        if self._worker_pool is not None:
+            self._worker_pool.shutdown()
+            self._worker_pool = None
+        if isinstance(self.chunk_entity_relation_graph, Neo4JStorage):
+            await self.chunk_entity_relation_graph.close()
@@ -1,6 +1,15 @@
+import asyncio
 import os
 import copy
+import queue
+import re
+import tempfile
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from threading import Thread
 import json
 import aioboto3
 import aiohttp
@@ -24,12 +33,21 @@ from tenacity import (
     wait_exponential,
     retry_if_exception_type,
 )
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoModel,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 import torch
 from pydantic import BaseModel, Field
-from typing import List, Dict, Callable, Any
-from .base import BaseKVStorage
+from typing import List, Dict, Callable, Any, AsyncIterator, Iterator, Union
+from .base import BaseKVStorage, HedgingStats, LLMUsageStats
+from .prompt import PROMPTS
 from .utils import (
+    logger,
     compute_args_hash,
     wrap_embedding_func_with_attrs,
     locate_json_string_body_from_string,
@@ -38,6 +56,92 @@ from .utils import (
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
+async def _replay_cached_response(content: str) -> AsyncIterator[str]:
+    """Yield a cached answer word by word, so a cache hit streams like a fresh call"""
+    for match in re.finditer(r"\S+\s*|\s+", content):
+        yield match.group(0)
+
+
+async def _iterate_in_thread(iterator: Iterator[str]) -> AsyncIterator[str]:
+    """Consume a blocking iterator without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+async def _stream_with_cache(
+    pieces: AsyncIterator[str], hashing_kv: BaseKVStorage, args_hash: str, model
+) -> AsyncIterator[str]:
+    """Pass streamed text through and cache the assembled answer once the stream ends.
+
+    A stream abandoned by the consumer is not cached, since the answer is incomplete.
+    """
+    response = []
+    async for piece in pieces:
+        if not piece:
+            continue
+        response.append(piece)
+        yield piece
+    if hashing_kv is not None:
+        await hashing_kv.upsert(
+            {args_hash: {"return": "".join(response), "model": model}}
+        )
+
+
+def _chat_messages(
+    prompt: str, system_prompt: Union[str, None], history_messages: list[dict]
+) -> list[dict]:
+    """Chat messages from the most to the least shared between calls: the system
+    prompt (the static instructions of PROMPTS), the history, then the prompt, so
+    servers with a prefix cache reuse as much of it as possible"""
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.extend(history_messages)
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _record_usage(
+    llm_usage: Union[LLMUsageStats, None],
+    model: str,
+    prompt_tokens: Union[int, None],
+    completion_tokens: Union[int, None],
+    cached_prompt_tokens: Union[int, None] = None,
+):
+    """Account the token counts a provider reported for one call"""
+    if prompt_tokens is None:
+        return
+    logger.debug(
+        f"LLM call to {model}: {prompt_tokens} prompt tokens"
+        + (
+            f" ({cached_prompt_tokens} cached)"
+            if cached_prompt_tokens is not None
+            else ""
+        )
+        + f", {completion_tokens or 0} completion tokens"
+    )
+    if llm_usage is not None:
+        llm_usage.record(prompt_tokens, completion_tokens or 0, cached_prompt_tokens)
+
+
+def _record_openai_usage(llm_usage: Union[LLMUsageStats, None], model: str, usage):
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    _record_usage(
+        llm_usage,
+        model,
+        usage.prompt_tokens,
+        usage.completion_tokens,
+        getattr(details, "cached_tokens", None),
+    )
+
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
@@ -51,7 +155,7 @@ async def openai_complete_if_cache(
     base_url=None,
     api_key=None,
     **kwargs,
-) -> str:
+) -> Union[str, AsyncIterator[str]]:
     if api_key:
         os.environ["OPENAI_API_KEY"] = api_key
 
@@ -59,17 +163,36 @@ async def openai_complete_if_cache(
         AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
     )
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.extend(history_messages)
-    messages.append({"role": "user", "content": prompt})
+    llm_usage: LLMUsageStats = kwargs.pop("llm_usage", None)
+    kwargs.pop("hedge", None)
+    stream = kwargs.pop("stream", False)
+    messages = _chat_messages(prompt, system_prompt, history_messages)
+    args_hash = None
     if hashing_kv is not None:
         args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
         if if_cache_return is not None:
+            if stream:
+                return _replay_cached_response(if_cache_return["return"])
             return if_cache_return["return"]
 
+    if stream:
+        if llm_usage is not None:
+            # the usage comes in a last chunk without choices
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        response = await openai_async_client.chat.completions.create(
+            model=model, messages=messages, stream=True, **kwargs
+        )
+
+        async def _iter_content():
+            async for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    _record_openai_usage(llm_usage, model, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        return _stream_with_cache(_iter_content(), hashing_kv, args_hash, model)
+
     if "response_format" in kwargs:
         response = await openai_async_client.beta.chat.completions.parse(
             model=model, messages=messages, **kwargs
@@ -78,6 +201,7 @@ async def openai_complete_if_cache(
         response = await openai_async_client.chat.completions.create(
             model=model, messages=messages, **kwargs
         )
+    _record_openai_usage(llm_usage, model, getattr(response, "usage", None))
     content = response.choices[0].message.content
     if r"\u" in content:
         content = content.encode("utf-8").decode("unicode_escape")
@@ -118,6 +242,8 @@ async def azure_openai_complete_if_cache(
     )
 
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    llm_usage: LLMUsageStats = kwargs.pop("llm_usage", None)
+    kwargs.pop("hedge", None)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -133,6 +259,7 @@ async def azure_openai_complete_if_cache(
     response = await openai_async_client.chat.completions.create(
         model=model, messages=messages, **kwargs
     )
+    _record_openai_usage(llm_usage, model, getattr(response, "usage", None))
 
     if hashing_kv is not None:
         await hashing_kv.upsert(
@@ -203,6 +330,8 @@ async def bedrock_complete_if_cache(
             )
 
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    llm_usage: LLMUsageStats = kwargs.pop("llm_usage", None)
+    kwargs.pop("hedge", None)
     if hashing_kv is not None:
         args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
@@ -216,6 +345,14 @@ async def bedrock_complete_if_cache(
             response = await bedrock_async_client.converse(**args, **kwargs)
         except Exception as e:
             raise BedrockError(e)
+        usage = response.get("usage", {})
+        _record_usage(
+            llm_usage,
+            model,
+            usage.get("inputTokens"),
+            usage.get("outputTokens"),
+            usage.get("cacheReadInputTokens"),
+        )
 
         if hashing_kv is not None:
             await hashing_kv.upsert(
@@ -232,34 +369,237 @@ async def bedrock_complete_if_cache(
 
 @lru_cache(maxsize=1)
 def initialize_hf_model(model_name):
-    hf_tokenizer = AutoTokenizer.from_pretrained(
-        model_name, device_map="auto", trust_remote_code=True
-    )
-    hf_model = AutoModelForCausalLM.from_pretrained(
-        model_name, device_map="auto", trust_remote_code=True
-    )
+    hf_tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    if torch.cuda.is_available():
+        hf_model = AutoModelForCausalLM.from_pretrained(
+            model_name, device_map="auto", trust_remote_code=True
+        )
+    else:
+        hf_model = AutoModelForCausalLM.from_pretrained(
+            model_name, trust_remote_code=True
+        )
+    hf_model.eval()
     if hf_tokenizer.pad_token is None:
         hf_tokenizer.pad_token = hf_tokenizer.eos_token
 
     return hf_model, hf_tokenizer
 
 
+class _GenerationRequest:
+    __slots__ = ("prompt", "max_new_tokens", "loop", "future", "streamer")
+
+    def __init__(self, prompt, max_new_tokens, loop=None, future=None, streamer=None):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.loop = loop
+        self.future = future
+        self.streamer = streamer
+
+    def _resolve(self, result=None, error=None):
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+
+    @property
+    def abandoned(self) -> bool:
+        """The caller is gone: its call was cancelled or its event loop closed"""
+        if self.future is None:
+            return False
+        return self.future.done() or self.loop.is_closed()
+
+    def _post(self, *args):
+        try:
+            self.loop.call_soon_threadsafe(self._resolve, *args)
+        except RuntimeError:
+            # the loop closed since, e.g. after the caller timed out
+            pass
+
+    def set_result(self, result: str):
+        self._post(result)
+
+    def set_exception(self, error: Exception):
+        self._post(None, error)
+
+
+class _RowTokenLimit(StoppingCriteria):
+    """Stops each sequence of a batch at its own number of new tokens"""
+
+    def __init__(self, prompt_length: int, limits: torch.Tensor):
+        self.prompt_length = prompt_length
+        self.limits = limits
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        return (input_ids.shape[1] - self.prompt_length) >= self.limits
+
+
+class HFGenerationEngine:
+    """Serves a Hugging Face causal LM from a background thread, in dynamic batches.
+
+    Requests wait in a queue while a batch is generated; the next batch takes up
+    to max_batch_size of them, waiting max_wait seconds for more if fewer are
+    queued. Each request stops at its own max_new_tokens and the batch ends once
+    all of them are done. Streamed requests are generated alone.
+    """
+
+    def __init__(
+        self, model, tokenizer, max_batch_size: int = 8, max_wait: float = 0.01
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        # decoder-only models continue after the last token, so pad on the left
+        self.tokenizer.padding_side = "left"
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: queue.Queue = queue.Queue()
+        self._held: list[_GenerationRequest] = []
+        Thread(target=self._run, name="lightrag-hf-generation", daemon=True).start()
+
+    async def generate(self, prompt: str, max_new_tokens: int = 512) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put(_GenerationRequest(prompt, max_new_tokens, loop, future))
+        return await future
+
+    def stream(self, prompt: str, max_new_tokens: int = 512) -> Iterator[str]:
+        """A blocking iterator over the text as it is generated"""
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        self._queue.put(_GenerationRequest(prompt, max_new_tokens, streamer=streamer))
+        return iter(streamer)
+
+    def _next_request(self, timeout: Union[float, None] = None):
+        if self._held:
+            return self._held.pop(0)
+        if timeout is None:
+            return self._queue.get()
+        if timeout <= 0:
+            return self._queue.get_nowait()
+        return self._queue.get(timeout=timeout)
+
+    def _next_batch(self) -> list[_GenerationRequest]:
+        first = self._next_request()
+        if first.streamer is not None:
+            return [first]
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                request = self._next_request(deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if request.streamer is not None:
+                self._held.append(request)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            try:
+                batch = [r for r in self._next_batch() if not r.abandoned]
+                if not batch:
+                    continue
+                if batch[0].streamer is not None:
+                    self._stream(batch[0])
+                else:
+                    self._generate(batch)
+            except Exception as e:
+                # the thread serves every later call, it must outlive any request
+                logger.error(f"Hugging Face generation engine error: {e!r}")
+
+    def _inputs(self, prompts: list[str]):
+        return self.tokenizer(
+            prompts, return_tensors="pt", padding=True, truncation=True
+        ).to(self.model.device)
+
+    def _generate(self, batch: list[_GenerationRequest]):
+        try:
+            inputs = self._inputs([request.prompt for request in batch])
+            prompt_length = inputs["input_ids"].shape[1]
+            limits = [request.max_new_tokens for request in batch]
+            with torch.inference_mode():
+                output = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max(limits),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    stopping_criteria=StoppingCriteriaList(
+                        [
+                            _RowTokenLimit(
+                                prompt_length,
+                                torch.tensor(limits, device=self.model.device),
+                            )
+                        ]
+                    ),
+                )
+            for request, row, limit in zip(batch, output, limits):
+                request.set_result(
+                    self.tokenizer.decode(
+                        row[prompt_length : prompt_length + limit],
+                        skip_special_tokens=True,
+                    )
+                )
+        except Exception as e:
+            for request in batch:
+                request.set_exception(e)
+
+    def _stream(self, request: _GenerationRequest):
+        try:
+            with torch.inference_mode():
+                self.model.generate(
+                    **self._inputs([request.prompt]),
+                    max_new_tokens=request.max_new_tokens,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    streamer=request.streamer,
+                )
+        except Exception as e:
+            logger.error(f"Streamed generation failed: {e}")
+            request.streamer.end()
+
+
+@lru_cache(maxsize=1)
+def initialize_hf_engine(
+    model_name, max_batch_size: int = 8, max_wait: float = 0.01
+) -> HFGenerationEngine:
+    hf_model, hf_tokenizer = initialize_hf_model(model_name)
+    return HFGenerationEngine(
+        hf_model, hf_tokenizer, max_batch_size=max_batch_size, max_wait=max_wait
+    )
+
+
 async def hf_model_if_cache(
     model, prompt, system_prompt=None, history_messages=[], **kwargs
-) -> str:
+) -> Union[str, AsyncIterator[str]]:
+    """Generate with a local Hugging Face model.
+
+    Concurrent calls are batched by an HFGenerationEngine (max_batch_size and
+    max_wait kwargs, set by the first call); max_tokens bounds the new tokens of
+    each call.
+    """
     model_name = model
-    hf_model, hf_tokenizer = initialize_hf_model(model_name)
+    engine = initialize_hf_engine(
+        model_name,
+        max_batch_size=kwargs.pop("max_batch_size", 8),
+        max_wait=kwargs.pop("max_wait", 0.01),
+    )
+    hf_tokenizer = engine.tokenizer
+    max_new_tokens = kwargs.pop("max_tokens", 512)
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.extend(history_messages)
-    messages.append({"role": "user", "content": prompt})
+    kwargs.pop("llm_usage", None)
+    kwargs.pop("hedge", None)
+    stream = kwargs.pop("stream", False)
+    messages = _chat_messages(prompt, system_prompt, history_messages)
 
+    args_hash = None
     if hashing_kv is not None:
         args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
         if if_cache_return is not None:
+            if stream:
+                return _replay_cached_response(if_cache_return["return"])
             return if_cache_return["return"]
     input_prompt = ""
     try:
@@ -294,16 +634,14 @@ async def hf_model_if_cache(
                     + ">\n"
                 )
 
-    input_ids = hf_tokenizer(
-        input_prompt, return_tensors="pt", padding=True, truncation=True
-    ).to("cuda")
-    inputs = {k: v.to(hf_model.device) for k, v in input_ids.items()}
-    output = hf_model.generate(
-        **input_ids, max_new_tokens=512, num_return_sequences=1, early_stopping=True
-    )
-    response_text = hf_tokenizer.decode(
-        output[0][len(inputs["input_ids"][0]) :], skip_special_tokens=True
-    )
+    if stream:
+        return _stream_with_cache(
+            _iterate_in_thread(engine.stream(input_prompt, max_new_tokens)),
+            hashing_kv,
+            args_hash,
+            model,
+        )
+    response_text = await engine.generate(input_prompt, max_new_tokens)
     if hashing_kv is not None:
         await hashing_kv.upsert({args_hash: {"return": response_text, "model": model}})
     return response_text
@@ -311,27 +649,50 @@ async def hf_model_if_cache(
 
 async def ollama_model_if_cache(
     model, prompt, system_prompt=None, history_messages=[], **kwargs
-) -> str:
+) -> Union[str, AsyncIterator[str]]:
     kwargs.pop("max_tokens", None)
     # kwargs.pop("response_format", None) # allow json
     host = kwargs.pop("host", None)
     timeout = kwargs.pop("timeout", None)
 
     ollama_client = ollama.AsyncClient(host=host, timeout=timeout)
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
-    messages.extend(history_messages)
-    messages.append({"role": "user", "content": prompt})
+    llm_usage: LLMUsageStats = kwargs.pop("llm_usage", None)
+    kwargs.pop("hedge", None)
+    stream = kwargs.pop("stream", False)
+    messages = _chat_messages(prompt, system_prompt, history_messages)
+    args_hash = None
     if hashing_kv is not None:
         args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
         if if_cache_return is not None:
+            if stream:
+                return _replay_cached_response(if_cache_return["return"])
             return if_cache_return["return"]
 
+    if stream:
+        response = await ollama_client.chat(
+            model=model, messages=messages, stream=True, **kwargs
+        )
+
+        async def _iter_content():
+            async for part in response:
+                if part.get("done"):
+                    _record_usage(
+                        llm_usage,
+                        model,
+                        part.get("prompt_eval_count"),
+                        part.get("eval_count"),
+                    )
+                yield part["message"]["content"]
+
+        return _stream_with_cache(_iter_content(), hashing_kv, args_hash, model)
+
     response = await ollama_client.chat(model=model, messages=messages, **kwargs)
+    # ollama reuses the cached prefix of the previous prompt but doesn't report it
+    _record_usage(
+        llm_usage, model, response.get("prompt_eval_count"), response.get("eval_count")
+    )
 
     result = response["message"]["content"]
 
@@ -349,13 +710,18 @@ def initialize_lmdeploy_pipeline(
     log_level="WARNING",
     model_format="hf",
     quant_policy=0,
+    enable_prefix_caching=True,
 ):
     from lmdeploy import pipeline, ChatTemplateConfig, TurbomindEngineConfig
 
     lmdeploy_pipe = pipeline(
         model_path=model,
         backend_config=TurbomindEngineConfig(
-            tp=tp, model_format=model_format, quant_policy=quant_policy
+            tp=tp,
+            model_format=model_format,
+            quant_policy=quant_policy,
+            # reuse the KV cache of the static system prompts across requests
+            enable_prefix_caching=enable_prefix_caching,
         ),
         chat_template_config=(
             ChatTemplateConfig(model_name=chat_template) if chat_template else None
@@ -402,6 +768,8 @@ async def lmdeploy_model_if_cache(
             in the decoding. Default to be True.
         do_sample (bool): Whether or not to use sampling, use greedy decoding otherwise.
             Default to be False, which means greedy decoding will be applied.
+        enable_prefix_caching (bool): whether the engine reuses the KV cache of
+            prompt prefixes shared between requests. Default to be True.
     """
     try:
         import lmdeploy
@@ -415,6 +783,10 @@ async def lmdeploy_model_if_cache(
     skip_special_tokens = kwargs.pop("skip_special_tokens", True)
     do_preprocess = kwargs.pop("do_preprocess", True)
     do_sample = kwargs.pop("do_sample", False)
+    enable_prefix_caching = kwargs.pop("enable_prefix_caching", True)
+    hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    llm_usage: LLMUsageStats = kwargs.pop("llm_usage", None)
+    kwargs.pop("hedge", None)
     gen_params = kwargs
 
     version = version_info
@@ -433,16 +805,11 @@ async def lmdeploy_model_if_cache(
         chat_template=chat_template,
         model_format=model_format,
         quant_policy=quant_policy,
+        enable_prefix_caching=enable_prefix_caching,
         log_level="WARNING",
     )
 
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-
-    hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
-    messages.extend(history_messages)
-    messages.append({"role": "user", "content": prompt})
+    messages = _chat_messages(prompt, system_prompt, history_messages)
     if hashing_kv is not None:
         args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
@@ -456,6 +823,7 @@ async def lmdeploy_model_if_cache(
     )
 
     response = ""
+    res = None
     async for res in lmdeploy_pipe.generate(
         messages,
         gen_config=gen_config,
@@ -464,6 +832,8 @@ async def lmdeploy_model_if_cache(
         session_id=1,
     ):
         response += res.response
+    if res is not None:
+        _record_usage(llm_usage, model, res.input_token_len, res.generate_token_len)
 
     if hashing_kv is not None:
         await hashing_kv.upsert({args_hash: {"return": response, "model": model}})
@@ -564,6 +934,43 @@ async def ollama_model_complete(
     )
 
 
+# clients of the embedding APIs, by event loop since their connections are bound to it
+_shared_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _loop_shared_client(key, factory: Callable[[], Any]):
+    """The client for key shared by the calls made from the running event loop"""
+    clients = _shared_clients.setdefault(asyncio.get_running_loop(), {})
+    if key not in clients:
+        clients[key] = factory()
+    return clients[key]
+
+
+async def _bedrock_runtime_client():
+    clients = _shared_clients.setdefault(asyncio.get_running_loop(), {})
+    if "bedrock-runtime" not in clients:
+        client = await aioboto3.Session().client("bedrock-runtime").__aenter__()
+        if "bedrock-runtime" in clients:
+            # another call opened one meanwhile
+            await client.__aexit__(None, None, None)
+        else:
+            clients["bedrock-runtime"] = client
+    return clients["bedrock-runtime"]
+
+
+async def close_shared_clients():
+    """Close the embedding API clients opened from the running event loop"""
+    clients = _shared_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        try:
+            # the Bedrock client and ollama.AsyncClient are async context managers
+            await client.__aexit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Failed to close {type(client).__name__}: {e!r}")
+
+
 @wrap_embedding_func_with_attrs(embedding_dim=1536, max_token_size=8192)
 @retry(
     stop=stop_after_attempt(3),
@@ -670,88 +1077,182 @@ async def bedrock_embedding(
     aws_access_key_id=None,
     aws_secret_access_key=None,
     aws_session_token=None,
+    max_concurrency: int = 8,
 ) -> np.ndarray:
-    os.environ["AWS_ACCESS_KEY_ID"] = os.environ.get(
-        "AWS_ACCESS_KEY_ID", aws_access_key_id
-    )
-    os.environ["AWS_SECRET_ACCESS_KEY"] = os.environ.get(
-        "AWS_SECRET_ACCESS_KEY", aws_secret_access_key
-    )
-    os.environ["AWS_SESSION_TOKEN"] = os.environ.get(
-        "AWS_SESSION_TOKEN", aws_session_token
-    )
-
-    session = aioboto3.Session()
-    async with session.client("bedrock-runtime") as bedrock_async_client:
-        if (model_provider := model.split(".")[0]) == "amazon":
-            embed_texts = []
-            for text in texts:
-                if "v2" in model:
-                    body = json.dumps(
-                        {
-                            "inputText": text,
-                            # 'dimensions': embedding_dim,
-                            "embeddingTypes": ["float"],
-                        }
-                    )
-                elif "v1" in model:
-                    body = json.dumps({"inputText": text})
-                else:
-                    raise ValueError(f"Model {model} is not supported!")
-
-                response = await bedrock_async_client.invoke_model(
-                    modelId=model,
-                    body=body,
-                    accept="application/json",
-                    contentType="application/json",
-                )
-
-                response_body = await response.get("body").json()
+    """Titan embeds one text per request, up to max_concurrency at once; Cohere
+    embeds up to 96 texts per request. The client stays open for the next calls
+    from the same event loop until close_shared_clients() (LightRAG.aclose())."""
+    # credentials already in the environment take precedence
+    for name, value in (
+        ("AWS_ACCESS_KEY_ID", aws_access_key_id),
+        ("AWS_SECRET_ACCESS_KEY", aws_secret_access_key),
+        ("AWS_SESSION_TOKEN", aws_session_token),
+    ):
+        if value:
+            os.environ.setdefault(name, value)
 
-                embed_texts.append(response_body["embedding"])
-        elif model_provider == "cohere":
-            body = json.dumps(
-                {"texts": texts, "input_type": "search_document", "truncate": "NONE"}
-            )
+    bedrock_async_client = await _bedrock_runtime_client()
+    semaphore = asyncio.Semaphore(max_concurrency)
 
+    async def _invoke(body: dict) -> dict:
+        async with semaphore:
             response = await bedrock_async_client.invoke_model(
-                model=model,
-                body=body,
+                modelId=model,
+                body=json.dumps(body),
                 accept="application/json",
                 contentType="application/json",
             )
+            return json.loads(await response["body"].read())
+
+    if (model_provider := model.split(".")[0]) == "amazon":
+        if "v2" in model:
+            # 'dimensions': embedding_dim,
+            bodies = [
+                {"inputText": text, "embeddingTypes": ["float"]} for text in texts
+            ]
+        elif "v1" in model:
+            bodies = [{"inputText": text} for text in texts]
+        else:
+            raise ValueError(f"Model {model} is not supported!")
+        responses = await asyncio.gather(*[_invoke(body) for body in bodies])
+        embed_texts = [response["embedding"] for response in responses]
+    elif model_provider == "cohere":
+        responses = await asyncio.gather(
+            *[
+                _invoke(
+                    {
+                        "texts": texts[i : i + 96],
+                        "input_type": "search_document",
+                        "truncate": "NONE",
+                    }
+                )
+                for i in range(0, len(texts), 96)
+            ]
+        )
+        embed_texts = [row for response in responses for row in response["embeddings"]]
+    else:
+        raise ValueError(f"Model provider '{model_provider}' is not supported!")
 
-            response_body = json.loads(response.get("body").read())
+    return np.array(embed_texts)
 
-            embed_texts = response_body["embeddings"]
-        else:
-            raise ValueError(f"Model provider '{model_provider}' is not supported!")
 
-        return np.array(embed_texts)
+@lru_cache(maxsize=1)
+def _local_inference_executor() -> ThreadPoolExecutor:
+    # torch already spreads one forward pass over the CPU cores, a single thread
+    # keeps the event loop free without running batches against each other
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="lightrag-inference")
 
 
-async def hf_embedding(texts: list[str], tokenizer, embed_model) -> np.ndarray:
-    device = next(embed_model.parameters()).device
-    input_ids = tokenizer(
-        texts, return_tensors="pt", padding=True, truncation=True
-    ).input_ids.to(device)
-    with torch.no_grad():
-        outputs = embed_model(input_ids)
-        embeddings = outputs.last_hidden_state.mean(dim=1)
-    if embeddings.dtype == torch.bfloat16:
-        return embeddings.detach().to(torch.float32).cpu().numpy()
-    else:
-        return embeddings.detach().cpu().numpy()
+@lru_cache(maxsize=4)
+def load_hf_embedding_model(
+    model_name: str, backend: str = "torch", quantize: bool = False, device=None
+):
+    """(tokenizer, model) of a Hugging Face embedding model, for hf_embedding.
+
+    backend "torch" loads it on device (CUDA if available, else CPU); quantize
+    converts its linear layers to dynamic int8, on CPU. backend "onnx" exports it
+    to ONNX Runtime with optimum, quantize then applies dynamic int8 quantization
+    to the exported model.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        except ImportError:
+            raise ImportError(
+                "Please install optimum[onnxruntime] to run embedding models with ONNX Runtime."
+            )
+        embed_model = ORTModelForFeatureExtraction.from_pretrained(
+            model_name, export=True
+        )
+        if quantize:
+            quantized_dir = os.path.join(
+                tempfile.gettempdir(),
+                f"lightrag-onnx-{model_name.replace('/', '--')}-int8",
+            )
+            ORTQuantizer.from_pretrained(embed_model).quantize(
+                save_dir=quantized_dir,
+                quantization_config=AutoQuantizationConfig.avx2(
+                    is_static=False, per_channel=False
+                ),
+            )
+            embed_model = ORTModelForFeatureExtraction.from_pretrained(quantized_dir)
+        return tokenizer, embed_model
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    embed_model = AutoModel.from_pretrained(model_name).to(device).eval()
+    if quantize:
+        embed_model = torch.ao.quantization.quantize_dynamic(
+            embed_model.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return tokenizer, embed_model
+
+
+def _hf_embed(texts: list[str], tokenizer, embed_model, batch_size: int) -> np.ndarray:
+    if not texts:
+        return np.zeros((0, embed_model.config.hidden_size), dtype=np.float32)
+    # tokenized once without padding, then batched by length so each batch is
+    # only padded to its own longest text
+    encodings = tokenizer(texts, truncation=True)
+    order = sorted(range(len(texts)), key=lambda i: len(encodings["input_ids"][i]))
+    device = getattr(embed_model, "device", None) or torch.device("cpu")
+    embeddings = [None] * len(texts)
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            bucket = order[start : start + batch_size]
+            batch = tokenizer.pad(
+                {key: [encodings[key][i] for i in bucket] for key in encodings.keys()},
+                return_tensors="pt",
+            )
+            batch = {key: value.to(device) for key, value in batch.items()}
+            hidden = embed_model(**batch).last_hidden_state
+            # mean over the real tokens only
+            mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            for i, row in zip(bucket, pooled.to(torch.float32).cpu().numpy()):
+                embeddings[i] = row
+    return np.stack(embeddings)
+
+
+async def hf_embedding(
+    texts: list[str], tokenizer, embed_model, batch_size: int = 32
+) -> np.ndarray:
+    """float32 mean-pooled embeddings of a Hugging Face model (torch or ONNX Runtime,
+    see load_hf_embedding_model), computed in a worker thread"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _local_inference_executor(),
+        _hf_embed,
+        texts,
+        tokenizer,
+        embed_model,
+        batch_size,
+    )
 
 
-async def ollama_embedding(texts: list[str], embed_model, **kwargs) -> np.ndarray:
-    embed_text = []
-    ollama_client = ollama.Client(**kwargs)
-    for text in texts:
-        data = ollama_client.embeddings(model=embed_model, prompt=text)
-        embed_text.append(data["embedding"])
+async def ollama_embedding(
+    texts: list[str], embed_model, max_concurrency: int = 8, **kwargs
+) -> np.ndarray:
+    """Embeds the texts with one request to /api/embed; with an ollama library
+    predating it, with one request per text, up to max_concurrency at once.
+    kwargs are passed to ollama.AsyncClient (host, timeout, headers...)"""
+    ollama_client = _loop_shared_client(
+        ("ollama", json.dumps(kwargs, sort_keys=True, default=repr)),
+        lambda: ollama.AsyncClient(**kwargs),
+    )
+    if hasattr(ollama_client, "embed"):
+        response = await ollama_client.embed(model=embed_model, input=texts)
+        return np.array(response["embeddings"])
+
+    semaphore = asyncio.Semaphore(max_concurrency)
 
-    return embed_text
+    async def _embed(text: str) -> list[float]:
+        async with semaphore:
+            data = await ollama_client.embeddings(model=embed_model, prompt=text)
+            return data["embedding"]
+
+    return np.array(await asyncio.gather(*[_embed(text) for text in texts]))
 
 
 class Model(BaseModel):
@@ -763,6 +1264,10 @@ class Model(BaseModel):
             The function should take any argument and return a string.
         kwargs (Dict[str, Any]): A dictionary that contains the arguments to pass to the callable function.
             This could include parameters such as the model name, API key, etc.
+        cheap (bool): Whether MultiModel should send the cheap calls (keyword extraction, gleaning if-loop checks)
+            to this model, see MultiModel.
+        max_concurrency (int): At most this many calls to this model at once, no limit if None.
+        requests_per_minute (int): The request quota of this model (e.g. of its api key), no limit if None.
 
     Example usage:
         Model(gen_func=openai_complete_if_cache, kwargs={"model": "gpt-4", "api_key": os.environ["OPENAI_API_KEY_1"]})
@@ -779,16 +1284,82 @@ class Model(BaseModel):
         ...,
         description="The arguments to pass to the callable function. Eg. the api key, model name, etc",
     )
+    cheap: bool = Field(
+        False,
+        description="Send the cheap calls (keyword extraction, if-loop checks) to this model",
+    )
+    max_concurrency: Union[int, None] = Field(
+        None, description="The maximum number of calls to this model at once"
+    )
+    requests_per_minute: Union[int, None] = Field(
+        None, description="The request quota of this model per minute"
+    )
 
     class Config:
         arbitrary_types_allowed = True
 
 
+class _ModelHealth:
+    """What MultiModel knows about one of its models"""
+
+    __slots__ = (
+        "ewma_latency",
+        "in_flight",
+        "calls",
+        "failures",
+        "consecutive_failures",
+        "cooldown_until",
+        "request_times",
+    )
+
+    def __init__(self):
+        # seconds, None until the first successful call
+        self.ewma_latency: Union[float, None] = None
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # time.monotonic() before which the model isn't used after a failure
+        self.cooldown_until = 0.0
+        # start times of the calls of the last minute, for requests_per_minute
+        self.request_times: deque = deque()
+
+
+def _retry_after(exc: Exception) -> Union[float, None]:
+    """The Retry-After of a rate limit error of an HTTP client, in seconds"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
 class MultiModel:
     """
     Distributes the load across multiple language models. Useful for circumventing low rate limits with certain api providers especially if you are on the free tier.
     Could also be used for spliting across diffrent models or providers.
 
+    Each call goes to the available model with the lowest expected wait: its EWMA
+    latency times the calls it already has in flight, ties are broken round-robin.
+    Models that are at their max_concurrency or out of their requests_per_minute
+    quota are skipped, and calls wait when all of them are. Models without a
+    latency yet are assumed to have the average latency of the others. A model
+    that fails is not used for a cooldown growing with its consecutive failures
+    (or for the Retry-After of a rate limit error), then gets one call at a time
+    until one succeeds, and the call is retried on the next best model; the error
+    is only raised once every model failed.
+
+    Calls with keyword_extraction=True and the gleaning if-loop checks go to the
+    models marked cheap, the other calls to the models that aren't, when there
+    are both. If all models of a tier are failing, the calls use the other tier;
+    cheap calls also do when the cheap models are at their limits.
+
+    Calls made with hedge=True (the query calls with QueryParam(hedge=True)) are
+    duplicated when they haven't returned after the hedge_percentile of the
+    latencies of such calls, preferably on another model, and the first answer
+    wins, the other call is cancelled. At most hedge_budget duplicates per hedged
+    call are sent; hedge_stats counts them.
+
     Attributes:
         models (List[Model]): A list of language models to be used.
 
@@ -800,6 +1371,7 @@ class MultiModel:
             Model(gen_func=openai_complete_if_cache, kwargs={"model": "gpt-4", "api_key": os.environ["OPENAI_API_KEY_3"]}),
             Model(gen_func=openai_complete_if_cache, kwargs={"model": "gpt-4", "api_key": os.environ["OPENAI_API_KEY_4"]}),
             Model(gen_func=openai_complete_if_cache, kwargs={"model": "gpt-4", "api_key": os.environ["OPENAI_API_KEY_5"]}),
+            Model(gen_func=openai_complete_if_cache, kwargs={"model": "gpt-4o-mini", "api_key": os.environ["OPENAI_API_KEY_1"]}, cheap=True),
         ]
         multi_model = MultiModel(models)
         rag = LightRAG(
@@ -809,28 +1381,273 @@ class MultiModel:
         ```
     """
 
-    def __init__(self, models: List[Model]):
+    def __init__(
+        self,
+        models: List[Model],
+        latency_alpha: float = 0.2,
+        failure_cooldown: float = 1.0,
+        max_failure_cooldown: float = 60.0,
+        hedge_percentile: float = 95,
+        hedge_budget: float = 0.1,
+        hedge_min_samples: int = 20,
+    ):
         self._models = models
         self._current_model = 0
+        self._health = [_ModelHealth() for _ in models]
+        self._latency_alpha = latency_alpha
+        self._failure_cooldown = failure_cooldown
+        self._max_failure_cooldown = max_failure_cooldown
+        self._cheap_prompts = {PROMPTS["entiti_if_loop_extraction"]}
+        self._hedge_percentile = hedge_percentile
+        self._hedge_budget = hedge_budget
+        self._hedge_min_samples = hedge_min_samples
+        # latencies of the last hedged calls, cheap and other calls apart
+        self._hedge_latencies = {True: deque(maxlen=500), False: deque(maxlen=500)}
+        self.hedge_stats = HedgingStats()
+        # set (and replaced) when a call ends, for the calls waiting for a model
+        self._released: Union[asyncio.Event, None] = None
 
     def _next_model(self):
         self._current_model = (self._current_model + 1) % len(self._models)
         return self._models[self._current_model]
 
+    def _is_cheap_call(self, prompt, kwargs: dict) -> bool:
+        return bool(kwargs.get("keyword_extraction")) or prompt in self._cheap_prompts
+
+    def _wait_time(self, index: int, now: float) -> float:
+        """Seconds before the model can take a call, 0 if it can now"""
+        model, health = self._models[index], self._health[index]
+        wait = max(health.cooldown_until - now, 0.0)
+        if model.requests_per_minute is not None:
+            while health.request_times and health.request_times[0] <= now - 60:
+                health.request_times.popleft()
+            if len(health.request_times) >= model.requests_per_minute:
+                wait = max(wait, health.request_times[0] + 60 - now)
+        return wait
+
+    def _choose_from(
+        self, candidates: list[int], now: float
+    ) -> tuple[Union[int, None], float]:
+        known = [h.ewma_latency for h in self._health if h.ewma_latency is not None]
+        # models without a latency yet are assumed as fast as the others on average
+        default_latency = sum(known) / len(known) if known else 0.0
+        best, best_cost, min_wait = None, None, float("inf")
+        # start after the last model used, so equal models take turns
+        start = self._current_model + 1
+        for offset in range(len(self._models)):
+            i = (start + offset) % len(self._models)
+            if i not in candidates:
+                continue
+            model, health = self._models[i], self._health[i]
+            if (
+                model.max_concurrency is not None
+                and health.in_flight >= model.max_concurrency
+            ):
+                continue
+            if health.consecutive_failures and health.in_flight:
+                # after a cooldown, one probe call at a time until one succeeds
+                continue
+            wait = self._wait_time(i, now)
+            if wait > 0:
+                min_wait = min(min_wait, wait)
+                continue
+            latency = (
+                default_latency if health.ewma_latency is None else health.ewma_latency
+            )
+            cost = latency * (health.in_flight + 1)
+            if best_cost is None or cost < best_cost:
+                best, best_cost = i, cost
+        return best, min_wait
+
+    def _choose(self, cheap: bool, exclude: set[int]) -> tuple[Union[int, None], float]:
+        """The best model that can take a call now, else None and how long to wait"""
+        now = time.monotonic()
+        candidates = [i for i in range(len(self._models)) if i not in exclude]
+        tier = [i for i in candidates if self._models[i].cheap == cheap]
+        if not any(self._health[i].cooldown_until <= now for i in tier):
+            return self._choose_from(candidates, now)
+        best, wait = self._choose_from(tier, now)
+        if best is None and cheap:
+            # rather than waiting for the quota of the cheap models
+            return self._choose_from(candidates, now)
+        return best, wait
+
+    async def _acquire(self, cheap: bool, exclude: set[int]) -> Union[int, None]:
+        """Reserve the best model for a call, None if all of them are excluded"""
+        if len(exclude) >= len(self._models):
+            return None
+        while True:
+            index, wait = self._choose(cheap, exclude)
+            if index is not None:
+                break
+            if self._released is None:
+                self._released = asyncio.Event()
+            try:
+                await asyncio.wait_for(
+                    self._released.wait(), None if wait == float("inf") else wait
+                )
+            except asyncio.TimeoutError:
+                pass
+        self._reserve(index)
+        return index
+
+    def _reserve(self, index: int):
+        self._current_model = index
+        health = self._health[index]
+        health.in_flight += 1
+        if self._models[index].requests_per_minute is not None:
+            health.request_times.append(time.monotonic())
+
+    def _release(self, index: int, latency: float = None, error: Exception = None):
+        """End a call, latency is None if it was cancelled"""
+        health = self._health[index]
+        health.in_flight -= 1
+        if self._released is not None:
+            self._released.set()
+            self._released = None
+        if latency is None:
+            return
+        health.calls += 1
+        # a failed call counts with the time it wasted, so a model that fails
+        # slowly isn't preferred again once its cooldown is over
+        health.ewma_latency = (
+            latency
+            if health.ewma_latency is None
+            else self._latency_alpha * latency
+            + (1 - self._latency_alpha) * health.ewma_latency
+        )
+        if error is None:
+            health.consecutive_failures = 0
+        else:
+            health.failures += 1
+            health.consecutive_failures += 1
+            cooldown = _retry_after(error) or min(
+                self._failure_cooldown * 2 ** (health.consecutive_failures - 1),
+                self._max_failure_cooldown,
+            )
+            health.cooldown_until = time.monotonic() + cooldown
+
+    async def _call_model(self, index: int, args: dict):
+        model = self._models[index]
+        start = time.monotonic()
+        try:
+            result = await model.gen_func(**args, **model.kwargs)
+        except asyncio.CancelledError:
+            # not the model's fault, e.g. a hedged call that lost
+            self._release(index)
+            raise
+        except Exception as e:
+            self._release(index, time.monotonic() - start, e)
+            raise
+        self._release(index, time.monotonic() - start)
+        return result
+
+    def _hedge_deadline(self, cheap: bool) -> Union[float, None]:
+        """Seconds after which a hedged call is duplicated, None until enough samples"""
+        latencies = self._hedge_latencies[cheap]
+        if len(latencies) < self._hedge_min_samples:
+            return None
+        return float(np.percentile(latencies, self._hedge_percentile))
+
+    def _take_hedge(self, cheap: bool, first: int) -> Union[int, None]:
+        """Reserve a model for the duplicate of a call, None if not allowed now"""
+        if self.hedge_stats.hedges_fired >= self._hedge_budget * self.hedge_stats.calls:
+            return None
+        index, _ = self._choose(cheap, {first})
+        if index is None:
+            # the same model, e.g. another connection to a provider with one key
+            index, _ = self._choose(cheap, set())
+        if index is not None:
+            self._reserve(index)
+        return index
+
+    async def _hedged_call(self, args: dict, cheap: bool, tried: set[int]):
+        self.hedge_stats.calls += 1
+        deadline = self._hedge_deadline(cheap)
+        first = await self._acquire(cheap, tried)
+        tried.add(first)
+        start = time.monotonic()
+        primary = asyncio.create_task(self._call_model(first, args))
+        pending = {primary}
+        hedge = None
+        try:
+            if deadline is not None:
+                done, _ = await asyncio.wait(pending, timeout=deadline)
+                if not done:
+                    second = self._take_hedge(cheap, first)
+                    if second is None:
+                        self.hedge_stats.hedges_skipped += 1
+                    else:
+                        self.hedge_stats.hedges_fired += 1
+                        tried.add(second)
+                        hedge = asyncio.create_task(self._call_model(second, args))
+                        pending.add(hedge)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    # the primary's latency, a lower bound of it if the hedge won
+                    self._hedge_latencies[cheap].append(time.monotonic() - start)
+                    if task is hedge:
+                        self.hedge_stats.hedges_won += 1
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @property
+    def stats(self) -> list[dict]:
+        """The health of each model, in the order of the models"""
+        return [
+            dict(
+                model=model.kwargs.get("model"),
+                cheap=model.cheap,
+                ewma_latency=health.ewma_latency,
+                in_flight=health.in_flight,
+                calls=health.calls,
+                failures=health.failures,
+                cooling_down=health.cooldown_until > time.monotonic(),
+            )
+            for model, health in zip(self._models, self._health)
+        ]
+
     async def llm_model_func(
         self, prompt, system_prompt=None, history_messages=[], **kwargs
     ) -> str:
         kwargs.pop("model", None)  # stop from overwriting the custom model name
-        next_model = self._next_model()
+        hedge = kwargs.pop("hedge", False)
         args = dict(
             prompt=prompt,
             system_prompt=system_prompt,
             history_messages=history_messages,
             **kwargs,
-            **next_model.kwargs,
         )
-
-        return await next_model.gen_func(**args)
+        cheap = self._is_cheap_call(prompt, kwargs)
+        tried = set()
+        if hedge:
+            try:
+                return await self._hedged_call(args, cheap, tried)
+            except Exception as e:
+                if len(tried) >= len(self._models):
+                    raise
+                logger.warning(f"Hedged call failed ({e!r}), retrying on another model")
+        while True:
+            index = await self._acquire(cheap, tried)
+            tried.add(index)
+            try:
+                return await self._call_model(index, args)
+            except Exception as e:
+                if len(tried) >= len(self._models):
+                    raise
+                logger.warning(
+                    f"{self._models[index].kwargs.get('model')} failed ({e!r}), retrying on another model"
+                )
 
 
 if __name__ == "__main__":
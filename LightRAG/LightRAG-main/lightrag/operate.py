@@ -1,31 +1,41 @@
 import asyncio
+import dataclasses
 import json
-import re
 from tqdm.asyncio import tqdm as tqdm_async
-from typing import Union
+from typing import AsyncIterator, Callable, Union
 from collections import Counter, defaultdict
 import warnings
+import zlib
 from .utils import (
     logger,
-    clean_str,
     compute_mdhash_id,
+    count_tokens_by_tiktoken,
     decode_tokens_by_tiktoken,
     encode_string_by_tiktoken,
-    is_float_regex,
+    KeyedLock,
     list_of_list_to_csv,
+    pack_list_by_token_size,
     pack_user_ass_to_openai_messages,
     split_string_by_multi_markers,
     truncate_list_by_token_size,
-    process_combine_contexts,
 )
 from .base import (
     BaseGraphStorage,
     BaseKVStorage,
     BaseVectorStorage,
+    ContextChunk,
+    ContextEntity,
+    ContextRelation,
+    GleaningStats,
+    QueryContext,
+    GraphEdgeRecord,
+    GraphNodeRecord,
     TextChunkSchema,
     QueryParam,
 )
 from .prompt import GRAPH_FIELD_SEP, PROMPTS
+from .record_parser import parse_extraction_records, parse_packed_extraction_records
+from .storage import ProvenanceIndex
 
 
 def chunking_by_token_size(
@@ -74,57 +84,54 @@ async def _handle_entity_relation_summary(
         description_list=use_description.split(GRAPH_FIELD_SEP),
         language=language,
     )
-    use_prompt = prompt_template.format(**context_base)
+    use_prompt = PROMPTS["summarize_entity_descriptions_input"].format(**context_base)
     logger.debug(f"Trigger summary: {entity_or_relation_name}")
-    summary = await use_llm_func(use_prompt, max_tokens=summary_max_tokens)
+    summary = await use_llm_func(
+        use_prompt,
+        system_prompt=prompt_template.format(**context_base),
+        max_tokens=summary_max_tokens,
+    )
     return summary
 
 
-async def _handle_single_entity_extraction(
-    record_attributes: list[str],
-    chunk_key: str,
-):
-    if len(record_attributes) < 4 or record_attributes[0] != '"entity"':
-        return None
-    # add this record as a node in the G
-    entity_name = clean_str(record_attributes[1].upper())
-    if not entity_name.strip():
-        return None
-    entity_type = clean_str(record_attributes[2].upper())
-    entity_description = clean_str(record_attributes[3])
-    entity_source_id = chunk_key
-    return dict(
-        entity_name=entity_name,
-        entity_type=entity_type,
-        description=entity_description,
-        source_id=entity_source_id,
-    )
+def _entity_source_ids(
+    entity_name: str,
+    node_data: Union[dict, GraphNodeRecord],
+    provenance_index: ProvenanceIndex = None,
+) -> list[str]:
+    """Source chunks of an entity, from the provenance index when it knows the entity,
+    else from the source ids stored on the node (e.g. nodes stored before the index)"""
+    if provenance_index is not None:
+        chunk_ids = provenance_index.entity_chunk_ids(entity_name)
+        if chunk_ids is not None:
+            return chunk_ids
+    if isinstance(node_data, GraphNodeRecord):
+        return list(node_data.source_ids)
+    return split_string_by_multi_markers(node_data["source_id"], [GRAPH_FIELD_SEP])
+
+
+def _relation_source_ids(
+    src_id: str,
+    tgt_id: str,
+    edge_data: Union[dict, GraphEdgeRecord],
+    provenance_index: ProvenanceIndex = None,
+) -> list[str]:
+    if provenance_index is not None:
+        chunk_ids = provenance_index.relation_chunk_ids(src_id, tgt_id)
+        if chunk_ids is not None:
+            return chunk_ids
+    if isinstance(edge_data, GraphEdgeRecord):
+        return list(edge_data.source_ids)
+    return split_string_by_multi_markers(edge_data["source_id"], [GRAPH_FIELD_SEP])
 
 
-async def _handle_single_relationship_extraction(
-    record_attributes: list[str],
-    chunk_key: str,
-):
-    if len(record_attributes) < 5 or record_attributes[0] != '"relationship"':
-        return None
-    # add this record as edge
-    source = clean_str(record_attributes[1].upper())
-    target = clean_str(record_attributes[2].upper())
-    edge_description = clean_str(record_attributes[3])
-
-    edge_keywords = clean_str(record_attributes[4])
-    edge_source_id = chunk_key
-    weight = (
-        float(record_attributes[-1]) if is_float_regex(record_attributes[-1]) else 1.0
-    )
-    return dict(
-        src_id=source,
-        tgt_id=target,
-        weight=weight,
-        description=edge_description,
-        keywords=edge_keywords,
-        source_id=edge_source_id,
-    )
+def entity_lock_key(entity_name: str) -> tuple:
+    return ("entity", entity_name)
+
+
+def relation_lock_key(src_id: str, tgt_id: str) -> tuple:
+    # edges are undirected, (a, b) and (b, a) are the same record
+    return ("relation", *sorted((src_id, tgt_id)))
 
 
 async def _merge_nodes_then_upsert(
@@ -132,46 +139,54 @@ async def _merge_nodes_then_upsert(
     nodes_data: list[dict],
     knowledge_graph_inst: BaseGraphStorage,
     global_config: dict,
+    provenance_index: ProvenanceIndex = None,
+    graph_locks: KeyedLock = None,
 ):
-    already_entitiy_types = []
-    already_source_ids = []
-    already_description = []
-
-    already_node = await knowledge_graph_inst.get_node(entity_name)
-    if already_node is not None:
-        already_entitiy_types.append(already_node["entity_type"])
-        already_source_ids.extend(
-            split_string_by_multi_markers(already_node["source_id"], [GRAPH_FIELD_SEP])
+    if graph_locks is None:
+        graph_locks = KeyedLock()
+    async with graph_locks.lock(entity_lock_key(entity_name)):
+        already_entitiy_types = []
+        already_source_ids = []
+        already_description = []
+
+        already_node = await knowledge_graph_inst.get_node_record(entity_name)
+        if already_node is not None:
+            already_entitiy_types.append(already_node.entity_type)
+            already_source_ids.extend(
+                _entity_source_ids(entity_name, already_node, provenance_index)
+            )
+            already_description.extend(already_node.descriptions)
+
+        entity_type = sorted(
+            Counter(
+                [dp["entity_type"] for dp in nodes_data] + already_entitiy_types
+            ).items(),
+            key=lambda x: x[1],
+            reverse=True,
+        )[0][0]
+        descriptions = sorted(
+            set([dp["description"] for dp in nodes_data] + already_description)
+        )
+        source_ids = sorted(
+            set([dp["source_id"] for dp in nodes_data] + already_source_ids)
+        )
+        description = GRAPH_FIELD_SEP.join(descriptions)
+        summary = await _handle_entity_relation_summary(
+            entity_name, description, global_config
+        )
+        if summary != description:
+            description, descriptions = summary, [summary]
+        await knowledge_graph_inst.upsert_node_record(
+            entity_name, GraphNodeRecord(entity_type, descriptions, source_ids)
+        )
+        if provenance_index is not None:
+            provenance_index.set_entity_chunk_ids(entity_name, source_ids)
+        return dict(
+            entity_type=entity_type,
+            description=description,
+            source_id=GRAPH_FIELD_SEP.join(source_ids),
+            entity_name=entity_name,
         )
-        already_description.append(already_node["description"])
-
-    entity_type = sorted(
-        Counter(
-            [dp["entity_type"] for dp in nodes_data] + already_entitiy_types
-        ).items(),
-        key=lambda x: x[1],
-        reverse=True,
-    )[0][0]
-    description = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["description"] for dp in nodes_data] + already_description))
-    )
-    source_id = GRAPH_FIELD_SEP.join(
-        set([dp["source_id"] for dp in nodes_data] + already_source_ids)
-    )
-    description = await _handle_entity_relation_summary(
-        entity_name, description, global_config
-    )
-    node_data = dict(
-        entity_type=entity_type,
-        description=description,
-        source_id=source_id,
-    )
-    await knowledge_graph_inst.upsert_node(
-        entity_name,
-        node_data=node_data,
-    )
-    node_data["entity_name"] = entity_name
-    return node_data
 
 
 async def _merge_edges_then_upsert(
@@ -180,65 +195,68 @@ async def _merge_edges_then_upsert(
     edges_data: list[dict],
     knowledge_graph_inst: BaseGraphStorage,
     global_config: dict,
+    provenance_index: ProvenanceIndex = None,
+    graph_locks: KeyedLock = None,
 ):
-    already_weights = []
-    already_source_ids = []
-    already_description = []
-    already_keywords = []
-
-    if await knowledge_graph_inst.has_edge(src_id, tgt_id):
-        already_edge = await knowledge_graph_inst.get_edge(src_id, tgt_id)
-        already_weights.append(already_edge["weight"])
-        already_source_ids.extend(
-            split_string_by_multi_markers(already_edge["source_id"], [GRAPH_FIELD_SEP])
+    if graph_locks is None:
+        graph_locks = KeyedLock()
+    async with graph_locks.lock(relation_lock_key(src_id, tgt_id)):
+        already_weights = []
+        already_source_ids = []
+        already_description = []
+        already_keywords = []
+
+        already_edge = await knowledge_graph_inst.get_edge_record(src_id, tgt_id)
+        if already_edge is not None:
+            already_weights.append(already_edge.weight)
+            already_source_ids.extend(
+                _relation_source_ids(src_id, tgt_id, already_edge, provenance_index)
+            )
+            already_description.extend(already_edge.descriptions)
+            already_keywords.extend(already_edge.keywords)
+
+        weight = sum([dp["weight"] for dp in edges_data] + already_weights)
+        descriptions = sorted(
+            set([dp["description"] for dp in edges_data] + already_description)
+        )
+        keywords = sorted(set([dp["keywords"] for dp in edges_data] + already_keywords))
+        source_ids = sorted(
+            set([dp["source_id"] for dp in edges_data] + already_source_ids)
+        )
+        # a missing endpoint is created here, which races with merges of that entity
+        async with graph_locks.lock(entity_lock_key(src_id), entity_lock_key(tgt_id)):
+            for need_insert_id in [src_id, tgt_id]:
+                if not (await knowledge_graph_inst.has_node(need_insert_id)):
+                    await knowledge_graph_inst.upsert_node_record(
+                        need_insert_id,
+                        GraphNodeRecord(
+                            '"UNKNOWN"', list(descriptions), list(source_ids)
+                        ),
+                    )
+                    if provenance_index is not None:
+                        provenance_index.set_entity_chunk_ids(
+                            need_insert_id, source_ids
+                        )
+        description = GRAPH_FIELD_SEP.join(descriptions)
+        summary = await _handle_entity_relation_summary(
+            (src_id, tgt_id), description, global_config
         )
-        already_description.append(already_edge["description"])
-        already_keywords.extend(
-            split_string_by_multi_markers(already_edge["keywords"], [GRAPH_FIELD_SEP])
+        if summary != description:
+            description, descriptions = summary, [summary]
+        await knowledge_graph_inst.upsert_edge_record(
+            src_id, tgt_id, GraphEdgeRecord(weight, descriptions, keywords, source_ids)
         )
+        if provenance_index is not None:
+            provenance_index.set_relation_chunk_ids(src_id, tgt_id, source_ids)
 
-    weight = sum([dp["weight"] for dp in edges_data] + already_weights)
-    description = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["description"] for dp in edges_data] + already_description))
-    )
-    keywords = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["keywords"] for dp in edges_data] + already_keywords))
-    )
-    source_id = GRAPH_FIELD_SEP.join(
-        set([dp["source_id"] for dp in edges_data] + already_source_ids)
-    )
-    for need_insert_id in [src_id, tgt_id]:
-        if not (await knowledge_graph_inst.has_node(need_insert_id)):
-            await knowledge_graph_inst.upsert_node(
-                need_insert_id,
-                node_data={
-                    "source_id": source_id,
-                    "description": description,
-                    "entity_type": '"UNKNOWN"',
-                },
-            )
-    description = await _handle_entity_relation_summary(
-        (src_id, tgt_id), description, global_config
-    )
-    await knowledge_graph_inst.upsert_edge(
-        src_id,
-        tgt_id,
-        edge_data=dict(
-            weight=weight,
+        edge_data = dict(
+            src_id=src_id,
+            tgt_id=tgt_id,
             description=description,
-            keywords=keywords,
-            source_id=source_id,
-        ),
-    )
-
-    edge_data = dict(
-        src_id=src_id,
-        tgt_id=tgt_id,
-        description=description,
-        keywords=keywords,
-    )
+            keywords=GRAPH_FIELD_SEP.join(keywords),
+        )
 
-    return edge_data
+        return edge_data
 
 
 async def extract_entities(
@@ -247,9 +265,159 @@ async def extract_entities(
     entity_vdb: BaseVectorStorage,
     relationships_vdb: BaseVectorStorage,
     global_config: dict,
+    chunk_extractions: BaseKVStorage = None,
+    provenance_index: ProvenanceIndex = None,
+    graph_locks: KeyedLock = None,
+    worker_pool=None,
+    gleaning_stats: GleaningStats = None,
 ) -> Union[BaseGraphStorage, None]:
+    maybe_nodes, maybe_edges = await extract_graph_elements(
+        chunks, global_config, worker_pool=worker_pool, gleaning_stats=gleaning_stats
+    )
+    all_entities_data, all_relationships_data = await merge_graph_elements(
+        maybe_nodes,
+        maybe_edges,
+        knowledge_graph_inst,
+        entity_vdb,
+        relationships_vdb,
+        global_config,
+        provenance_index=provenance_index,
+        graph_locks=graph_locks,
+    )
+    if not len(all_entities_data):
+        logger.warning("Didn't extract any entities, maybe your LLM is not working")
+        return None
+    if not len(all_relationships_data):
+        logger.warning(
+            "Didn't extract any relationships, maybe your LLM is not working"
+        )
+        return None
+    if chunk_extractions is not None:
+        await chunk_extractions.upsert(
+            group_graph_elements_by_chunk(chunks.keys(), maybe_nodes, maybe_edges)
+        )
+    return knowledge_graph_inst
+
+
+async def extract_graph_elements(
+    chunks: dict[str, TextChunkSchema],
+    global_config: dict,
+    show_progress: bool = True,
+    on_chunk_done: Callable[[str], None] = None,
+    worker_pool=None,
+    gleaning_stats: GleaningStats = None,
+) -> tuple[dict[str, list[dict]], dict[tuple[str, str], list[dict]]]:
+    """Ask the LLM for the entities and relationships of each chunk.
+
+    Returns the extracted nodes grouped by entity name and edges grouped by their
+    (sorted) endpoints, without touching any storage. Both list the extractions in
+    chunk order, however the chunks were scheduled. With an ExtractionWorkerPool
+    the chunks are extracted in its worker processes. The gleaning rounds are
+    accounted in gleaning_stats.
+    """
+    if worker_pool is not None:
+        chunk_results = await worker_pool.extract(
+            list(chunks.items()),
+            on_chunk_done=on_chunk_done,
+            gleaning_stats=gleaning_stats,
+        )
+    else:
+        chunk_results = await extract_chunk_graph_elements(
+            chunks, global_config, show_progress, on_chunk_done, gleaning_stats
+        )
+    maybe_nodes = defaultdict(list)
+    maybe_edges = defaultdict(list)
+    for _, m_nodes, m_edges in chunk_results:
+        for k, v in m_nodes.items():
+            maybe_nodes[k].extend(v)
+        for k, v in m_edges.items():
+            maybe_edges[tuple(sorted(k))].extend(v)
+    return dict(maybe_nodes), dict(maybe_edges)
+
+
+@dataclasses.dataclass
+class AdaptiveGleaningPolicy:
+    """Decides per chunk whether another gleaning round is worth its LLM calls.
+
+    A chunk is not gleaned when it is short or its first pass found few entities
+    and relations for its size. After a round, gleaning ends if it found few new
+    elements, and goes on without asking the LLM if it found many; in between the
+    LLM is asked as with the fixed policy.
+    """
+
+    min_chunk_tokens: int = 200
+    min_elements_per_100_tokens: float = 0.5
+    # new elements of a round, relative to all found so far
+    stop_below_new_ratio: float = 0.1
+    continue_above_new_ratio: float = 0.5
+    # share of skipped rounds run anyway to estimate the recall lost by skipping
+    audit_rate: float = 0.0
+
+    def should_glean(self, chunk_tokens: int, known_elements: int) -> bool:
+        if chunk_tokens < self.min_chunk_tokens:
+            return False
+        return known_elements * 100 >= self.min_elements_per_100_tokens * chunk_tokens
+
+    def next_round(self, new_elements: int, known_elements: int) -> Union[bool, None]:
+        """True/False to go on or stop without asking the LLM, None to ask it"""
+        new_ratio = new_elements / max(known_elements, 1)
+        if new_ratio < self.stop_below_new_ratio:
+            return False
+        if new_ratio >= self.continue_above_new_ratio:
+            return True
+        return None
+
+    def audits(self, chunk_key: str, glean_index: int) -> bool:
+        # deterministic, so reruns and worker processes audit the same rounds
+        sample = zlib.crc32(f"{chunk_key}:{glean_index}".encode()) % 10000
+        return sample < self.audit_rate * 10000
+
+
+def pack_extraction_chunks(
+    ordered_chunks: list[tuple[str, TextChunkSchema]],
+    max_chunks: int,
+    max_tokens: int,
+) -> list[list[tuple[str, TextChunkSchema]]]:
+    """Groups of consecutive chunks extracted by one LLM request.
+
+    A group has at most max_chunks chunks of max_tokens tokens in total; a chunk
+    larger than max_tokens is a group of its own.
+    """
+    packs = []
+    pack, pack_tokens = [], 0
+    for chunk_key, chunk_dp in ordered_chunks:
+        tokens = chunk_dp.get("tokens") or count_tokens_by_tiktoken(chunk_dp["content"])
+        if pack and (len(pack) >= max_chunks or pack_tokens + tokens > max_tokens):
+            packs.append(pack)
+            pack, pack_tokens = [], 0
+        pack.append((chunk_key, chunk_dp))
+        pack_tokens += tokens
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+async def extract_chunk_graph_elements(
+    chunks: dict[str, TextChunkSchema],
+    global_config: dict,
+    show_progress: bool = True,
+    on_chunk_done: Callable[[str], None] = None,
+    gleaning_stats: GleaningStats = None,
+) -> list[tuple[str, dict[str, list[dict]], dict[tuple[str, str], list[dict]]]]:
+    """The (chunk_key, nodes, edges) extracted from each chunk, in chunk order.
+
+    With entity_extract_pack_chunks > 1, consecutive small chunks are extracted
+    together by one request of the packed prompt, so its instructions and examples
+    are sent once for all of them. Only the chunks of one call are packed together.
+    """
     use_llm_func: callable = global_config["llm_model_func"]
     entity_extract_max_gleaning = global_config["entity_extract_max_gleaning"]
+    gleaning_policy = None
+    if global_config.get("entity_extract_gleaning", "fixed") == "adaptive":
+        gleaning_policy = AdaptiveGleaningPolicy(
+            **global_config.get("entity_extract_gleaning_params", {})
+        )
+    stats = GleaningStats()
 
     ordered_chunks = list(chunks.items())
     # add language and example number params to prompt
@@ -264,7 +432,8 @@ async def extract_entities(
     else:
         examples = "\n".join(PROMPTS["entity_extraction_examples"])
 
-    entity_extract_prompt = PROMPTS["entity_extraction"]
+    entity_extract_prompt = PROMPTS["entity_extraction_input"]
+    packed_prompt = PROMPTS["entity_extraction_packed_input"]
     context_base = dict(
         tuple_delimiter=PROMPTS["DEFAULT_TUPLE_DELIMITER"],
         record_delimiter=PROMPTS["DEFAULT_RECORD_DELIMITER"],
@@ -273,107 +442,242 @@ async def extract_entities(
         examples=examples,
         language=language,
     )
+    # the instructions and examples are the same for every chunk
+    system_prompt = PROMPTS["entity_extraction"].format(**context_base)
+    packed_system_prompt = PROMPTS["entity_extraction_packed"].format(**context_base)
+    delimiters = dict(
+        tuple_delimiter=context_base["tuple_delimiter"],
+        record_delimiter=context_base["record_delimiter"],
+        completion_delimiter=context_base["completion_delimiter"],
+    )
 
     continue_prompt = PROMPTS["entiti_continue_extraction"]
+    packed_continue_prompt = PROMPTS["entiti_continue_extraction_packed"].format(
+        tuple_delimiter=context_base["tuple_delimiter"]
+    )
     if_loop_prompt = PROMPTS["entiti_if_loop_extraction"]
 
+    max_pack_chunks = global_config.get("entity_extract_pack_chunks", 1)
+    if max_pack_chunks > 1:
+        # the packed texts get half of the context window the instructions leave,
+        # the other half is for the records of the answer
+        prompt_tokens = count_tokens_by_tiktoken(
+            packed_system_prompt
+        ) + count_tokens_by_tiktoken(
+            packed_prompt.format(**context_base, input_text="")
+        )
+        max_pack_tokens = (
+            global_config["llm_model_max_token_size"] - prompt_tokens
+        ) // 2
+        packs = pack_extraction_chunks(ordered_chunks, max_pack_chunks, max_pack_tokens)
+        logger.info(
+            f"Packed {len(ordered_chunks)} chunks into {len(packs)} extraction requests"
+        )
+    else:
+        packs = [[chunk] for chunk in ordered_chunks]
+
     already_processed = 0
     already_entities = 0
     already_relations = 0
 
-    async def _process_single_content(chunk_key_dp: tuple[str, TextChunkSchema]):
-        nonlocal already_processed, already_entities, already_relations
-        chunk_key = chunk_key_dp[0]
-        chunk_dp = chunk_key_dp[1]
-        content = chunk_dp["content"]
-        hint_prompt = entity_extract_prompt.format(**context_base, input_text=content)
-        final_result = await use_llm_func(hint_prompt)
+    def _element_keys(result: str) -> set:
+        nodes, edges = parse_extraction_records(result, "", **delimiters)
+        return set(nodes) | set(edges)
+
+    async def _extract_with_gleaning(
+        hint_prompt: str,
+        glean_prompt: str,
+        extract_system_prompt: str,
+        audit_key: str,
+        content_tokens: int,
+    ) -> str:
+        final_result = await use_llm_func(
+            hint_prompt, system_prompt=extract_system_prompt
+        )
         history = pack_user_ass_to_openai_messages(hint_prompt, final_result)
+        if gleaning_policy is not None:
+            known = _element_keys(final_result)
+        audit = False
         for now_glean_index in range(entity_extract_max_gleaning):
-            glean_result = await use_llm_func(continue_prompt, history_messages=history)
+            if (
+                gleaning_policy is not None
+                and now_glean_index == 0
+                and not gleaning_policy.should_glean(content_tokens, len(known))
+            ):
+                stats.skipped_rounds += 1
+                audit = gleaning_policy.audits(audit_key, now_glean_index)
+                # the fixed policy gleans, then asks whether to go on
+                stats.calls_saved += (not audit) + (entity_extract_max_gleaning > 1)
+                if not audit:
+                    break
+            glean_result = await use_llm_func(
+                glean_prompt,
+                system_prompt=extract_system_prompt,
+                history_messages=history,
+            )
+            stats.glean_calls += 1
 
-            history += pack_user_ass_to_openai_messages(continue_prompt, glean_result)
+            history += pack_user_ass_to_openai_messages(glean_prompt, glean_result)
             final_result += glean_result
+            if gleaning_policy is not None:
+                new_keys = _element_keys(glean_result) - known
+                known |= new_keys
+                if audit:
+                    stats.audited_skips += 1
+                    stats.audited_new_elements += len(new_keys)
+                    break
             if now_glean_index == entity_extract_max_gleaning - 1:
                 break
 
+            if gleaning_policy is not None:
+                go_on = gleaning_policy.next_round(len(new_keys), len(known))
+                if go_on is not None:
+                    # the answer to the if-loop question is predictable
+                    stats.calls_saved += 1
+                    if go_on:
+                        continue
+                    stats.skipped_rounds += 1
+                    audit = gleaning_policy.audits(audit_key, now_glean_index + 1)
+                    if audit:
+                        continue
+                    break
+
             if_loop_result: str = await use_llm_func(
-                if_loop_prompt, history_messages=history
+                if_loop_prompt,
+                system_prompt=extract_system_prompt,
+                history_messages=history,
             )
+            stats.if_loop_calls += 1
             if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
             if if_loop_result != "yes":
                 break
+        return final_result
 
-        records = split_string_by_multi_markers(
-            final_result,
-            [context_base["record_delimiter"], context_base["completion_delimiter"]],
+    async def _process_pack(pack: list[tuple[str, TextChunkSchema]]):
+        nonlocal already_processed, already_entities, already_relations
+        chunk_keys = [chunk_key for chunk_key, _ in pack]
+        content_tokens = sum(
+            chunk_dp.get("tokens") or count_tokens_by_tiktoken(chunk_dp["content"])
+            for _, chunk_dp in pack
         )
-
-        maybe_nodes = defaultdict(list)
-        maybe_edges = defaultdict(list)
-        for record in records:
-            record = re.search(r"\((.*)\)", record)
-            if record is None:
-                continue
-            record = record.group(1)
-            record_attributes = split_string_by_multi_markers(
-                record, [context_base["tuple_delimiter"]]
+        if len(pack) == 1:
+            hint_prompt = entity_extract_prompt.format(
+                **context_base, input_text=pack[0][1]["content"]
+            )
+            final_result = await _extract_with_gleaning(
+                hint_prompt,
+                continue_prompt,
+                system_prompt,
+                chunk_keys[0],
+                content_tokens,
+            )
+            sections = [
+                parse_extraction_records(final_result, chunk_keys[0], **delimiters)
+            ]
+        else:
+            input_text = "\n".join(
+                PROMPTS["entity_extraction_packed_text"].format(
+                    text_number=i + 1, input_text=chunk_dp["content"]
+                )
+                for i, (_, chunk_dp) in enumerate(pack)
+            )
+            hint_prompt = packed_prompt.format(**context_base, input_text=input_text)
+            final_result = await _extract_with_gleaning(
+                hint_prompt,
+                packed_continue_prompt,
+                packed_system_prompt,
+                chunk_keys[0],
+                content_tokens,
             )
-            if_entities = await _handle_single_entity_extraction(
-                record_attributes, chunk_key
+            sections = parse_packed_extraction_records(
+                final_result, chunk_keys, **delimiters
             )
-            if if_entities is not None:
-                maybe_nodes[if_entities["entity_name"]].append(if_entities)
-                continue
 
-            if_relation = await _handle_single_relationship_extraction(
-                record_attributes, chunk_key
+        chunk_results = []
+        for chunk_key, (maybe_nodes, maybe_edges) in zip(chunk_keys, sections):
+            already_processed += 1
+            already_entities += len(maybe_nodes)
+            already_relations += len(maybe_edges)
+            stats.chunks += 1
+            stats.extracted_elements += len(maybe_nodes) + len(maybe_edges)
+            if on_chunk_done is not None:
+                on_chunk_done(chunk_key)
+            chunk_results.append((chunk_key, maybe_nodes, maybe_edges))
+        if show_progress:
+            now_ticks = PROMPTS["process_tickers"][
+                already_processed % len(PROMPTS["process_tickers"])
+            ]
+            print(
+                f"{now_ticks} Processed {already_processed} chunks, {already_entities} entities(duplicated), {already_relations} relations(duplicated)\r",
+                end="",
+                flush=True,
             )
-            if if_relation is not None:
-                maybe_edges[(if_relation["src_id"], if_relation["tgt_id"])].append(
-                    if_relation
-                )
-        already_processed += 1
-        already_entities += len(maybe_nodes)
-        already_relations += len(maybe_edges)
-        now_ticks = PROMPTS["process_tickers"][
-            already_processed % len(PROMPTS["process_tickers"])
-        ]
-        print(
-            f"{now_ticks} Processed {already_processed} chunks, {already_entities} entities(duplicated), {already_relations} relations(duplicated)\r",
-            end="",
-            flush=True,
-        )
-        return dict(maybe_nodes), dict(maybe_edges)
+        return chunk_results
 
-    results = []
+    results = {}
     for result in tqdm_async(
-        asyncio.as_completed([_process_single_content(c) for c in ordered_chunks]),
-        total=len(ordered_chunks),
+        asyncio.as_completed([_process_pack(pack) for pack in packs]),
+        total=len(packs),
         desc="Extracting entities from chunks",
-        unit="chunk",
+        unit="chunk" if max_pack_chunks <= 1 else "request",
+        disable=not show_progress,
     ):
-        results.append(await result)
+        for chunk_result in await result:
+            results[chunk_result[0]] = chunk_result
+    if gleaning_policy is not None:
+        recall_lost = stats.estimated_recall_lost
+        logger.info(
+            f"Adaptive gleaning saved {stats.calls_saved} LLM calls, made {stats.glean_calls} gleaning and {stats.if_loop_calls} if-loop calls for {stats.chunks} chunks"
+            + (
+                f", estimated recall lost {recall_lost:.1%}"
+                if recall_lost is not None
+                else ""
+            )
+        )
+    if gleaning_stats is not None:
+        gleaning_stats.merge(stats)
+    return [results[chunk_key] for chunk_key, _ in ordered_chunks]
 
-    maybe_nodes = defaultdict(list)
-    maybe_edges = defaultdict(list)
-    for m_nodes, m_edges in results:
-        for k, v in m_nodes.items():
-            maybe_nodes[k].extend(v)
-        for k, v in m_edges.items():
-            maybe_edges[tuple(sorted(k))].extend(v)
+
+async def merge_graph_elements(
+    maybe_nodes: dict[str, list[dict]],
+    maybe_edges: dict[tuple[str, str], list[dict]],
+    knowledge_graph_inst: BaseGraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    global_config: dict,
+    show_progress: bool = True,
+    provenance_index: ProvenanceIndex = None,
+    graph_locks: KeyedLock = None,
+) -> tuple[list[dict], list[dict]]:
+    """Merge extracted nodes and edges into the graph and upsert them into the vector dbs.
+
+    Returns the merged entities and relationships; nothing is written to the vector
+    dbs unless both are non-empty. Merges lock the entities and relations they
+    change in graph_locks, so calls sharing it can run concurrently.
+    """
+    if graph_locks is None:
+        graph_locks = KeyedLock()
     logger.info("Inserting entities into storage...")
     all_entities_data = []
     for result in tqdm_async(
         asyncio.as_completed(
             [
-                _merge_nodes_then_upsert(k, v, knowledge_graph_inst, global_config)
+                _merge_nodes_then_upsert(
+                    k,
+                    v,
+                    knowledge_graph_inst,
+                    global_config,
+                    provenance_index,
+                    graph_locks,
+                )
                 for k, v in maybe_nodes.items()
             ]
         ),
         total=len(maybe_nodes),
         desc="Inserting entities",
         unit="entity",
+        disable=not show_progress,
     ):
         all_entities_data.append(await result)
 
@@ -383,7 +687,13 @@ async def extract_entities(
         asyncio.as_completed(
             [
                 _merge_edges_then_upsert(
-                    k[0], k[1], v, knowledge_graph_inst, global_config
+                    k[0],
+                    k[1],
+                    v,
+                    knowledge_graph_inst,
+                    global_config,
+                    provenance_index,
+                    graph_locks,
                 )
                 for k, v in maybe_edges.items()
             ]
@@ -391,55 +701,80 @@ async def extract_entities(
         total=len(maybe_edges),
         desc="Inserting relationships",
         unit="relationship",
+        disable=not show_progress,
     ):
         all_relationships_data.append(await result)
 
-    if not len(all_entities_data):
-        logger.warning("Didn't extract any entities, maybe your LLM is not working")
-        return None
-    if not len(all_relationships_data):
-        logger.warning(
-            "Didn't extract any relationships, maybe your LLM is not working"
-        )
-        return None
-
-    if entity_vdb is not None:
-        data_for_vdb = {
-            compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
-                "content": dp["entity_name"] + dp["description"],
-                "entity_name": dp["entity_name"],
-            }
-            for dp in all_entities_data
-        }
-        await entity_vdb.upsert(data_for_vdb)
-
-    if relationships_vdb is not None:
-        data_for_vdb = {
-            compute_mdhash_id(dp["src_id"] + dp["tgt_id"], prefix="rel-"): {
-                "src_id": dp["src_id"],
-                "tgt_id": dp["tgt_id"],
-                "content": dp["keywords"]
-                + dp["src_id"]
-                + dp["tgt_id"]
-                + dp["description"],
-            }
-            for dp in all_relationships_data
-        }
-        await relationships_vdb.upsert(data_for_vdb)
+    if not len(all_entities_data) or not len(all_relationships_data):
+        return all_entities_data, all_relationships_data
 
-    return knowledge_graph_inst
+    await _upsert_graph_elements_vdb(
+        [dp["entity_name"] for dp in all_entities_data],
+        [(dp["src_id"], dp["tgt_id"]) for dp in all_relationships_data],
+        knowledge_graph_inst,
+        entity_vdb,
+        relationships_vdb,
+        graph_locks,
+    )
+    return all_entities_data, all_relationships_data
 
 
-async def kg_query(
-    query,
+async def _upsert_graph_elements_vdb(
+    entity_names: list[str],
+    relation_keys: list[tuple[str, str]],
     knowledge_graph_inst: BaseGraphStorage,
-    entities_vdb: BaseVectorStorage,
+    entity_vdb: BaseVectorStorage,
     relationships_vdb: BaseVectorStorage,
-    text_chunks_db: BaseKVStorage[TextChunkSchema],
-    query_param: QueryParam,
-    global_config: dict,
-) -> str:
-    context = None
+    graph_locks: KeyedLock,
+):
+    """Embed the current graph version of the given entities and relations.
+
+    The graph is read and the vector db written under the element locks, so when
+    concurrent inserts merge the same element, whichever embeds last stores the
+    latest merge.
+    """
+    if entity_vdb is not None and entity_names:
+        async with graph_locks.lock(*[entity_lock_key(k) for k in entity_names]):
+            records = await asyncio.gather(
+                *[knowledge_graph_inst.get_node_record(k) for k in entity_names]
+            )
+            data_for_vdb = {
+                compute_mdhash_id(entity_name, prefix="ent-"): {
+                    "content": entity_name + GRAPH_FIELD_SEP.join(record.descriptions),
+                    "entity_name": entity_name,
+                }
+                for entity_name, record in zip(entity_names, records)
+                if record is not None
+            }
+            if data_for_vdb:
+                await entity_vdb.upsert(data_for_vdb)
+
+    if relationships_vdb is not None and relation_keys:
+        async with graph_locks.lock(*[relation_lock_key(*k) for k in relation_keys]):
+            records = await asyncio.gather(
+                *[knowledge_graph_inst.get_edge_record(*k) for k in relation_keys]
+            )
+            data_for_vdb = {
+                compute_mdhash_id(src_id + tgt_id, prefix="rel-"): {
+                    "src_id": src_id,
+                    "tgt_id": tgt_id,
+                    "content": GRAPH_FIELD_SEP.join(record.keywords)
+                    + src_id
+                    + tgt_id
+                    + GRAPH_FIELD_SEP.join(record.descriptions),
+                }
+                for (src_id, tgt_id), record in zip(relation_keys, records)
+                if record is not None
+            }
+            if data_for_vdb:
+                await relationships_vdb.upsert(data_for_vdb)
+
+
+async def _extract_keywords_with_llm(
+    query: str, query_param: QueryParam, global_config: dict
+) -> Union[tuple[list[str], list[str]], None]:
+    """The (high-level, low-level) keywords the LLM finds in a query, None if its
+    answer can't be parsed"""
     example_number = global_config["addon_params"].get("example_number", None)
     if example_number and example_number < len(PROMPTS["keywords_extraction_examples"]):
         examples = "\n".join(
@@ -451,16 +786,15 @@ async def kg_query(
         "language", PROMPTS["DEFAULT_LANGUAGE"]
     )
 
-    # Set mode
-    if query_param.mode not in ["local", "global", "hybrid"]:
-        logger.error(f"Unknown mode {query_param.mode} in kg_query")
-        return PROMPTS["fail_response"]
-
-    # LLM generate keywords
     use_model_func = global_config["llm_model_func"]
     kw_prompt_temp = PROMPTS["keywords_extraction"]
-    kw_prompt = kw_prompt_temp.format(query=query, examples=examples, language=language)
-    result = await use_model_func(kw_prompt, keyword_extraction=True)
+    kw_prompt = PROMPTS["keywords_extraction_input"].format(query=query)
+    result = await use_model_func(
+        kw_prompt,
+        system_prompt=kw_prompt_temp.format(examples=examples, language=language),
+        keyword_extraction=True,
+        **_hedge_kwargs(query_param),
+    )
     logger.info("kw_prompt result:")
     print(result)
     try:
@@ -472,8 +806,41 @@ async def kg_query(
     # Handle parsing error
     except json.JSONDecodeError as e:
         print(f"JSON parsing error: {e} {result}")
+        return None
+    return hl_keywords, ll_keywords
+
+
+async def kg_query(
+    query,
+    knowledge_graph_inst: BaseGraphStorage,
+    entities_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    global_config: dict,
+    provenance_index: ProvenanceIndex = None,
+    keyword_extractor=None,
+) -> Union[str, AsyncIterator[str]]:
+    """Answer a query from the graph.
+
+    The query keywords come from keyword_extractor (e.g. a LocalKeywordExtractor)
+    when given, from an LLM call otherwise.
+    """
+    context = None
+
+    # Set mode
+    if query_param.mode not in ["local", "global", "hybrid"]:
+        logger.error(f"Unknown mode {query_param.mode} in kg_query")
         return PROMPTS["fail_response"]
 
+    if keyword_extractor is not None:
+        hl_keywords, ll_keywords = await keyword_extractor.extract(query, query_param)
+    else:
+        keywords = await _extract_keywords_with_llm(query, query_param, global_config)
+        if keywords is None:
+            return PROMPTS["fail_response"]
+        hl_keywords, ll_keywords = keywords
+
     # Handdle keywords missing
     if hl_keywords == [] and ll_keywords == []:
         logger.warning("low_level_keywords and high_level_keywords is empty")
@@ -498,25 +865,30 @@ async def kg_query(
         relationships_vdb,
         text_chunks_db,
         query_param,
+        provenance_index,
     )
 
     if query_param.only_need_context:
         return context
     if context is None:
         return PROMPTS["fail_response"]
-    sys_prompt_temp = PROMPTS["rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
+    sys_prompt = PROMPTS["rag_response"]
+    user_prompt = PROMPTS["rag_response_input"].format(
+        context_data=context, response_type=query_param.response_type, query=query
     )
     if query_param.only_need_prompt:
-        return sys_prompt
+        return f"{sys_prompt}\n{user_prompt}"
+    use_model_func = global_config["llm_model_func"]
     response = await use_model_func(
-        query,
+        user_prompt,
         system_prompt=sys_prompt,
+        **_stream_kwargs(query_param),
+        **_hedge_kwargs(query_param),
     )
-    if len(response) > len(sys_prompt):
+    if isinstance(response, str) and len(response) > len(sys_prompt):
         response = (
             response.replace(sys_prompt, "")
+            .replace(user_prompt, "")
             .replace("user", "")
             .replace("model", "")
             .replace(query, "")
@@ -528,6 +900,15 @@ async def kg_query(
     return response
 
 
+def _stream_kwargs(query_param: QueryParam) -> dict:
+    # only ask for a stream when wanted, so llm funcs without streaming support keep working
+    return {"stream": True} if query_param.stream else {}
+
+
+def _hedge_kwargs(query_param: QueryParam) -> dict:
+    return {"hedge": True} if query_param.hedge else {}
+
+
 async def _build_query_context(
     query: list,
     knowledge_graph_inst: BaseGraphStorage,
@@ -535,72 +916,199 @@ async def _build_query_context(
     relationships_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
+    provenance_index: ProvenanceIndex = None,
 ):
     ll_kewwords, hl_keywrds = query[0], query[1]
-    if query_param.mode in ["local", "hybrid"]:
-        if ll_kewwords == "":
-            ll_entities_context, ll_relations_context, ll_text_units_context = (
-                "",
-                "",
-                "",
-            )
-            warnings.warn(
-                "Low Level context is None. Return empty Low entity/relationship/source"
-            )
-            query_param.mode = "global"
-        else:
-            (
-                ll_entities_context,
-                ll_relations_context,
-                ll_text_units_context,
-            ) = await _get_node_data(
+    # query_param may be shared by concurrent queries, so the fallback mode
+    # is kept local instead of being written back to it
+    mode = query_param.mode
+    if mode in ["local", "hybrid"] and ll_kewwords == "":
+        warnings.warn(
+            "Low Level context is None. Return empty Low entity/relationship/source"
+        )
+        mode = "global"
+    if mode in ["global", "hybrid"] and hl_keywrds == "":
+        warnings.warn(
+            "High Level context is None. Return empty High entity/relationship/source"
+        )
+        mode = "local"
+
+    # the low-level (entities) and high-level (relationships) branches only
+    # read from storage, so in hybrid mode they are built concurrently
+    retrieval_tasks = []
+    if mode in ["local", "hybrid"]:
+        retrieval_tasks.append(
+            _get_node_data(
                 ll_kewwords,
                 knowledge_graph_inst,
                 entities_vdb,
                 text_chunks_db,
                 query_param,
+                provenance_index,
             )
-    if query_param.mode in ["global", "hybrid"]:
-        if hl_keywrds == "":
-            hl_entities_context, hl_relations_context, hl_text_units_context = (
-                "",
-                "",
-                "",
-            )
-            warnings.warn(
-                "High Level context is None. Return empty High entity/relationship/source"
-            )
-            query_param.mode = "local"
-        else:
-            (
-                hl_entities_context,
-                hl_relations_context,
-                hl_text_units_context,
-            ) = await _get_edge_data(
+        )
+    if mode in ["global", "hybrid"]:
+        retrieval_tasks.append(
+            _get_edge_data(
                 hl_keywrds,
                 knowledge_graph_inst,
                 relationships_vdb,
                 text_chunks_db,
                 query_param,
+                provenance_index,
             )
-    if query_param.mode == "hybrid":
-        entities_context, relations_context, text_units_context = combine_contexts(
-            [hl_entities_context, ll_entities_context],
-            [hl_relations_context, ll_relations_context],
-            [hl_text_units_context, ll_text_units_context],
         )
-    elif query_param.mode == "local":
-        entities_context, relations_context, text_units_context = (
-            ll_entities_context,
-            ll_relations_context,
-            ll_text_units_context,
+    contexts = [c for c in await asyncio.gather(*retrieval_tasks) if c is not None]
+    if not contexts:
+        return None
+    context = contexts[0] if len(contexts) == 1 else merge_query_contexts(*contexts)
+    if len(contexts) > 1 or query_param.max_token_for_context:
+        context = pack_query_context(context, query_param)
+    return _render_query_context(context)
+
+
+def merge_query_contexts(*contexts: QueryContext) -> QueryContext:
+    """Merge contexts retrieved by different branches into one.
+
+    Items are deduplicated by entity name, (source, target) pair and chunk id.
+    An item found by several branches keeps the sum of its scores, so the merge is
+    a reciprocal rank fusion when the scores are reciprocal ranks.
+    """
+
+    def _merge(items_lists, key):
+        merged = {}
+        for items in items_lists:
+            for item in items:
+                item_key = key(item)
+                if item_key in merged:
+                    merged[item_key].score += item.score
+                else:
+                    merged[item_key] = dataclasses.replace(item)
+        return sorted(merged.values(), key=lambda x: x.score, reverse=True)
+
+    return QueryContext(
+        entities=_merge([c.entities for c in contexts], lambda x: x.entity_name),
+        relations=_merge(
+            [c.relations for c in contexts],
+            lambda x: tuple(sorted((x.src_id, x.tgt_id))),
+        ),
+        chunks=_merge([c.chunks for c in contexts], lambda x: x.chunk_id),
+    )
+
+
+def pack_query_context(context: QueryContext, query_param: QueryParam) -> QueryContext:
+    """Fit the context into the token budget of query_param, best scored items first"""
+    if query_param.max_token_for_context:
+        return _pack_query_context_by_total_budget(context, query_param)
+    return QueryContext(
+        entities=pack_list_by_token_size(
+            context.entities,
+            key=lambda x: x.description,
+            score=lambda x: x.score,
+            max_token_size=query_param.max_token_for_local_context,
+        ),
+        relations=pack_list_by_token_size(
+            context.relations,
+            key=lambda x: x.description,
+            score=lambda x: x.score,
+            max_token_size=query_param.max_token_for_global_context,
+        ),
+        chunks=pack_list_by_token_size(
+            context.chunks,
+            key=lambda x: x.content,
+            score=lambda x: x.score,
+            max_token_size=query_param.max_token_for_text_unit,
+        ),
+    )
+
+
+def _pack_query_context_by_total_budget(
+    context: QueryContext, query_param: QueryParam
+) -> QueryContext:
+    """Share max_token_for_context between entities, relations and chunks.
+
+    Each section first gets a part of the budget proportional to its weight times
+    the total score of its items, and fills it in score order. Whatever a section
+    leaves unused then goes to the remaining items of all sections, ordered by
+    weighted score, so no budget is wasted while relevant context is left out.
+    """
+    budget = query_param.max_token_for_context
+    weights = query_param.context_section_weights
+    sections = {
+        "entities": [
+            (x, count_tokens_by_tiktoken(x.description)) for x in context.entities
+        ],
+        "relations": [
+            (x, count_tokens_by_tiktoken(x.description)) for x in context.relations
+        ],
+        "chunks": [(x, count_tokens_by_tiktoken(x.content)) for x in context.chunks],
+    }
+    relevance = {
+        name: weights.get(name, 1.0) * sum(x.score for x, _ in items)
+        for name, items in sections.items()
+    }
+    total_relevance = sum(relevance.values())
+    if budget <= 0 or total_relevance <= 0:
+        return QueryContext()
+
+    selected = {name: [] for name in sections}
+    leftovers = []
+    used_tokens = 0
+    for name, items in sections.items():
+        share = budget * relevance[name] / total_relevance
+        section_tokens = 0
+        for x, tokens in sorted(items, key=lambda item: item[0].score, reverse=True):
+            if section_tokens + tokens <= share:
+                section_tokens += tokens
+                selected[name].append(x)
+            else:
+                leftovers.append((weights.get(name, 1.0) * x.score, name, x, tokens))
+        used_tokens += section_tokens
+
+    for _, name, x, tokens in sorted(leftovers, key=lambda item: item[0], reverse=True):
+        if used_tokens + tokens <= budget:
+            used_tokens += tokens
+            selected[name].append(x)
+
+    logger.info(
+        f"Packed {sum(len(v) for v in selected.values())} context items into {used_tokens}/{budget} tokens"
+    )
+    return QueryContext(
+        entities=sorted(selected["entities"], key=lambda x: x.score, reverse=True),
+        relations=sorted(selected["relations"], key=lambda x: x.score, reverse=True),
+        chunks=sorted(selected["chunks"], key=lambda x: x.score, reverse=True),
+    )
+
+
+def _section_token_budget(query_param: QueryParam, section_max_tokens: int) -> int:
+    # with a total budget the sections are packed together afterwards, so any one
+    # section may keep candidates up to the whole budget at retrieval time
+    if query_param.max_token_for_context:
+        return query_param.max_token_for_context
+    return section_max_tokens
+
+
+def _render_query_context(context: QueryContext) -> str:
+    entites_section_list = [["id", "entity", "type", "description", "rank"]]
+    for i, n in enumerate(context.entities):
+        entites_section_list.append(
+            [i, n.entity_name, n.entity_type, n.description, n.rank]
         )
-    elif query_param.mode == "global":
-        entities_context, relations_context, text_units_context = (
-            hl_entities_context,
-            hl_relations_context,
-            hl_text_units_context,
+    entities_context = list_of_list_to_csv(entites_section_list)
+
+    relations_section_list = [
+        ["id", "source", "target", "description", "keywords", "weight", "rank"]
+    ]
+    for i, e in enumerate(context.relations):
+        relations_section_list.append(
+            [i, e.src_id, e.tgt_id, e.description, e.keywords, e.weight, e.rank]
         )
+    relations_context = list_of_list_to_csv(relations_section_list)
+
+    text_units_section_list = [["id", "content"]]
+    for i, t in enumerate(context.chunks):
+        text_units_section_list.append([i, t.content])
+    text_units_context = list_of_list_to_csv(text_units_section_list)
     return f"""
 -----Entities-----
 ```csv
@@ -617,81 +1125,104 @@ async def _build_query_context(
 """
 
 
+def _to_query_context(
+    node_datas: list[dict], edge_datas: list[dict], text_units: list[dict]
+) -> QueryContext:
+    # each list is already in retrieval order, score items by reciprocal rank
+    return QueryContext(
+        entities=[
+            ContextEntity(
+                entity_name=n["entity_name"],
+                entity_type=n.get("entity_type", "UNKNOWN"),
+                description=n.get("description", "UNKNOWN"),
+                rank=n["rank"],
+                score=1 / (i + 1),
+            )
+            for i, n in enumerate(node_datas)
+        ],
+        relations=[
+            ContextRelation(
+                src_id=e["src_id"],
+                tgt_id=e["tgt_id"],
+                description=e["description"],
+                keywords=e["keywords"],
+                weight=e["weight"],
+                rank=e["rank"],
+                score=1 / (i + 1),
+            )
+            for i, e in enumerate(edge_datas)
+        ],
+        chunks=[
+            ContextChunk(chunk_id=t["id"], content=t["content"], score=1 / (i + 1))
+            for i, t in enumerate(text_units)
+        ],
+    )
+
+
 async def _get_node_data(
     query,
     knowledge_graph_inst: BaseGraphStorage,
     entities_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
+    provenance_index: ProvenanceIndex = None,
 ):
     # get similar entities
     results = await entities_vdb.query(query, top_k=query_param.top_k)
     if not len(results):
         return None
-    # get entity information
-    node_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
+    # get entity information and degree
+    node_datas, node_degrees = await asyncio.gather(
+        asyncio.gather(
+            *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
+        ),
+        asyncio.gather(
+            *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
+        ),
     )
     if not all([n is not None for n in node_datas]):
         logger.warning("Some nodes are missing, maybe the storage is damaged")
 
-    # get entity degree
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
     node_datas = [
         {**n, "entity_name": k["entity_name"], "rank": d}
         for k, n, d in zip(results, node_datas, node_degrees)
         if n is not None
     ]  # what is this text_chunks_db doing.  dont remember it in airvx.  check the diagram.
-    # get entitytext chunk
-    use_text_units = await _find_most_related_text_unit_from_entities(
-        node_datas, query_param, text_chunks_db, knowledge_graph_inst
-    )
-    # get relate edges
-    use_relations = await _find_most_related_edges_from_entities(
-        node_datas, query_param, knowledge_graph_inst
+    # get entitytext chunk and relate edges
+    use_text_units, use_relations = await asyncio.gather(
+        _find_most_related_text_unit_from_entities(
+            node_datas,
+            query_param,
+            text_chunks_db,
+            knowledge_graph_inst,
+            provenance_index,
+        ),
+        _find_most_related_edges_from_entities(
+            node_datas, query_param, knowledge_graph_inst
+        ),
     )
     logger.info(
         f"Local query uses {len(node_datas)} entites, {len(use_relations)} relations, {len(use_text_units)} text units"
     )
 
-    # build prompt
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(node_datas):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
-
-    relations_section_list = [
-        ["id", "source", "target", "description", "keywords", "weight", "rank"]
+    use_relations = [
+        {"src_id": e["src_tgt"][0], "tgt_id": e["src_tgt"][1], **e}
+        for e in use_relations
     ]
-    for i, e in enumerate(use_relations):
-        relations_section_list.append(
-            [
-                i,
-                e["src_tgt"][0],
-                e["src_tgt"][1],
-                e["description"],
-                e["keywords"],
-                e["weight"],
-                e["rank"],
-            ]
-        )
-    relations_context = list_of_list_to_csv(relations_section_list)
+    return _to_query_context(node_datas, use_relations, use_text_units)
 
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
-    return entities_context, relations_context, text_units_context
+
+async def _fill_text_units_data(
+    text_units_lookup: dict[str, dict],
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+):
+    # fetch every referenced chunk in one batch instead of one get_by_id per chunk
+    chunk_ids = list(text_units_lookup.keys())
+    if not chunk_ids:
+        return
+    chunk_datas = await text_chunks_db.get_by_ids(chunk_ids)
+    for c_id, data in zip(chunk_ids, chunk_datas):
+        text_units_lookup[c_id]["data"] = data
 
 
 async def _find_most_related_text_unit_from_entities(
@@ -699,10 +1230,10 @@ async def _find_most_related_text_unit_from_entities(
     query_param: QueryParam,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     knowledge_graph_inst: BaseGraphStorage,
+    provenance_index: ProvenanceIndex = None,
 ):
     text_units = [
-        split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
-        for dp in node_datas
+        _entity_source_ids(dp["entity_name"], dp, provenance_index) for dp in node_datas
     ]
     edges = await asyncio.gather(
         *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
@@ -713,24 +1244,38 @@ async def _find_most_related_text_unit_from_entities(
             continue
         all_one_hop_nodes.update([e[1] for e in this_edges])
 
-    all_one_hop_nodes = list(all_one_hop_nodes)
-    all_one_hop_nodes_data = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(e) for e in all_one_hop_nodes]
+    # one-hop nodes are only needed for their sources, which the provenance index
+    # answers without reading them from the graph
+    all_one_hop_text_units_lookup = {}
+    unindexed_one_hop_nodes = []
+    for node_id in all_one_hop_nodes:
+        chunk_ids = (
+            provenance_index.entity_chunk_ids(node_id)
+            if provenance_index is not None
+            else None
+        )
+        if chunk_ids is None:
+            unindexed_one_hop_nodes.append(node_id)
+        else:
+            all_one_hop_text_units_lookup[node_id] = set(chunk_ids)
+    unindexed_one_hop_nodes_data = await asyncio.gather(
+        *[knowledge_graph_inst.get_node(e) for e in unindexed_one_hop_nodes]
     )
 
     # Add null check for node data
-    all_one_hop_text_units_lookup = {
-        k: set(split_string_by_multi_markers(v["source_id"], [GRAPH_FIELD_SEP]))
-        for k, v in zip(all_one_hop_nodes, all_one_hop_nodes_data)
-        if v is not None and "source_id" in v  # Add source_id check
-    }
+    all_one_hop_text_units_lookup.update(
+        {
+            k: set(split_string_by_multi_markers(v["source_id"], [GRAPH_FIELD_SEP]))
+            for k, v in zip(unindexed_one_hop_nodes, unindexed_one_hop_nodes_data)
+            if v is not None and "source_id" in v  # Add source_id check
+        }
+    )
 
     all_text_units_lookup = {}
     for index, (this_text_units, this_edges) in enumerate(zip(text_units, edges)):
         for c_id in this_text_units:
             if c_id not in all_text_units_lookup:
                 all_text_units_lookup[c_id] = {
-                    "data": await text_chunks_db.get_by_id(c_id),
                     "order": index,
                     "relation_counts": 0,
                 }
@@ -743,6 +1288,8 @@ async def _find_most_related_text_unit_from_entities(
                     ):
                         all_text_units_lookup[c_id]["relation_counts"] += 1
 
+    await _fill_text_units_data(all_text_units_lookup, text_chunks_db)
+
     # Filter out None values and ensure data has content
     all_text_units = [
         {"id": k, **v}
@@ -761,13 +1308,29 @@ async def _find_most_related_text_unit_from_entities(
     all_text_units = truncate_list_by_token_size(
         all_text_units,
         key=lambda x: x["data"]["content"],
-        max_token_size=query_param.max_token_for_text_unit,
+        max_token_size=_section_token_budget(
+            query_param, query_param.max_token_for_text_unit
+        ),
     )
 
-    all_text_units = [t["data"] for t in all_text_units]
+    all_text_units = [{**t["data"], "id": t["id"]} for t in all_text_units]
     return all_text_units
 
 
+async def _get_edge_degrees(
+    edges: list[tuple[str, str]],
+    knowledge_graph_inst: BaseGraphStorage,
+) -> list[int]:
+    # edge rank is the sum of the endpoint degrees, read each stored degree once
+    # instead of aggregating both endpoints again for every edge
+    node_ids = list({node_id for edge in edges for node_id in edge})
+    node_degrees = await asyncio.gather(
+        *[knowledge_graph_inst.node_degree(node_id) for node_id in node_ids]
+    )
+    degree_lookup = {k: d or 0 for k, d in zip(node_ids, node_degrees)}
+    return [degree_lookup[src] + degree_lookup[tgt] for src, tgt in edges]
+
+
 async def _find_most_related_edges_from_entities(
     node_datas: list[dict],
     query_param: QueryParam,
@@ -789,9 +1352,7 @@ async def _find_most_related_edges_from_entities(
     all_edges_pack = await asyncio.gather(
         *[knowledge_graph_inst.get_edge(e[0], e[1]) for e in all_edges]
     )
-    all_edges_degree = await asyncio.gather(
-        *[knowledge_graph_inst.edge_degree(e[0], e[1]) for e in all_edges]
-    )
+    all_edges_degree = await _get_edge_degrees(all_edges, knowledge_graph_inst)
     all_edges_data = [
         {"src_tgt": k, "rank": d, **v}
         for k, v, d in zip(all_edges, all_edges_pack, all_edges_degree)
@@ -803,7 +1364,9 @@ async def _find_most_related_edges_from_entities(
     all_edges_data = truncate_list_by_token_size(
         all_edges_data,
         key=lambda x: x["description"],
-        max_token_size=query_param.max_token_for_global_context,
+        max_token_size=_section_token_budget(
+            query_param, query_param.max_token_for_global_context
+        ),
     )
     return all_edges_data
 
@@ -814,6 +1377,7 @@ async def _get_edge_data(
     relationships_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
+    provenance_index: ProvenanceIndex = None,
 ):
     results = await relationships_vdb.query(keywords, top_k=query_param.top_k)
 
@@ -826,8 +1390,8 @@ async def _get_edge_data(
 
     if not all([n is not None for n in edge_datas]):
         logger.warning("Some edges are missing, maybe the storage is damaged")
-    edge_degree = await asyncio.gather(
-        *[knowledge_graph_inst.edge_degree(r["src_id"], r["tgt_id"]) for r in results]
+    edge_degree = await _get_edge_degrees(
+        [(r["src_id"], r["tgt_id"]) for r in results], knowledge_graph_inst
     )
     edge_datas = [
         {"src_id": k["src_id"], "tgt_id": k["tgt_id"], "rank": d, **v}
@@ -840,54 +1404,28 @@ async def _get_edge_data(
     edge_datas = truncate_list_by_token_size(
         edge_datas,
         key=lambda x: x["description"],
-        max_token_size=query_param.max_token_for_global_context,
+        max_token_size=_section_token_budget(
+            query_param, query_param.max_token_for_global_context
+        ),
     )
 
-    use_entities = await _find_most_related_entities_from_relationships(
-        edge_datas, query_param, knowledge_graph_inst
-    )
-    use_text_units = await _find_related_text_unit_from_relationships(
-        edge_datas, query_param, text_chunks_db, knowledge_graph_inst
+    use_entities, use_text_units = await asyncio.gather(
+        _find_most_related_entities_from_relationships(
+            edge_datas, query_param, knowledge_graph_inst
+        ),
+        _find_related_text_unit_from_relationships(
+            edge_datas,
+            query_param,
+            text_chunks_db,
+            knowledge_graph_inst,
+            provenance_index,
+        ),
     )
     logger.info(
         f"Global query uses {len(use_entities)} entites, {len(edge_datas)} relations, {len(use_text_units)} text units"
     )
 
-    relations_section_list = [
-        ["id", "source", "target", "description", "keywords", "weight", "rank"]
-    ]
-    for i, e in enumerate(edge_datas):
-        relations_section_list.append(
-            [
-                i,
-                e["src_id"],
-                e["tgt_id"],
-                e["description"],
-                e["keywords"],
-                e["weight"],
-                e["rank"],
-            ]
-        )
-    relations_context = list_of_list_to_csv(relations_section_list)
-
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(use_entities):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
-
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
-    return entities_context, relations_context, text_units_context
+    return _to_query_context(use_entities, edge_datas, use_text_units)
 
 
 async def _find_most_related_entities_from_relationships(
@@ -921,7 +1459,9 @@ async def _find_most_related_entities_from_relationships(
     node_datas = truncate_list_by_token_size(
         node_datas,
         key=lambda x: x["description"],
-        max_token_size=query_param.max_token_for_local_context,
+        max_token_size=_section_token_budget(
+            query_param, query_param.max_token_for_local_context
+        ),
     )
 
     return node_datas
@@ -932,9 +1472,10 @@ async def _find_related_text_unit_from_relationships(
     query_param: QueryParam,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     knowledge_graph_inst: BaseGraphStorage,
+    provenance_index: ProvenanceIndex = None,
 ):
     text_units = [
-        split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
+        _relation_source_ids(dp["src_id"], dp["tgt_id"], dp, provenance_index)
         for dp in edge_datas
     ]
 
@@ -944,45 +1485,30 @@ async def _find_related_text_unit_from_relationships(
         for c_id in unit_list:
             if c_id not in all_text_units_lookup:
                 all_text_units_lookup[c_id] = {
-                    "data": await text_chunks_db.get_by_id(c_id),
                     "order": index,
                 }
+    await _fill_text_units_data(all_text_units_lookup, text_chunks_db)
 
-    if any([v is None for v in all_text_units_lookup.values()]):
+    if any([v["data"] is None for v in all_text_units_lookup.values()]):
         logger.warning("Text chunks are missing, maybe the storage is damaged")
     all_text_units = [
-        {"id": k, **v} for k, v in all_text_units_lookup.items() if v is not None
+        {"id": k, **v}
+        for k, v in all_text_units_lookup.items()
+        if v["data"] is not None
     ]
     all_text_units = sorted(all_text_units, key=lambda x: x["order"])
     all_text_units = truncate_list_by_token_size(
         all_text_units,
         key=lambda x: x["data"]["content"],
-        max_token_size=query_param.max_token_for_text_unit,
+        max_token_size=_section_token_budget(
+            query_param, query_param.max_token_for_text_unit
+        ),
     )
-    all_text_units: list[TextChunkSchema] = [t["data"] for t in all_text_units]
+    all_text_units = [{**t["data"], "id": t["id"]} for t in all_text_units]
 
     return all_text_units
 
 
-def combine_contexts(entities, relationships, sources):
-    # Function to extract entities, relationships, and sources from context strings
-    hl_entities, ll_entities = entities[0], entities[1]
-    hl_relationships, ll_relationships = relationships[0], relationships[1]
-    hl_sources, ll_sources = sources[0], sources[1]
-    # Combine and deduplicate the entities
-    combined_entities = process_combine_contexts(hl_entities, ll_entities)
-
-    # Combine and deduplicate the relationships
-    combined_relationships = process_combine_contexts(
-        hl_relationships, ll_relationships
-    )
-
-    # Combine and deduplicate the sources
-    combined_sources = process_combine_contexts(hl_sources, ll_sources)
-
-    return combined_entities, combined_relationships, combined_sources
-
-
 async def naive_query(
     query,
     chunks_vdb: BaseVectorStorage,
@@ -1000,27 +1526,32 @@ async def naive_query(
     maybe_trun_chunks = truncate_list_by_token_size(
         chunks,
         key=lambda x: x["content"],
-        max_token_size=query_param.max_token_for_text_unit,
+        max_token_size=_section_token_budget(
+            query_param, query_param.max_token_for_text_unit
+        ),
     )
     logger.info(f"Truncate {len(chunks)} to {len(maybe_trun_chunks)} chunks")
     section = "\n--New Chunk--\n".join([c["content"] for c in maybe_trun_chunks])
     if query_param.only_need_context:
         return section
-    sys_prompt_temp = PROMPTS["naive_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        content_data=section, response_type=query_param.response_type
+    sys_prompt = PROMPTS["naive_rag_response"]
+    user_prompt = PROMPTS["naive_rag_response_input"].format(
+        content_data=section, response_type=query_param.response_type, query=query
     )
     if query_param.only_need_prompt:
-        return sys_prompt
+        return f"{sys_prompt}\n{user_prompt}"
     response = await use_model_func(
-        query,
+        user_prompt,
         system_prompt=sys_prompt,
+        **_stream_kwargs(query_param),
+        **_hedge_kwargs(query_param),
     )
 
-    if len(response) > len(sys_prompt):
+    if isinstance(response, str) and len(response) > len(sys_prompt):
         response = (
             response[len(sys_prompt) :]
             .replace(sys_prompt, "")
+            .replace(user_prompt, "")
             .replace("user", "")
             .replace("model", "")
             .replace(query, "")
@@ -1030,3 +1561,233 @@ async def naive_query(
         )
 
     return response
+
+
+def group_graph_elements_by_chunk(
+    chunk_keys,
+    maybe_nodes: dict[str, list[dict]],
+    maybe_edges: dict[tuple[str, str], list[dict]],
+) -> dict[str, dict]:
+    """What each chunk contributed to the graph, so it can be taken out again later.
+
+    Which elements these are is also in the ProvenanceIndex; the records keep the
+    descriptions, types, keywords and weights, so the elements can be merged again
+    from their remaining chunks without asking the LLM.
+
+    Relations are recorded under the (sorted) endpoints of the edge they were merged
+    into. Chunks without any extracted element get an empty record.
+    """
+    records = {chunk_key: {"entities": [], "relations": []} for chunk_key in chunk_keys}
+    for nodes in maybe_nodes.values():
+        for dp in nodes:
+            records[dp["source_id"]]["entities"].append(
+                dict(
+                    entity_name=dp["entity_name"],
+                    entity_type=dp["entity_type"],
+                    description=dp["description"],
+                )
+            )
+    for (src_id, tgt_id), edges in maybe_edges.items():
+        for dp in edges:
+            records[dp["source_id"]]["relations"].append(
+                dict(
+                    src_id=src_id,
+                    tgt_id=tgt_id,
+                    weight=dp["weight"],
+                    description=dp["description"],
+                    keywords=dp["keywords"],
+                )
+            )
+    return records
+
+
+async def remove_chunk_contributions(
+    removed_records: dict[str, dict],
+    knowledge_graph_inst: BaseGraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    chunk_extractions: BaseKVStorage,
+    global_config: dict,
+    provenance_index: ProvenanceIndex = None,
+    graph_locks: KeyedLock = None,
+) -> dict[str, int]:
+    """Take what the given chunks contributed out of the graph and the vector dbs.
+
+    removed_records maps each removed chunk to its group_graph_elements_by_chunk
+    record. Entities and relations left without a source chunk are deleted, the
+    others are merged again from the records of their remaining chunks and only
+    re-embedded if their description changed. When a remaining chunk has no record
+    (e.g. custom kg sources), the stored description is kept and only the removed
+    sources (and their weight) are subtracted.
+
+    Which elements a chunk contributed to is read from provenance_index; the
+    records only give what it contributed, and which elements for the chunks the
+    index does not know.
+    """
+    removed_ids = set(removed_records.keys())
+    affected_entities = set()
+    affected_relations = set()
+    for chunk_id, record in removed_records.items():
+        if provenance_index is not None and provenance_index.has_chunk(chunk_id):
+            affected_entities.update(provenance_index.chunk_entities(chunk_id))
+            affected_relations.update(provenance_index.chunk_relations(chunk_id))
+            continue
+        for dp in record["entities"]:
+            affected_entities.add(dp["entity_name"])
+        for dp in record["relations"]:
+            affected_relations.add((dp["src_id"], dp["tgt_id"]))
+            # endpoints created for an edge carry the edge's sources
+            affected_entities.update([dp["src_id"], dp["tgt_id"]])
+
+    stats = Counter()
+    entities_for_vdb = set()
+    relationships_for_vdb = set()
+    if graph_locks is None:
+        graph_locks = KeyedLock()
+
+    async def _remaining_records(source_ids: list[str]) -> Union[list[dict], None]:
+        records = await chunk_extractions.get_by_ids(source_ids)
+        if any(record is None for record in records):
+            return None
+        return records
+
+    async def _update_relation(src_id: str, tgt_id: str):
+        async with graph_locks.lock(relation_lock_key(src_id, tgt_id)):
+            await _update_relation_locked(src_id, tgt_id)
+
+    async def _update_relation_locked(src_id: str, tgt_id: str):
+        edge = await knowledge_graph_inst.get_edge_record(src_id, tgt_id)
+        if edge is None:
+            return
+        source_ids = _relation_source_ids(src_id, tgt_id, edge, provenance_index)
+        remaining_ids = [s for s in source_ids if s not in removed_ids]
+        if len(remaining_ids) == len(source_ids):
+            return
+        relation_id = compute_mdhash_id(src_id + tgt_id, prefix="rel-")
+        if provenance_index is not None:
+            provenance_index.set_relation_chunk_ids(src_id, tgt_id, remaining_ids)
+        if not remaining_ids:
+            await knowledge_graph_inst.delete_edge(src_id, tgt_id)
+            if relationships_vdb is not None:
+                await relationships_vdb.delete([relation_id])
+            stats["relations_deleted"] += 1
+            return
+
+        records = await _remaining_records(remaining_ids)
+        contributions = [
+            dp
+            for record in records or []
+            for dp in record["relations"]
+            if (dp["src_id"], dp["tgt_id"]) == (src_id, tgt_id)
+        ]
+        if contributions:
+            weight = sum(dp["weight"] for dp in contributions)
+            descriptions = sorted(set(dp["description"] for dp in contributions))
+            keywords = sorted(set(dp["keywords"] for dp in contributions))
+            description = GRAPH_FIELD_SEP.join(descriptions)
+            summary = await _handle_entity_relation_summary(
+                (src_id, tgt_id), description, global_config
+            )
+            if summary != description:
+                descriptions = [summary]
+        else:
+            weight = edge.weight - sum(
+                dp["weight"]
+                for chunk_id in source_ids
+                if chunk_id in removed_ids
+                for dp in removed_records[chunk_id]["relations"]
+                if (dp["src_id"], dp["tgt_id"]) == (src_id, tgt_id)
+            )
+            descriptions = edge.descriptions
+            keywords = edge.keywords
+        await knowledge_graph_inst.upsert_edge_record(
+            src_id,
+            tgt_id,
+            GraphEdgeRecord(weight, descriptions, keywords, remaining_ids),
+        )
+        if descriptions != edge.descriptions or keywords != edge.keywords:
+            relationships_for_vdb.add((src_id, tgt_id))
+        stats["relations_updated"] += 1
+
+    async def _update_entity(entity_name: str):
+        async with graph_locks.lock(entity_lock_key(entity_name)):
+            await _update_entity_locked(entity_name)
+
+    async def _update_entity_locked(entity_name: str):
+        node = await knowledge_graph_inst.get_node_record(entity_name)
+        if node is None:
+            return
+        source_ids = _entity_source_ids(entity_name, node, provenance_index)
+        remaining_ids = [s for s in source_ids if s not in removed_ids]
+        if len(remaining_ids) == len(source_ids):
+            return
+        entity_id = compute_mdhash_id(entity_name, prefix="ent-")
+        entity_type = node.entity_type
+        descriptions = node.descriptions
+        if not remaining_ids:
+            # still an endpoint of relations from other chunks, rebuild it from
+            # them the way _merge_edges_then_upsert creates missing endpoints
+            entity_type = '"UNKNOWN"'
+            descriptions = []
+            for edge_src, edge_tgt in (
+                await knowledge_graph_inst.get_node_edges(entity_name) or []
+            ):
+                edge = await knowledge_graph_inst.get_edge_record(edge_src, edge_tgt)
+                if edge is not None:
+                    remaining_ids.extend(
+                        _relation_source_ids(edge_src, edge_tgt, edge, provenance_index)
+                    )
+                    descriptions.extend(edge.descriptions)
+            remaining_ids = sorted(set(remaining_ids))
+            descriptions = sorted(set(descriptions))
+            if provenance_index is not None:
+                provenance_index.set_entity_chunk_ids(entity_name, remaining_ids)
+            if not remaining_ids:
+                await knowledge_graph_inst.delete_node(entity_name)
+                if entity_vdb is not None:
+                    await entity_vdb.delete([entity_id])
+                stats["entities_deleted"] += 1
+                return
+        else:
+            if provenance_index is not None:
+                provenance_index.set_entity_chunk_ids(entity_name, remaining_ids)
+            records = await _remaining_records(remaining_ids)
+            contributions = [
+                dp
+                for record in records or []
+                for dp in record["entities"]
+                if dp["entity_name"] == entity_name
+            ]
+            if contributions:
+                entity_type = Counter(
+                    dp["entity_type"] for dp in contributions
+                ).most_common(1)[0][0]
+                descriptions = sorted(set(dp["description"] for dp in contributions))
+                description = GRAPH_FIELD_SEP.join(descriptions)
+                summary = await _handle_entity_relation_summary(
+                    entity_name, description, global_config
+                )
+                if summary != description:
+                    descriptions = [summary]
+        await knowledge_graph_inst.upsert_node_record(
+            entity_name, GraphNodeRecord(entity_type, descriptions, remaining_ids)
+        )
+        if descriptions != node.descriptions:
+            entities_for_vdb.add(entity_name)
+        stats["entities_updated"] += 1
+
+    # relations first, so entities only kept alive by a relation see its final state
+    await asyncio.gather(*[_update_relation(*k) for k in affected_relations])
+    await asyncio.gather(*[_update_entity(k) for k in affected_entities])
+
+    await _upsert_graph_elements_vdb(
+        list(entities_for_vdb),
+        list(relationships_for_vdb),
+        knowledge_graph_inst,
+        entity_vdb,
+        relationships_vdb,
+        graph_locks,
+    )
+    stats["entities_reembedded"] = len(entities_for_vdb)
+    stats["relations_reembedded"] = len(relationships_for_vdb)
+    return dict(stats)
@@ -2,6 +2,12 @@ GRAPH_FIELD_SEP = "<SEP>"
 
 PROMPTS = {}
 
+# Prompts sent with variable content are split in two: PROMPTS[name] holds the
+# instructions and examples, which only depend on the configuration and are sent
+# as the system prompt, and PROMPTS[f"{name}_input"] the content of the call, sent
+# as the user message. Providers that cache prompt prefixes then reuse the
+# instructions across calls.
+
 PROMPTS["DEFAULT_LANGUAGE"] = "English"
 PROMPTS["DEFAULT_TUPLE_DELIMITER"] = "<|>"
 PROMPTS["DEFAULT_RECORD_DELIMITER"] = "##"
@@ -41,8 +47,9 @@ Format the content-level key words as ("content_keywords"{tuple_delimiter}<high_
 -Examples-
 ######################
 {examples}
+"""
 
-#############################
+PROMPTS["entity_extraction_input"] = """#############################
 -Real Data-
 ######################
 Entity_types: {entity_types}
@@ -51,6 +58,56 @@ Text: {input_text}
 Output:
 """
 
+PROMPTS["entity_extraction_packed"] = """-Goal-
+Given several text documents that are potentially relevant to this activity and a list of entity types, identify all entities of those types from each text and all relationships among the identified entities of the same text.
+Use {language} as output language.
+
+-Steps-
+1. Identify all entities. For each identified entity, extract the following information:
+- entity_name: Name of the entity, use same language as input text. If English, capitalized the name.
+- entity_type: One of the following types: [{entity_types}]
+- entity_description: Comprehensive description of the entity's attributes and activities
+Format each entity as ("entity"{tuple_delimiter}<entity_name>{tuple_delimiter}<entity_type>{tuple_delimiter}<entity_description>
+
+2. From the entities identified in step 1, identify all pairs of (source_entity, target_entity) that are *clearly related* to each other.
+For each pair of related entities, extract the following information:
+- source_entity: name of the source entity, as identified in step 1
+- target_entity: name of the target entity, as identified in step 1
+- relationship_description: explanation as to why you think the source entity and the target entity are related to each other
+- relationship_strength: a numeric score indicating strength of the relationship between the source entity and target entity
+- relationship_keywords: one or more high-level key words that summarize the overarching nature of the relationship, focusing on concepts or themes rather than specific details
+Format each relationship as ("relationship"{tuple_delimiter}<source_entity>{tuple_delimiter}<target_entity>{tuple_delimiter}<relationship_description>{tuple_delimiter}<relationship_keywords>{tuple_delimiter}<relationship_strength>)
+
+3. Identify high-level key words that summarize the main concepts, themes, or topics of each text. These should capture the overarching ideas present in the document.
+Format the content-level key words as ("content_keywords"{tuple_delimiter}<high_level_keywords>)
+
+4. Process the texts one after the other. Start the records of each text with ("text"{tuple_delimiter}<text_number>), where text_number is the number in the "-Text N-" header of the text, then list its entities, relationships and content-level key words. Never mix records of different texts.
+
+5. Return output in {language} as a single list of all the records. Use **{record_delimiter}** as the list delimiter.
+
+6. When finished, output {completion_delimiter}
+
+######################
+-Examples-
+######################
+Each example shows the records of a single text, without its ("text"{tuple_delimiter}<text_number>) record.
+
+{examples}
+"""
+
+PROMPTS["entity_extraction_packed_input"] = """#############################
+-Real Data-
+######################
+Entity_types: {entity_types}
+{input_text}
+######################
+Output:
+"""
+
+PROMPTS["entity_extraction_packed_text"] = """-Text {text_number}-
+{input_text}
+"""
+
 PROMPTS["entity_extraction_examples"] = [
     """Example 1:
 
@@ -132,8 +189,9 @@ Please concatenate all of these into a single, comprehensive description. Make s
 If the provided descriptions are contradictory, please resolve the contradictions and provide a single, coherent summary.
 Make sure it is written in third person, and include the entity names so we the have full context.
 Use {language} as output language.
+"""
 
-#######
+PROMPTS["summarize_entity_descriptions_input"] = """#######
 -Data-
 Entities: {entity_name}
 Description List: {description_list}
@@ -146,6 +204,11 @@ PROMPTS[
 ] = """MANY entities were missed in the last extraction.  Add them below using the same format:
 """
 
+PROMPTS[
+    "entiti_continue_extraction_packed"
+] = """MANY entities were missed in the last extraction.  Add them below using the same format, starting the records of each text with its ("text"{tuple_delimiter}<text_number>) record:
+"""
+
 PROMPTS[
     "entiti_if_loop_extraction"
 ] = """It appears some entities may have still been missed.  Answer YES | NO if there are still entities that need to be added.
@@ -163,8 +226,10 @@ You are a helpful assistant responding to questions about data in the tables pro
 Generate a response of the target length and format that responds to the user's question, summarizing all information in the input data tables appropriate for the response length and format, and incorporating any relevant general knowledge.
 If you don't know the answer, just say so. Do not make anything up.
 Do not include information where the supporting evidence for it is not provided.
+Add sections and commentary to the response as appropriate for the length and format. Style the response in markdown.
+"""
 
----Target response length and format---
+PROMPTS["rag_response_input"] = """---Target response length and format---
 
 {response_type}
 
@@ -172,7 +237,9 @@ Do not include information where the supporting evidence for it is not provided.
 
 {context_data}
 
-Add sections and commentary to the response as appropriate for the length and format. Style the response in markdown.
+---Question---
+
+{query}
 """
 
 PROMPTS["keywords_extraction"] = """---Role---
@@ -195,8 +262,9 @@ Given the query, list both high-level and low-level keywords. High-level keyword
 -Examples-
 ######################
 {examples}
+"""
 
-#############################
+PROMPTS["keywords_extraction_input"] = """#############################
 -Real Data-
 ######################
 Query: {query}
@@ -250,8 +318,10 @@ You are a helpful assistant responding to questions about documents provided.
 Generate a response of the target length and format that responds to the user's question, summarizing all information in the input data tables appropriate for the response length and format, and incorporating any relevant general knowledge.
 If you don't know the answer, just say so. Do not make anything up.
 Do not include information where the supporting evidence for it is not provided.
+Add sections and commentary to the response as appropriate for the length and format. Style the response in markdown.
+"""
 
----Target response length and format---
+PROMPTS["naive_rag_response_input"] = """---Target response length and format---
 
 {response_type}
 
@@ -259,5 +329,7 @@ Do not include information where the supporting evidence for it is not provided.
 
 {content_data}
 
-Add sections and commentary to the response as appropriate for the length and format. Style the response in markdown.
+---Question---
+
+{query}
 """
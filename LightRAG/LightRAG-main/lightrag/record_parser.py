@@ -0,0 +1,167 @@
+"""Parser for the entity and relationship records the LLM writes during extraction.
+
+An extraction response looks like
+
+    ("entity"<|>"ALICE"<|>"person"<|>"Alice is ...")##
+    ("relationship"<|>"ALICE"<|>"BOB"<|>"Alice knows Bob"<|>"friendship"<|>5)
+    <|COMPLETE|>
+
+With the packed extraction prompt, a ("text"<|>N) record starts the records of
+the N-th chunk of the request.
+
+This is plain synchronous string work run for every chunk, so the patterns are
+compiled once and the fields are split with str methods.
+"""
+
+import html
+import re
+from collections import defaultdict
+from functools import lru_cache
+from typing import Union
+
+from .prompt import PROMPTS
+
+_CONTROL_CHARS = re.compile(r"[\x00-\x1f\x7f-\x9f]")
+_FLOAT = re.compile(r"[-+]?[0-9]*\.?[0-9]+")
+
+
+@lru_cache(maxsize=None)
+def _record_splitter(record_delimiter: str, completion_delimiter: str) -> re.Pattern:
+    return re.compile(
+        f"{re.escape(record_delimiter)}|{re.escape(completion_delimiter)}"
+    )
+
+
+def clean_field(value: str) -> str:
+    """Same as utils.clean_str for strings: unescape HTML and drop control characters"""
+    value = value.strip()
+    if "&" in value:
+        value = html.unescape(value)
+    return _CONTROL_CHARS.sub("", value)
+
+
+def split_record_fields(record: str, tuple_delimiter: str) -> Union[list[str], None]:
+    """The fields of one record, None if it has no parenthesised body.
+
+    Fields keep their position, so an empty field doesn't shift the ones after it;
+    only empty trailing fields (e.g. a delimiter before the closing parenthesis)
+    are dropped.
+    """
+    start = record.find("(")
+    end = record.rfind(")")
+    if start < 0 or end <= start:
+        return None
+    fields = [f.strip() for f in record[start + 1 : end].split(tuple_delimiter)]
+    while fields and not fields[-1]:
+        fields.pop()
+    return fields
+
+
+def _record_type(fields: list[str]) -> str:
+    return fields[0].strip("\"'").lower() if fields else ""
+
+
+def _is_empty_name(name: str) -> bool:
+    return not name.strip('"').strip()
+
+
+def parse_entity_record(fields: list[str], chunk_key: str) -> Union[dict, None]:
+    if len(fields) < 4 or _record_type(fields) != "entity":
+        return None
+    entity_name = clean_field(fields[1].upper())
+    if _is_empty_name(entity_name):
+        return None
+    return dict(
+        entity_name=entity_name,
+        entity_type=clean_field(fields[2].upper()),
+        description=clean_field(fields[3]),
+        source_id=chunk_key,
+    )
+
+
+def parse_relationship_record(fields: list[str], chunk_key: str) -> Union[dict, None]:
+    if len(fields) < 5 or _record_type(fields) != "relationship":
+        return None
+    source = clean_field(fields[1].upper())
+    target = clean_field(fields[2].upper())
+    if _is_empty_name(source) or _is_empty_name(target):
+        return None
+    weight = fields[-1].strip("\"'")
+    return dict(
+        src_id=source,
+        tgt_id=target,
+        weight=float(weight) if _FLOAT.fullmatch(weight) else 1.0,
+        description=clean_field(fields[3]),
+        keywords=clean_field(fields[4]),
+        source_id=chunk_key,
+    )
+
+
+def _add_record(
+    fields: list[str],
+    chunk_key: str,
+    maybe_nodes: dict[str, list[dict]],
+    maybe_edges: dict[tuple[str, str], list[dict]],
+):
+    entity = parse_entity_record(fields, chunk_key)
+    if entity is not None:
+        maybe_nodes[entity["entity_name"]].append(entity)
+        return
+    relation = parse_relationship_record(fields, chunk_key)
+    if relation is not None:
+        maybe_edges[(relation["src_id"], relation["tgt_id"])].append(relation)
+
+
+def parse_extraction_records(
+    content: str,
+    chunk_key: str,
+    tuple_delimiter: str = PROMPTS["DEFAULT_TUPLE_DELIMITER"],
+    record_delimiter: str = PROMPTS["DEFAULT_RECORD_DELIMITER"],
+    completion_delimiter: str = PROMPTS["DEFAULT_COMPLETION_DELIMITER"],
+) -> tuple[dict[str, list[dict]], dict[tuple[str, str], list[dict]]]:
+    """Entities by name and relationships by (source, target) found in an LLM response.
+
+    Records that can't be parsed (no parentheses, unknown type, missing fields or
+    empty names) are skipped.
+    """
+    maybe_nodes = defaultdict(list)
+    maybe_edges = defaultdict(list)
+    for record in _record_splitter(record_delimiter, completion_delimiter).split(
+        content
+    ):
+        fields = split_record_fields(record, tuple_delimiter)
+        if fields:
+            _add_record(fields, chunk_key, maybe_nodes, maybe_edges)
+    return dict(maybe_nodes), dict(maybe_edges)
+
+
+def parse_packed_extraction_records(
+    content: str,
+    chunk_keys: list[str],
+    tuple_delimiter: str = PROMPTS["DEFAULT_TUPLE_DELIMITER"],
+    record_delimiter: str = PROMPTS["DEFAULT_RECORD_DELIMITER"],
+    completion_delimiter: str = PROMPTS["DEFAULT_COMPLETION_DELIMITER"],
+) -> list[tuple[dict[str, list[dict]], dict[tuple[str, str], list[dict]]]]:
+    """The (nodes, edges) of each chunk of a response to the packed extraction prompt.
+
+    A ("text"<|>N) record assigns the records after it to chunk_keys[N - 1]; the
+    records before the first one go to the first chunk, those after an unknown
+    text number are skipped.
+    """
+    sections = [(defaultdict(list), defaultdict(list)) for _ in chunk_keys]
+    current = 0
+    for record in _record_splitter(record_delimiter, completion_delimiter).split(
+        content
+    ):
+        fields = split_record_fields(record, tuple_delimiter)
+        if not fields:
+            continue
+        if _record_type(fields) == "text":
+            number = fields[1].strip("\"'") if len(fields) > 1 else ""
+            current = int(number) - 1 if number.isdigit() else None
+            if current is not None and not 0 <= current < len(chunk_keys):
+                current = None
+            continue
+        if current is not None:
+            _add_record(fields, chunk_keys[current], *sections[current])
+    return [(dict(nodes), dict(edges)) for nodes, edges in sections]
@@ -1,16 +1,24 @@
 import asyncio
+import glob
 import html
+import json
 import os
+import sys
+from array import array
+from collections import defaultdict
 from tqdm.asyncio import tqdm as tqdm_async
 from dataclasses import dataclass
-from typing import Any, Union, cast
+from typing import Any, Callable, Iterator, Union, cast
 import networkx as nx
 import numpy as np
 from nano_vectordb import NanoVectorDB
+from nano_vectordb.dbs import array_to_buffer_string, buffer_string_to_array
 
 from .utils import (
     logger,
+    fsync_dir,
     load_json,
+    write_file_atomic,
     write_json,
     compute_mdhash_id,
 )
@@ -19,22 +27,225 @@ from .base import (
     BaseGraphStorage,
     BaseKVStorage,
     BaseVectorStorage,
+    GraphEdgeRecord,
+    GraphNodeRecord,
+    StorageNameSpace,
 )
 
 
+class StorageFlushScheduler:
+    """Coalesce storage writes into debounced background flushes.
+
+    Storages are marked dirty instead of being written right away. A background task
+    writes every dirty storage once, `flush_interval` seconds after the first mark, or
+    as soon as `max_pending` marks have piled up. `flush_interval <= 0` writes on every
+    mark, like calling index_done_callback directly.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, max_pending: int = 100):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._dirty: dict[int, StorageNameSpace] = {}
+        self._pending = 0
+        self._task: Union[asyncio.Task, None] = None
+        self._wakeup: Union[asyncio.Event, None] = None
+        self._lock: Union[asyncio.Lock, None] = None
+
+    async def mark_dirty(self, *storages: StorageNameSpace):
+        for storage in storages:
+            if storage is not None:
+                self._dirty[id(storage)] = storage
+        self._pending += 1
+        if self.flush_interval <= 0:
+            await self.flush()
+            return
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._flush_later())
+        if self._pending >= self.max_pending:
+            self._wakeup.set()
+
+    async def _flush_later(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        # marks arriving while this flush runs schedule the next one
+        self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # nobody awaits this task; the failed storages stay dirty for the next flush
+            logger.error(f"Background storage flush failed: {e!r}")
+
+    async def flush(self):
+        """Write every dirty storage now"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            dirty, self._dirty, self._pending = list(self._dirty.values()), {}, 0
+            if not dirty:
+                return
+            logger.debug(f"Flushing {len(dirty)} storages")
+            results = await asyncio.gather(
+                *[storage.index_done_callback() for storage in dirty],
+                return_exceptions=True,
+            )
+            failed = [
+                (storage, result)
+                for storage, result in zip(dirty, results)
+                if isinstance(result, BaseException)
+            ]
+            if failed:
+                # retried by the next flush, unless marked again before
+                for storage, _ in failed:
+                    self._dirty.setdefault(id(storage), storage)
+                self._pending += len(failed)
+                raise failed[0][1]
+
+
+class WriteAheadLog:
+    """Journal of the updates a file-backed storage made since its last checkpoint.
+
+    Updates are appended as JSON lines to `<file>.wal.<seq>` segments. A checkpoint
+    starts a new segment in the same step as the in-memory snapshot is taken, writes
+    the snapshot atomically, then removes the segments it covers, so updates made
+    while the snapshot is being written are never lost. On load the remaining
+    segments are replayed over the last snapshot.
+    """
+
+    def __init__(self, file_name: str, enabled: bool = True, fsync: bool = False):
+        self._file_name = file_name
+        self._enabled = enabled
+        self._fsync = fsync
+        self._file = None
+        self._lock: Union[asyncio.Lock, None] = None
+        # leftovers of a snapshot write that was interrupted before its rename
+        for tmp_file_name in glob.glob(
+            os.path.join(
+                glob.escape(os.path.dirname(file_name) or "."),
+                f".{glob.escape(os.path.basename(file_name))}.*.tmp",
+            )
+        ):
+            os.remove(tmp_file_name)
+        # never append to a segment left by a crash, its last line may be torn
+        self._seq = max((seq for seq, _ in self._segments()), default=0) + 1
+
+    def _segments(self) -> list[tuple[int, str]]:
+        segments = []
+        for path in glob.glob(f"{glob.escape(self._file_name)}.wal.*"):
+            seq = path.rsplit(".", 1)[-1]
+            if seq.isdigit():
+                segments.append((int(seq), path))
+        return sorted(segments)
+
+    def replay(self) -> Iterator[dict]:
+        for _, path in self._segments():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # only the last append of a crashed process can be torn
+                        logger.warning(
+                            f"Ignoring incomplete record at the end of {path}"
+                        )
+                        break
+
+    def append(self, record: dict):
+        if not self._enabled:
+            return
+        if self._file is None:
+            self._file = open(
+                f"{self._file_name}.wal.{self._seq}", "a", encoding="utf-8"
+            )
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+
+    async def checkpoint(
+        self, take_snapshot: Callable[[], Any], write_snapshot: Callable[[Any], None]
+    ):
+        """Write a full snapshot and drop the journal segments it makes redundant.
+
+        take_snapshot runs on the event loop and must not await, write_snapshot runs
+        in a worker thread.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            snapshot = take_snapshot()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            covered_seq, self._seq = self._seq, self._seq + 1
+            await asyncio.to_thread(write_snapshot, snapshot)
+            self._remove_segments(covered_seq)
+
+    def compact(self, snapshot: Any, write_snapshot: Callable[[Any], None]):
+        """Fold the segments replayed on load into a new snapshot"""
+        write_snapshot(snapshot)
+        self._remove_segments(self._seq - 1)
+
+    def _remove_segments(self, up_to_seq: int):
+        removed = False
+        for seq, path in self._segments():
+            if seq <= up_to_seq:
+                os.remove(path)
+                removed = True
+        if removed:
+            fsync_dir(os.path.dirname(self._file_name) or ".")
+
+
+def _open_wal(file_name: str, global_config: dict) -> WriteAheadLog:
+    return WriteAheadLog(
+        file_name,
+        enabled=global_config.get("enable_storage_wal", True),
+        fsync=global_config.get("storage_wal_fsync", False),
+    )
+
+
 @dataclass
 class JsonKVStorage(BaseKVStorage):
     def __post_init__(self):
         working_dir = self.global_config["working_dir"]
         self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.json")
         self._data = load_json(self._file_name) or {}
+        self._wal = _open_wal(self._file_name, self.global_config)
+        recovered = 0
+        for record in self._wal.replay():
+            if record["op"] == "upsert":
+                self._data.update(record["data"])
+            elif record["op"] == "delete":
+                for id in record["ids"]:
+                    self._data.pop(id, None)
+            elif record["op"] == "drop":
+                self._data = {}
+            recovered += 1
+        if recovered:
+            logger.info(
+                f"Recovered {recovered} updates of KV {self.namespace} from WAL"
+            )
+            self._wal.compact(self._take_snapshot(), self._write_snapshot)
         logger.info(f"Load KV {self.namespace} with {len(self._data)} data")
 
     async def all_keys(self) -> list[str]:
         return list(self._data.keys())
 
     async def index_done_callback(self):
-        write_json(self._data, self._file_name)
+        # serialise a snapshot off the event loop so large stores (e.g. the LLM
+        # cache) don't stall concurrent queries while being written
+        await self._wal.checkpoint(self._take_snapshot, self._write_snapshot)
+
+    def _take_snapshot(self) -> dict:
+        return dict(self._data)
+
+    def _write_snapshot(self, snapshot: dict):
+        write_json(snapshot, self._file_name)
 
     async def get_by_id(self, id):
         return self._data.get(id, None)
@@ -57,10 +268,18 @@ class JsonKVStorage(BaseKVStorage):
     async def upsert(self, data: dict[str, dict]):
         left_data = {k: v for k, v in data.items() if k not in self._data}
         self._data.update(left_data)
+        if left_data:
+            self._wal.append({"op": "upsert", "data": left_data})
         return left_data
 
+    async def delete(self, ids: list[str]):
+        ids = [id for id in ids if self._data.pop(id, None) is not None]
+        if ids:
+            self._wal.append({"op": "delete", "ids": ids})
+
     async def drop(self):
         self._data = {}
+        self._wal.append({"op": "drop"})
 
 
 @dataclass
@@ -78,6 +297,60 @@ class NanoVectorDBStorage(BaseVectorStorage):
         self.cosine_better_than_threshold = self.global_config.get(
             "cosine_better_than_threshold", self.cosine_better_than_threshold
         )
+        # relation ids by endpoint, so the relations of an entity are found
+        # without scanning every vector
+        self._relation_endpoints: dict[str, tuple[str, str]] = {}
+        self._relation_ids_by_entity: dict[str, set[str]] = defaultdict(set)
+        self._index_relations(self.client_storage["data"])
+        self._wal = _open_wal(self._client_file_name, self.global_config)
+        recovered = 0
+        for record in self._wal.replay():
+            if record["op"] == "upsert":
+                self._client_upsert(
+                    record["data"],
+                    buffer_string_to_array(record["matrix"]).reshape(
+                        len(record["data"]), self.embedding_func.embedding_dim
+                    ),
+                )
+            elif record["op"] == "delete":
+                self._client.delete(record["ids"])
+                self._unindex_relations(record["ids"])
+            recovered += 1
+        if recovered:
+            logger.info(
+                f"Recovered {recovered} updates of vdb {self.namespace} from WAL"
+            )
+            self._wal.compact(self._take_snapshot(), self._write_snapshot)
+
+    def _client_upsert(self, list_data: list[dict], embeddings: np.ndarray):
+        self._index_relations(list_data)
+        return self._client.upsert(
+            datas=[{**d, "__vector__": embeddings[i]} for i, d in enumerate(list_data)]
+        )
+
+    def _client_delete(self, ids: list[str]):
+        self._client.delete(ids)
+        self._unindex_relations(ids)
+        self._wal.append({"op": "delete", "ids": ids})
+
+    def _index_relations(self, list_data: list[dict]):
+        for dp in list_data:
+            if "src_id" not in dp or "tgt_id" not in dp:
+                continue
+            self._unindex_relations([dp["__id__"]])
+            self._relation_endpoints[dp["__id__"]] = (dp["src_id"], dp["tgt_id"])
+            self._relation_ids_by_entity[dp["src_id"]].add(dp["__id__"])
+            self._relation_ids_by_entity[dp["tgt_id"]].add(dp["__id__"])
+
+    def _unindex_relations(self, ids: list[str]):
+        for id in ids:
+            for entity_name in self._relation_endpoints.pop(id, ()):
+                relation_ids = self._relation_ids_by_entity.get(entity_name)
+                if relation_ids is None:
+                    continue
+                relation_ids.discard(id)
+                if not relation_ids:
+                    del self._relation_ids_by_entity[entity_name]
 
     async def upsert(self, data: dict[str, dict]):
         logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
@@ -107,9 +380,14 @@ class NanoVectorDBStorage(BaseVectorStorage):
             embeddings = await f
             embeddings_list.append(embeddings)
         embeddings = np.concatenate(embeddings_list)
-        for i, d in enumerate(list_data):
-            d["__vector__"] = embeddings[i]
-        results = self._client.upsert(datas=list_data)
+        results = self._client_upsert(list_data, embeddings)
+        self._wal.append(
+            {
+                "op": "upsert",
+                "data": list_data,
+                "matrix": array_to_buffer_string(embeddings.astype(np.float32)),
+            }
+        )
         return results
 
     async def query(self, query: str, top_k=5):
@@ -125,6 +403,12 @@ class NanoVectorDBStorage(BaseVectorStorage):
         ]
         return results
 
+    async def delete(self, ids: list[str]):
+        ids = set(ids)
+        existing_ids = [dp["__id__"] for dp in self._client.get(ids)]
+        if existing_ids:
+            self._client_delete(existing_ids)
+
     @property
     def client_storage(self):
         return getattr(self._client, "_NanoVectorDB__storage")
@@ -134,7 +418,7 @@ class NanoVectorDBStorage(BaseVectorStorage):
             entity_id = [compute_mdhash_id(entity_name, prefix="ent-")]
 
             if self._client.get(entity_id):
-                self._client.delete(entity_id)
+                self._client_delete(entity_id)
                 logger.info(f"Entity {entity_name} have been deleted.")
             else:
                 logger.info(f"No entity found with name {entity_name}.")
@@ -143,15 +427,10 @@ class NanoVectorDBStorage(BaseVectorStorage):
 
     async def delete_relation(self, entity_name: str):
         try:
-            relations = [
-                dp
-                for dp in self.client_storage["data"]
-                if dp["src_id"] == entity_name or dp["tgt_id"] == entity_name
-            ]
-            ids_to_delete = [relation["__id__"] for relation in relations]
+            ids_to_delete = list(self._relation_ids_by_entity.get(entity_name, ()))
 
             if ids_to_delete:
-                self._client.delete(ids_to_delete)
+                self._client_delete(ids_to_delete)
                 logger.info(
                     f"All relations related to entity {entity_name} have been deleted."
                 )
@@ -163,7 +442,21 @@ class NanoVectorDBStorage(BaseVectorStorage):
             )
 
     async def index_done_callback(self):
-        self._client.save()
+        # the matrix is encoded on the event loop, only the JSON dump and the
+        # atomic replace run off it
+        await self._wal.checkpoint(self._take_snapshot, self._write_snapshot)
+
+    def _take_snapshot(self) -> dict:
+        # same file format as NanoVectorDB.save()
+        storage = self.client_storage
+        return {
+            **storage,
+            "data": list(storage["data"]),
+            "matrix": array_to_buffer_string(storage["matrix"]),
+        }
+
+    def _write_snapshot(self, snapshot: dict):
+        write_json(snapshot, self._client_file_name, indent=None)
 
 
 @dataclass
@@ -179,7 +472,7 @@ class NetworkXStorage(BaseGraphStorage):
         logger.info(
             f"Writing graph with {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges"
         )
-        nx.write_graphml(graph, file_name)
+        write_file_atomic(file_name, lambda f: nx.write_graphml(graph, f), mode="wb")
 
     @staticmethod
     def stable_largest_connected_component(graph: nx.Graph) -> nx.Graph:
@@ -238,13 +531,151 @@ class NetworkXStorage(BaseGraphStorage):
             logger.info(
                 f"Loaded graph from {self._graphml_xml_file} with {preloaded_graph.number_of_nodes()} nodes, {preloaded_graph.number_of_edges()} edges"
             )
-        self._graph = preloaded_graph or nx.Graph()
+        self._strings = _StringTable()
+        self._graph = nx.Graph()
+        if preloaded_graph is not None:
+            # the joined strings of the file are split once here, in memory nodes
+            # and edges only hold a packed record
+            for node_id, node_data in preloaded_graph.nodes(data=True):
+                self._graph.add_node(node_id, record=self._pack_node_data(node_data))
+            for src_id, tgt_id, edge_data in preloaded_graph.edges(data=True):
+                self._graph.add_edge(
+                    src_id, tgt_id, record=self._pack_edge_data(edge_data)
+                )
         self._node_embed_algorithms = {
             "node2vec": self._node2vec_embed,
         }
+        self._wal = _open_wal(self._graphml_xml_file, self.global_config)
+        recovered = 0
+        for record in self._wal.replay():
+            if record["op"] == "upsert_node":
+                self._graph.add_node(
+                    record["id"], record=self._pack_node_data(record["data"])
+                )
+            elif record["op"] == "upsert_edge":
+                self._graph.add_edge(
+                    record["src"],
+                    record["tgt"],
+                    record=self._pack_edge_data(record["data"]),
+                )
+            elif record["op"] == "upsert_node_record":
+                self._graph.add_node(
+                    record["id"],
+                    record=self._pack_node(
+                        GraphNodeRecord(**record["record"]),
+                        self._node_extra(record["id"]),
+                    ),
+                )
+            elif record["op"] == "upsert_edge_record":
+                self._graph.add_edge(
+                    record["src"],
+                    record["tgt"],
+                    record=self._pack_edge(
+                        GraphEdgeRecord(**record["record"]),
+                        self._edge_extra(record["src"], record["tgt"]),
+                    ),
+                )
+            elif record["op"] == "delete_node":
+                if self._graph.has_node(record["id"]):
+                    self._graph.remove_node(record["id"])
+            elif record["op"] == "delete_edge":
+                if self._graph.has_edge(record["src"], record["tgt"]):
+                    self._graph.remove_edge(record["src"], record["tgt"])
+            recovered += 1
+        if recovered:
+            logger.info(
+                f"Recovered {recovered} updates of graph {self.namespace} from WAL"
+            )
+            self._wal.compact(self._take_snapshot(), self._write_snapshot)
 
     async def index_done_callback(self):
-        NetworkXStorage.write_nx_graph(self._graph, self._graphml_xml_file)
+        # packed records are replaced, never changed in place, so listing them is
+        # enough of a snapshot; converting to joined strings and serialising the
+        # graph happen off the event loop
+        await self._wal.checkpoint(self._take_snapshot, self._write_snapshot)
+
+    def _take_snapshot(self) -> tuple[list, list]:
+        return (
+            list(self._graph.nodes(data="record")),
+            list(self._graph.edges(data="record")),
+        )
+
+    def _write_snapshot(self, snapshot: tuple[list, list]):
+        NetworkXStorage.write_nx_graph(
+            self._export_graph(*snapshot), self._graphml_xml_file
+        )
+
+    def _export_graph(self, nodes: list, edges: list) -> nx.Graph:
+        """The graph with the legacy GRAPH_FIELD_SEP-joined attributes"""
+        graph = nx.Graph()
+        graph.add_nodes_from(
+            (node_id, self._unpack_node_data(packed)) for node_id, packed in nodes
+        )
+        graph.add_edges_from(
+            (src_id, tgt_id, self._unpack_edge_data(packed))
+            for src_id, tgt_id, packed in edges
+        )
+        return graph
+
+    def _pack_node(
+        self, record: GraphNodeRecord, extra: Union[dict, None] = None
+    ) -> "_PackedNode":
+        return _PackedNode(
+            sys.intern(record.entity_type),
+            tuple(record.descriptions),
+            self._strings.encode(record.source_ids),
+            extra,
+        )
+
+    def _pack_edge(
+        self, record: GraphEdgeRecord, extra: Union[dict, None] = None
+    ) -> "_PackedEdge":
+        return _PackedEdge(
+            record.weight,
+            tuple(record.descriptions),
+            self._strings.encode(record.keywords),
+            self._strings.encode(record.source_ids),
+            extra,
+        )
+
+    def _unpack_node(self, packed: "_PackedNode") -> GraphNodeRecord:
+        return GraphNodeRecord(
+            packed.entity_type,
+            list(packed.descriptions),
+            self._strings.decode(packed.source_ids),
+        )
+
+    def _unpack_edge(self, packed: "_PackedEdge") -> GraphEdgeRecord:
+        return GraphEdgeRecord(
+            packed.weight,
+            list(packed.descriptions),
+            self._strings.decode(packed.keywords),
+            self._strings.decode(packed.source_ids),
+        )
+
+    def _pack_node_data(self, node_data: dict) -> "_PackedNode":
+        extra = {k: v for k, v in node_data.items() if k not in _NODE_RECORD_FIELDS}
+        return self._pack_node(GraphNodeRecord.from_node_data(node_data), extra or None)
+
+    def _pack_edge_data(self, edge_data: dict) -> "_PackedEdge":
+        extra = {k: v for k, v in edge_data.items() if k not in _EDGE_RECORD_FIELDS}
+        return self._pack_edge(GraphEdgeRecord.from_edge_data(edge_data), extra or None)
+
+    def _unpack_node_data(self, packed: "_PackedNode") -> dict:
+        return {**(packed.extra or {}), **self._unpack_node(packed).to_node_data()}
+
+    def _unpack_edge_data(self, packed: "_PackedEdge") -> dict:
+        return {**(packed.extra or {}), **self._unpack_edge(packed).to_edge_data()}
+
+    def _node_extra(self, node_id: str) -> Union[dict, None]:
+        if not self._graph.has_node(node_id):
+            return None
+        return self._graph.nodes[node_id]["record"].extra
+
+    def _edge_extra(self, src_id: str, tgt_id: str) -> Union[dict, None]:
+        if not self._graph.has_edge(src_id, tgt_id):
+            return None
+        return self._graph.edges[src_id, tgt_id]["record"].extra
 
     async def has_node(self, node_id: str) -> bool:
         return self._graph.has_node(node_id)
@@ -253,7 +684,17 @@ class NetworkXStorage(BaseGraphStorage):
         return self._graph.has_edge(source_node_id, target_node_id)
 
     async def get_node(self, node_id: str) -> Union[dict, None]:
-        return self._graph.nodes.get(node_id)
+        if not self._graph.has_node(node_id):
+            return None
+        return self._unpack_node_data(self._graph.nodes[node_id]["record"])
+
+    async def get_node_record(self, node_id: str) -> Union[GraphNodeRecord, None]:
+        if not self._graph.has_node(node_id):
+            return None
+        return self._unpack_node(self._graph.nodes[node_id]["record"])
+
+    async def node_ids(self) -> list[str]:
+        return list(self._graph.nodes)
 
     async def node_degree(self, node_id: str) -> int:
         return self._graph.degree(node_id)
@@ -264,7 +705,20 @@ class NetworkXStorage(BaseGraphStorage):
     async def get_edge(
         self, source_node_id: str, target_node_id: str
     ) -> Union[dict, None]:
-        return self._graph.edges.get((source_node_id, target_node_id))
+        if not self._graph.has_edge(source_node_id, target_node_id):
+            return None
+        return self._unpack_edge_data(
+            self._graph.edges[source_node_id, target_node_id]["record"]
+        )
+
+    async def get_edge_record(
+        self, source_node_id: str, target_node_id: str
+    ) -> Union[GraphEdgeRecord, None]:
+        if not self._graph.has_edge(source_node_id, target_node_id):
+            return None
+        return self._unpack_edge(
+            self._graph.edges[source_node_id, target_node_id]["record"]
+        )
 
     async def get_node_edges(self, source_node_id: str):
         if self._graph.has_node(source_node_id):
@@ -272,12 +726,67 @@ class NetworkXStorage(BaseGraphStorage):
         return None
 
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
-        self._graph.add_node(node_id, **node_data)
+        if self._graph.has_node(node_id):
+            # like networkx's add_node, attributes not given are kept
+            node_data = {
+                **self._unpack_node_data(self._graph.nodes[node_id]["record"]),
+                **node_data,
+            }
+        self._graph.add_node(node_id, record=self._pack_node_data(node_data))
+        self._wal.append({"op": "upsert_node", "id": node_id, "data": node_data})
 
     async def upsert_edge(
         self, source_node_id: str, target_node_id: str, edge_data: dict[str, str]
     ):
-        self._graph.add_edge(source_node_id, target_node_id, **edge_data)
+        if self._graph.has_edge(source_node_id, target_node_id):
+            edge_data = {
+                **self._unpack_edge_data(
+                    self._graph.edges[source_node_id, target_node_id]["record"]
+                ),
+                **edge_data,
+            }
+        self._graph.add_edge(
+            source_node_id, target_node_id, record=self._pack_edge_data(edge_data)
+        )
+        self._wal.append(
+            {
+                "op": "upsert_edge",
+                "src": source_node_id,
+                "tgt": target_node_id,
+                "data": edge_data,
+            }
+        )
+
+    async def upsert_node_record(self, node_id: str, record: GraphNodeRecord):
+        self._graph.add_node(
+            node_id, record=self._pack_node(record, self._node_extra(node_id))
+        )
+        self._wal.append(
+            {
+                "op": "upsert_node_record",
+                "id": node_id,
+                "record": {k: getattr(record, k) for k in GraphNodeRecord.__slots__},
+            }
+        )
+
+    async def upsert_edge_record(
+        self, source_node_id: str, target_node_id: str, record: GraphEdgeRecord
+    ):
+        self._graph.add_edge(
+            source_node_id,
+            target_node_id,
+            record=self._pack_edge(
+                record, self._edge_extra(source_node_id, target_node_id)
+            ),
+        )
+        self._wal.append(
+            {
+                "op": "upsert_edge_record",
+                "src": source_node_id,
+                "tgt": target_node_id,
+                "record": {k: getattr(record, k) for k in GraphEdgeRecord.__slots__},
+            }
+        )
 
     async def delete_node(self, node_id: str):
         """
@@ -287,10 +796,23 @@ class NetworkXStorage(BaseGraphStorage):
         """
         if self._graph.has_node(node_id):
             self._graph.remove_node(node_id)
+            self._wal.append({"op": "delete_node", "id": node_id})
             logger.info(f"Node {node_id} deleted from the graph.")
         else:
             logger.warning(f"Node {node_id} not found in the graph for deletion.")
 
+    async def delete_edge(self, source_node_id: str, target_node_id: str):
+        if self._graph.has_edge(source_node_id, target_node_id):
+            self._graph.remove_edge(source_node_id, target_node_id)
+            self._wal.append(
+                {"op": "delete_edge", "src": source_node_id, "tgt": target_node_id}
+            )
+
+    async def rebuild_degrees(self):
+        # networkx keeps the adjacency of every node up to date on add/remove,
+        # so node_degree is already a lookup and there is nothing to recompute
+        return None
+
     async def embed_nodes(self, algorithm: str) -> tuple[np.ndarray, list[str]]:
         if algorithm not in self._node_embed_algorithms:
             raise ValueError(f"Node embedding algorithm {algorithm} not supported")
@@ -307,3 +829,250 @@ class NetworkXStorage(BaseGraphStorage):
 
         nodes_ids = [self._graph.nodes[node_id]["id"] for node_id in nodes]
         return embeddings, nodes_ids
+
+
+_NODE_RECORD_FIELDS = ("entity_type", "description", "source_id")
+_EDGE_RECORD_FIELDS = ("weight", "description", "keywords", "source_id")
+
+
+class _StringTable:
+    """Append-only table interning strings to integer ids.
+
+    Chunk ids and relation keywords repeat across many nodes and edges, each is
+    stored once here and referenced by a 4 byte id. Descriptions are mostly unique
+    and replaced by every merge summary, so they are kept as plain strings rather
+    than piling up here.
+    """
+
+    def __init__(self):
+        self._strings: list[str] = []
+        self._ids: dict[str, int] = {}
+
+    def encode(self, strings: list[str]) -> array:
+        ids = array("I")
+        for string in strings:
+            string_id = self._ids.get(string)
+            if string_id is None:
+                string_id = self._ids[string] = len(self._strings)
+                self._strings.append(string)
+            ids.append(string_id)
+        return ids
+
+    def decode(self, ids: array) -> list[str]:
+        strings = self._strings
+        return [strings[i] for i in ids]
+
+
+class _PackedNode:
+    __slots__ = ("entity_type", "descriptions", "source_ids", "extra")
+
+    def __init__(self, entity_type, descriptions, source_ids, extra):
+        self.entity_type = entity_type
+        self.descriptions = descriptions
+        self.source_ids = source_ids
+        # attributes other than the record fields, None for extracted nodes
+        self.extra = extra
+
+
+class _PackedEdge:
+    __slots__ = ("weight", "descriptions", "keywords", "source_ids", "extra")
+
+    def __init__(self, weight, descriptions, keywords, source_ids, extra):
+        self.weight = weight
+        self.descriptions = descriptions
+        self.keywords = keywords
+        self.source_ids = source_ids
+        self.extra = extra
+
+
+class _InternedSources:
+    """Elements interned to integer ids, with their source chunks in both directions"""
+
+    def __init__(self):
+        # element id -> key, None once the element is removed
+        self.keys: list = []
+        self.index: dict = {}
+        # element id -> chunk ids, chunk id -> element ids
+        self.sources: list[set[int]] = []
+        self.by_chunk: dict[int, set[int]] = defaultdict(set)
+        # bumped when an element is added or removed
+        self.version = 0
+
+    def get(self, key) -> Union[set[int], None]:
+        element_id = self.index.get(key)
+        return None if element_id is None else self.sources[element_id]
+
+    def set(self, key, chunk_ids: set[int]) -> set[int]:
+        """Replace the sources of an element, removing it when there are none.
+        Returns the chunks that lost this element as a derived element."""
+        element_id = self.index.get(key)
+        if element_id is None:
+            if not chunk_ids:
+                return set()
+            element_id = len(self.keys)
+            self.keys.append(key)
+            self.sources.append(set())
+            self.index[key] = element_id
+            self.version += 1
+        old_chunk_ids = self.sources[element_id]
+        for chunk_id in old_chunk_ids - chunk_ids:
+            self.by_chunk[chunk_id].discard(element_id)
+            if not self.by_chunk[chunk_id]:
+                del self.by_chunk[chunk_id]
+        for chunk_id in chunk_ids - old_chunk_ids:
+            self.by_chunk[chunk_id].add(element_id)
+        self.sources[element_id] = set(chunk_ids)
+        if not chunk_ids:
+            self.keys[element_id] = None
+            del self.index[key]
+            self.version += 1
+        return old_chunk_ids - chunk_ids
+
+    def chunk_elements(self, chunk_id: int) -> list:
+        return [self.keys[e] for e in self.by_chunk.get(chunk_id, ())]
+
+
+@dataclass
+class ProvenanceIndex(StorageNameSpace):
+    """Which chunks every entity and relation was extracted from, and the reverse.
+
+    The source_id strings on graph nodes and edges only answer the first question
+    and have to be split again on every read. Here chunk ids, entity names and
+    relations are interned to integer ids with posting sets in both directions. The
+    index is a JSON file in the working dir whatever the graph storage is, journaled
+    like the other file-backed storages. Relations are keyed by sorted endpoints.
+    """
+
+    def __post_init__(self):
+        self._file_name = os.path.join(
+            self.global_config["working_dir"], f"provenance_{self.namespace}.json"
+        )
+        self._chunk_keys: list[Union[str, None]] = []
+        self._chunk_index: dict[str, int] = {}
+        self._entities = _InternedSources()
+        self._relations = _InternedSources()
+        data = load_json(self._file_name)
+        if data is not None:
+            self._load_snapshot(data)
+        self._wal = _open_wal(self._file_name, self.global_config)
+        recovered = 0
+        for record in self._wal.replay():
+            if record["op"] == "set_entity":
+                self._set(self._entities, record["key"], record["chunks"])
+            elif record["op"] == "set_relation":
+                self._set(self._relations, tuple(record["key"]), record["chunks"])
+            recovered += 1
+        if recovered:
+            logger.info(
+                f"Recovered {recovered} updates of provenance {self.namespace} from WAL"
+            )
+            self._wal.compact(self._take_snapshot(), self._write_snapshot)
+        logger.info(
+            f"Load provenance {self.namespace} with {len(self._chunk_index)} chunks, "
+            f"{len(self._entities.index)} entities, {len(self._relations.index)} relations"
+        )
+
+    def entity_chunk_ids(self, entity_name: str) -> Union[list[str], None]:
+        """Source chunks of an entity, None if the index does not know it"""
+        return self._chunk_keys_of(self._entities.get(entity_name))
+
+    def relation_chunk_ids(self, src_id: str, tgt_id: str) -> Union[list[str], None]:
+        return self._chunk_keys_of(self._relations.get(_relation_key(src_id, tgt_id)))
+
+    def has_chunk(self, chunk_id: str) -> bool:
+        """Whether any entity or relation is extracted from the chunk"""
+        return chunk_id in self._chunk_index
+
+    def chunk_entities(self, chunk_id: str) -> list[str]:
+        """Entities extracted from a chunk"""
+        if chunk_id not in self._chunk_index:
+            return []
+        return self._entities.chunk_elements(self._chunk_index[chunk_id])
+
+    def chunk_relations(self, chunk_id: str) -> list[tuple[str, str]]:
+        if chunk_id not in self._chunk_index:
+            return []
+        return self._relations.chunk_elements(self._chunk_index[chunk_id])
+
+    @property
+    def entities_version(self) -> int:
+        """Changes when entities are added or removed"""
+        return self._entities.version
+
+    def set_entity_chunk_ids(self, entity_name: str, chunk_ids: list[str]):
+        """Replace the source chunks of an entity, no chunks removes it"""
+        self._set(self._entities, entity_name, chunk_ids)
+        self._wal.append({"op": "set_entity", "key": entity_name, "chunks": chunk_ids})
+
+    def set_relation_chunk_ids(self, src_id: str, tgt_id: str, chunk_ids: list[str]):
+        key = _relation_key(src_id, tgt_id)
+        self._set(self._relations, key, chunk_ids)
+        self._wal.append({"op": "set_relation", "key": key, "chunks": chunk_ids})
+
+    def _chunk_keys_of(
+        self, chunk_ids: Union[set[int], None]
+    ) -> Union[list[str], None]:
+        if chunk_ids is None:
+            return None
+        return [self._chunk_keys[i] for i in sorted(chunk_ids)]
+
+    def _set(self, elements: _InternedSources, key, chunk_keys: list[str]):
+        chunk_ids = set()
+        for chunk_key in chunk_keys:
+            chunk_id = self._chunk_index.get(chunk_key)
+            if chunk_id is None:
+                chunk_id = self._chunk_index[chunk_key] = len(self._chunk_keys)
+                self._chunk_keys.append(chunk_key)
+            chunk_ids.add(chunk_id)
+        for chunk_id in elements.set(key, chunk_ids):
+            # forget chunks nothing is derived from anymore
+            if (
+                chunk_id not in self._entities.by_chunk
+                and chunk_id not in self._relations.by_chunk
+            ):
+                del self._chunk_index[self._chunk_keys[chunk_id]]
+                self._chunk_keys[chunk_id] = None
+
+    async def index_done_callback(self):
+        await self._wal.checkpoint(self._take_snapshot, self._write_snapshot)
+
+    def _take_snapshot(self) -> dict:
+        # removed chunks and elements are dropped, so ids are renumbered densely
+        chunk_ids = sorted(self._chunk_index.values())
+        renumber = {old: new for new, old in enumerate(chunk_ids)}
+        snapshot = {"chunks": [self._chunk_keys[i] for i in chunk_ids]}
+        for name, elements in [
+            ("entities", self._entities),
+            ("relations", self._relations),
+        ]:
+            element_ids = sorted(elements.index.values())
+            snapshot[name] = [elements.keys[i] for i in element_ids]
+            snapshot[f"{name}_chunks"] = [
+                sorted(renumber[c] for c in elements.sources[i]) for i in element_ids
+            ]
+        return snapshot
+
+    def _load_snapshot(self, data: dict):
+        self._chunk_keys = data["chunks"]
+        self._chunk_index = {k: i for i, k in enumerate(self._chunk_keys)}
+        for elements, keys, sources in [
+            (self._entities, data["entities"], data["entities_chunks"]),
+            (
+                self._relations,
+                [tuple(k) for k in data["relations"]],
+                data["relations_chunks"],
+            ),
+        ]:
+            elements.keys = keys
+            elements.index = {k: i for i, k in enumerate(keys)}
+            elements.sources = [set(chunk_ids) for chunk_ids in sources]
+            for element_id, chunk_ids in enumerate(elements.sources):
+                for chunk_id in chunk_ids:
+                    elements.by_chunk[chunk_id].add(element_id)
+
+    def _write_snapshot(self, snapshot: dict):
+        write_json(snapshot, self._file_name, indent=None)
+
+
+def _relation_key(src_id: str, tgt_id: str) -> tuple[str, str]:
+    return tuple(sorted((src_id, tgt_id)))
@@ -6,8 +6,11 @@ import json
 import logging
 import os
 import re
+import uuid
+import weakref
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from functools import wraps
+from functools import lru_cache, wraps
 from hashlib import md5
 from typing import Any, Union, List
 import xml.etree.ElementTree as ET
@@ -112,6 +115,145 @@ def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
     return final_decro
 
 
+class KeyedLock:
+    """Async locks by key, for read-modify-write of records shared between tasks.
+
+    A key's lock only exists while it is held or waited for. The keys of one
+    lock() call are acquired in sorted order, so tasks locking overlapping sets
+    of keys can't deadlock.
+    """
+
+    def __init__(self):
+        # key -> [lock, number of tasks holding or waiting for it]
+        self._locks: dict[Any, list] = {}
+
+    @asynccontextmanager
+    async def lock(self, *keys):
+        entries = []
+        try:
+            for key in sorted(set(keys)):
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                entries.append([key, entry, False])
+                await entry[0].acquire()
+                entries[-1][2] = True
+            yield
+        finally:
+            for key, entry, held in reversed(entries):
+                if held:
+                    entry[0].release()
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+class _EmbeddingRequest:
+    __slots__ = ("rows", "remaining", "future")
+
+    def __init__(self, size: int, future: asyncio.Future):
+        self.rows = [None] * size
+        self.remaining = size
+        self.future = future
+
+
+class _EmbeddingQueue:
+    """Texts waiting for a batch on one event loop"""
+
+    __slots__ = ("items", "timer", "__weakref__")
+
+    def __init__(self):
+        self.items: list[tuple[_EmbeddingRequest, int, str]] = []
+        self.timer: Union[asyncio.TimerHandle, None] = None
+
+
+class EmbeddingBatcher:
+    """Coalesces the texts of concurrent embedding calls into full batches.
+
+    Texts wait in a queue shared by all callers (chunks, entities, relations,
+    queries). The queue is sent to the wrapped embedding func as soon as it holds
+    max_batch_size texts, or max_wait seconds after its first text arrived; each
+    caller gets the rows of its own texts back, in order. A failed batch fails
+    every call with texts in it. Each event loop has its own queue, so texts left
+    by a loop that ended (e.g. an asyncio.run per call) never hold up the next one.
+    """
+
+    def __init__(self, func, max_batch_size: int = 32, max_wait: float = 0.01):
+        self._func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queues: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._tasks: set[asyncio.Task] = set()
+
+    def __getattr__(self, name):
+        # embedding_dim, max_token_size... of the wrapped EmbeddingFunc
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._func, name)
+
+    def __deepcopy__(self, memo):
+        # shared by the storages, also through the asdict() of the config
+        return self
+
+    async def __call__(self, texts: list[str]) -> np.ndarray:
+        if not texts:
+            return await self._func(texts)
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(loop)
+        if queue is None:
+            queue = self._queues[loop] = _EmbeddingQueue()
+        request = _EmbeddingRequest(len(texts), loop.create_future())
+        queue.items.extend((request, i, text) for i, text in enumerate(texts))
+        while len(queue.items) >= self.max_batch_size:
+            self._send(queue.items[: self.max_batch_size])
+            del queue.items[: self.max_batch_size]
+        self._schedule(queue, loop)
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            # texts of a cancelled call that are still queued are not embedded
+            queue.items = [item for item in queue.items if item[0] is not request]
+            self._schedule(queue, loop)
+            raise
+
+    def _schedule(self, queue: _EmbeddingQueue, loop: asyncio.AbstractEventLoop):
+        if not queue.items and queue.timer is not None:
+            queue.timer.cancel()
+            queue.timer = None
+        elif queue.items and queue.timer is None:
+            queue.timer = loop.call_later(self.max_wait, self._send_queued, queue)
+
+    def _send_queued(self, queue: _EmbeddingQueue):
+        queue.timer = None
+        items, queue.items = queue.items, []
+        if items:
+            self._send(items)
+
+    def _send(self, items: list[tuple[_EmbeddingRequest, int, str]]):
+        task = asyncio.ensure_future(self._embed(items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _embed(self, items: list[tuple[_EmbeddingRequest, int, str]]):
+        try:
+            embeddings = await self._func([text for _, _, text in items])
+            if len(embeddings) != len(items):
+                raise ValueError(
+                    f"embedding func returned {len(embeddings)} rows for {len(items)} texts"
+                )
+        except Exception as e:
+            for request, _, _ in items:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        for (request, i, _), row in zip(items, embeddings):
+            request.rows[i] = row
+            request.remaining -= 1
+            if not request.remaining and not request.future.done():
+                request.future.set_result(np.stack(request.rows))
+
+
 def wrap_embedding_func_with_attrs(**kwargs):
     """Wrap a function with attributes"""
 
@@ -129,9 +271,45 @@ def load_json(file_name):
         return json.load(f)
 
 
-def write_json(json_obj, file_name):
-    with open(file_name, "w", encoding="utf-8") as f:
-        json.dump(json_obj, f, indent=2, ensure_ascii=False)
+def write_json(json_obj, file_name, indent=2):
+    write_file_atomic(
+        file_name,
+        lambda f: json.dump(json_obj, f, indent=indent, ensure_ascii=False),
+    )
+
+
+def write_file_atomic(file_name, write_func, mode="w"):
+    """Write a file through a temp file in the same directory and rename it into place,
+    so readers (and a crash mid-write) never see a half-written file"""
+    dir_name = os.path.dirname(os.path.abspath(file_name))
+    tmp_file_name = os.path.join(
+        dir_name, f".{os.path.basename(file_name)}.{uuid.uuid4().hex}.tmp"
+    )
+    try:
+        # unlike mkstemp's 0o600, mode 0o666 lets the umask give the renamed file
+        # the permissions a plain open() would have given it
+        fd = os.open(tmp_file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        with open(fd, mode, encoding=None if "b" in mode else "utf-8") as f:
+            write_func(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+    fsync_dir(dir_name)
+
+
+def fsync_dir(dir_name):
+    """Persist renames/creations in a directory, where the platform supports it"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(dir_name, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def encode_string_by_tiktoken(content: str, model_name: str = "gpt-4o"):
@@ -150,6 +328,13 @@ def decode_tokens_by_tiktoken(tokens: list[int], model_name: str = "gpt-4o"):
     return content
 
 
+@lru_cache(maxsize=8192)
+def count_tokens_by_tiktoken(content: str, model_name: str = "gpt-4o") -> int:
+    """Number of tokens in content, cached because the same entity descriptions and
+    chunks are measured again by every query that retrieves them"""
+    return len(encode_string_by_tiktoken(content, model_name=model_name))
+
+
 def pack_user_ass_to_openai_messages(*args: str):
     roles = ["user", "assistant"]
     return [
@@ -157,11 +342,19 @@ def pack_user_ass_to_openai_messages(*args: str):
     ]
 
 
+@lru_cache(maxsize=None)
+def _markers_pattern(markers: tuple[str, ...]) -> re.Pattern:
+    return re.compile("|".join(re.escape(marker) for marker in markers))
+
+
 def split_string_by_multi_markers(content: str, markers: list[str]) -> list[str]:
     """Split a string by multiple markers"""
     if not markers:
         return [content]
-    results = re.split("|".join(re.escape(marker) for marker in markers), content)
+    if len(markers) == 1:
+        results = content.split(markers[0])
+    else:
+        results = _markers_pattern(tuple(markers)).split(content)
     return [r.strip() for r in results if r.strip()]
 
 
@@ -188,12 +381,34 @@ def truncate_list_by_token_size(list_data: list, key: callable, max_token_size:
         return []
     tokens = 0
     for i, data in enumerate(list_data):
-        tokens += len(encode_string_by_tiktoken(key(data)))
+        tokens += count_tokens_by_tiktoken(key(data))
         if tokens > max_token_size:
             return list_data[:i]
     return list_data
 
 
+def pack_list_by_token_size(
+    list_data: list, key: callable, score: callable, max_token_size: int
+):
+    """Fill a token budget with the highest scoring items first.
+
+    Unlike truncate_list_by_token_size this does not stop at the first item that
+    overflows the budget, smaller lower-scored items can still use the remainder.
+    The result is ordered by descending score.
+    """
+    if max_token_size <= 0:
+        return []
+    tokens = 0
+    results = []
+    for data in sorted(list_data, key=score, reverse=True):
+        data_tokens = count_tokens_by_tiktoken(key(data))
+        if tokens + data_tokens > max_token_size:
+            continue
+        tokens += data_tokens
+        results.append(data)
+    return results
+
+
 def list_of_list_to_csv(data: List[List[str]]) -> str:
     output = io.StringIO()
     writer = csv.writer(output)
@@ -270,40 +485,3 @@ def xml_to_json(xml_file):
     except Exception as e:
         print(f"An error occurred: {e}")
         return None
-
-
-def process_combine_contexts(hl, ll):
-    header = None
-    list_hl = csv_string_to_list(hl.strip())
-    list_ll = csv_string_to_list(ll.strip())
-
-    if list_hl:
-        header = list_hl[0]
-        list_hl = list_hl[1:]
-    if list_ll:
-        header = list_ll[0]
-        list_ll = list_ll[1:]
-    if header is None:
-        return ""
-
-    if list_hl:
-        list_hl = [",".join(item[1:]) for item in list_hl if item]
-    if list_ll:
-        list_ll = [",".join(item[1:]) for item in list_ll if item]
-
-    combined_sources = []
-    seen = set()
-
-    for item in list_hl + list_ll:
-        if item and item not in seen:
-            combined_sources.append(item)
-            seen.add(item)
-
-    combined_sources_result = [",\t".join(header)]
-
-    for i, item in enumerate(combined_sources, start=1):
-        combined_sources_result.append(f"{i},\t{item}")
-
-    combined_sources_result = "\n".join(combined_sources_result)
-
-    return combined_sources_result
@@ -0,0 +1,86 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable
+
+from .base import GleaningStats
+from .operate import extract_chunk_graph_elements
+from .utils import limit_async_func_call, logger
+
+
+def _extract_in_worker(
+    chunks: list[tuple[str, dict]], worker_config: dict
+) -> tuple[list, GleaningStats]:
+    """Entry point of a worker process, extracts one shard with its own event loop"""
+    llm_model_func = limit_async_func_call(worker_config["llm_model_max_async"])(
+        partial(worker_config["llm_model_func"], **worker_config["llm_model_kwargs"])
+    )
+    gleaning_stats = GleaningStats()
+    results = asyncio.run(
+        extract_chunk_graph_elements(
+            dict(chunks),
+            {**worker_config, "llm_model_func": llm_model_func},
+            show_progress=False,
+            gleaning_stats=gleaning_stats,
+        )
+    )
+    return results, gleaning_stats
+
+
+class ExtractionWorkerPool:
+    """Worker processes that run the LLM extraction and parsing of chunks.
+
+    The chunks of a call are split into one shard of consecutive chunks per
+    worker. Workers only return
+    what they extracted, the coordinating process merges it into its storages, in
+    chunk order. worker_config is the global config of the workers; its
+    llm_model_func must be picklable (a module level function) and is called
+    without the coordinator's LLM response cache.
+    """
+
+    def __init__(
+        self, num_workers: int, worker_config: dict, start_method: str = "spawn"
+    ):
+        self.num_workers = num_workers
+        self._worker_config = worker_config
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context(start_method),
+        )
+
+    async def extract(
+        self,
+        chunks: list[tuple[str, dict]],
+        on_chunk_done: Callable[[str], None] = None,
+        gleaning_stats: GleaningStats = None,
+    ) -> list[tuple[str, dict, dict]]:
+        """The (chunk_key, nodes, edges) of each chunk, in the order of chunks"""
+        loop = asyncio.get_running_loop()
+        # contiguous ranges, so consecutive chunks can still be packed together
+        shard_size = -(-len(chunks) // self.num_workers)
+        shards = [chunks[i : i + shard_size] for i in range(0, len(chunks), shard_size)]
+        logger.info(
+            f"Extracting {len(chunks)} chunks in {len(shards)} worker processes"
+        )
+
+        async def _run_shard(shard: list[tuple[str, dict]]) -> list:
+            results, shard_stats = await loop.run_in_executor(
+                self._executor, _extract_in_worker, shard, self._worker_config
+            )
+            if gleaning_stats is not None:
+                gleaning_stats.merge(shard_stats)
+            if on_chunk_done is not None:
+                for chunk_key, _, _ in results:
+                    on_chunk_done(chunk_key)
+            return results
+
+        by_chunk = {
+            result[0]: result
+            for results in await asyncio.gather(*[_run_shard(s) for s in shards])
+            for result in results
+        }
+        return [by_chunk[chunk_key] for chunk_key, _ in chunks]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
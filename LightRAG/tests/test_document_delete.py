@@ -0,0 +1,103 @@
+"""Tests of deleting documents that share entities with other documents.
+
+The LLM is a mock that extracts fixed entities and relations for each document,
+so no model or network access is needed.
+
+    PYTHONPATH=../LightRAG-main python -m unittest test_document_delete
+"""
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lightrag import LightRAG
+from lightrag.utils import EmbeddingFunc, compute_mdhash_id
+
+SECRET_DOC = "Alpha holds the secret launch code. Gamma guards it."
+PUBLIC_DOC = "Beta works with Alpha on the public roadmap."
+
+# the records the mock LLM extracts from each document
+EXTRACTIONS = {
+    "secret": [
+        '("entity"<|>"Alpha"<|>"person"<|>"Alpha holds the secret launch code 1234.")',
+        '("entity"<|>"Gamma"<|>"person"<|>"Gamma guards the secret launch code.")',
+        '("relationship"<|>"Alpha"<|>"Gamma"<|>"Gamma guards the secret of Alpha."'
+        '<|>"secret, guard"<|>5)',
+    ],
+    "public": [
+        '("entity"<|>"Beta"<|>"person"<|>"Beta works on the public roadmap.")',
+        '("relationship"<|>"Beta"<|>"Alpha"<|>"Beta works with Alpha."'
+        '<|>"roadmap, collaboration"<|>5)',
+    ],
+}
+
+
+async def mock_llm(prompt, system_prompt=None, history_messages=[], **kwargs):
+    if "Answer YES | NO" in prompt:
+        return "NO"
+    text = prompt.split("Text:")[-1]
+    for key, records in EXTRACTIONS.items():
+        if key in text:
+            return "##".join(records) + "<|COMPLETE|>"
+    return ""
+
+
+class TestDocumentDelete(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.working_dir)
+        self.embedded = []
+
+        async def embed(texts):
+            self.embedded.extend(texts)
+            return np.array([[len(t), 1.0, 0.0, 0.0] for t in texts], dtype=float)
+
+        self.rag = LightRAG(
+            working_dir=self.working_dir,
+            llm_model_func=mock_llm,
+            embedding_func=EmbeddingFunc(
+                embedding_dim=4, max_token_size=8192, func=embed
+            ),
+        )
+        await self.rag.ainsert([SECRET_DOC, PUBLIC_DOC])
+
+    async def asyncTearDown(self):
+        await self.rag.aclose()
+
+    async def test_no_description_of_the_deleted_document_remains(self):
+        graph = self.rag.chunk_entity_relation_graph
+        alpha = await graph.get_node_record('"ALPHA"')
+        self.assertIn("secret", " ".join(alpha.descriptions))
+
+        self.embedded.clear()
+        deleted = await self.rag.adelete_document(
+            compute_mdhash_id(SECRET_DOC, prefix="doc-")
+        )
+        self.assertTrue(deleted)
+
+        self.assertIsNone(await graph.get_node_record('"GAMMA"'))
+        self.assertIsNone(await graph.get_edge_record('"ALPHA"', '"GAMMA"'))
+        # ALPHA is kept as an endpoint of the public relation, and only that
+        alpha = await graph.get_node_record('"ALPHA"')
+        public_chunk_id = compute_mdhash_id(PUBLIC_DOC, prefix="chunk-")
+        self.assertEqual(alpha.entity_type, '"UNKNOWN"')
+        self.assertEqual(alpha.descriptions, ['"Beta works with Alpha."'])
+        self.assertEqual(alpha.source_ids, [public_chunk_id])
+        self.assertEqual(
+            self.rag.provenance_index.entity_chunk_ids('"ALPHA"'), [public_chunk_id]
+        )
+        # and embedded again without the deleted description
+        alpha_embeddings = [t for t in self.embedded if t.startswith('"ALPHA"')]
+        self.assertEqual(len(alpha_embeddings), 1)
+        self.assertNotIn("secret", alpha_embeddings[0])
+        for record in [
+            await graph.get_node_record('"BETA"'),
+            await graph.get_edge_record('"BETA"', '"ALPHA"'),
+        ]:
+            self.assertNotIn("secret", " ".join(record.descriptions))
+
+
+if __name__ == "__main__":
+    unittest.main()
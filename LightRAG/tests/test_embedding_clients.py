@@ -0,0 +1,157 @@
+"""Tests of the Ollama and Bedrock embedding adapters against local stubs.
+
+Ollama is served by an aiohttp stub of /api/embed, Bedrock by a fake aioboto3
+client; no model or network access is needed.
+
+    PYTHONPATH=../LightRAG-main python -m unittest test_embedding_clients
+"""
+
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from lightrag import llm
+
+
+class _FakeBody:
+    def __init__(self, data: dict):
+        self._data = data
+
+    async def read(self) -> bytes:
+        return json.dumps(self._data).encode()
+
+
+class _FakeBedrockClient:
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.peak = 0
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    async def invoke_model(self, modelId, body, accept, contentType):
+        self.calls.append((modelId, json.loads(body)))
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        body = json.loads(body)
+        if "texts" in body:
+            return {
+                "body": _FakeBody(
+                    {"embeddings": [[len(t), 0.0] for t in body["texts"]]}
+                )
+            }
+        return {"body": _FakeBody({"embedding": [len(body["inputText"]), 0.0]})}
+
+
+class _FakeSession:
+    def __init__(self, client: _FakeBedrockClient):
+        self._client = client
+
+    def client(self, service_name):
+        assert service_name == "bedrock-runtime"
+        return self._client
+
+
+class TestOllamaEmbedding(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def embed(request):
+            body = await request.json()
+            self.requests.append(body)
+            await asyncio.sleep(0.01)
+            return web.json_response(
+                {
+                    "model": body["model"],
+                    "embeddings": [[float(len(t)), 1.0] for t in body["input"]],
+                }
+            )
+
+        app = web.Application()
+        app.router.add_post("/api/embed", embed)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.host = f"http://127.0.0.1:{port}"
+
+    async def asyncTearDown(self):
+        await llm.close_shared_clients()
+        await self.runner.cleanup()
+
+    async def test_batch_in_one_request(self):
+        embeddings = await llm.ollama_embedding(
+            ["a", "bbb", "cc"], embed_model="stub", host=self.host
+        )
+        self.assertEqual(embeddings.shape, (3, 2))
+        self.assertEqual(embeddings[:, 0].tolist(), [1.0, 3.0, 2.0])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.requests[0]["input"], ["a", "bbb", "cc"])
+
+    async def test_concurrent_calls_share_a_client(self):
+        results = await asyncio.gather(
+            *[
+                llm.ollama_embedding([f"text {i}"], embed_model="stub", host=self.host)
+                for i in range(8)
+            ]
+        )
+        self.assertEqual([r.shape for r in results], [(1, 2)] * 8)
+        self.assertEqual(len(self.requests), 8)
+        clients = llm._shared_clients[asyncio.get_running_loop()]
+        self.assertEqual(len(clients), 1)
+
+
+class TestBedrockEmbedding(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = _FakeBedrockClient()
+        patcher = mock.patch.object(
+            llm.aioboto3, "Session", lambda: _FakeSession(self.client)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await llm.close_shared_clients()
+
+    async def test_titan_requests_are_concurrent_and_bounded(self):
+        texts = [f"t{'x' * i}" for i in range(20)]
+        embeddings = await llm.bedrock_embedding(texts, max_concurrency=5)
+        self.assertEqual(embeddings.shape, (20, 2))
+        self.assertEqual(embeddings[:, 0].tolist(), [len(t) for t in texts])
+        self.assertEqual(len(self.client.calls), 20)
+        self.assertEqual(self.client.peak, 5)
+
+    async def test_cohere_batches_96_texts_per_request(self):
+        texts = [f"text {i}" for i in range(200)]
+        embeddings = await llm.bedrock_embedding(texts, model="cohere.embed-english-v3")
+        self.assertEqual(embeddings.shape, (200, 2))
+        self.assertEqual(
+            [len(body["texts"]) for _, body in self.client.calls], [96, 96, 8]
+        )
+        self.assertTrue(
+            all(model == "cohere.embed-english-v3" for model, _ in self.client.calls)
+        )
+
+    async def test_client_is_shared_and_closed(self):
+        await llm.bedrock_embedding(["a"])
+        await llm.bedrock_embedding(["b"])
+        self.assertEqual(len(self.client.calls), 2)
+        self.assertFalse(self.client.closed)
+        await llm.close_shared_clients()
+        self.assertTrue(self.client.closed)
+        self.assertNotIn(asyncio.get_running_loop(), llm._shared_clients)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Tests that extracting in worker processes builds the same graph as in process.
+
+The LLM is a deterministic mock, defined at module level so the worker processes
+can unpickle it; no model or network access is needed.
+
+    PYTHONPATH=../LightRAG-main python -m unittest test_extraction_workers
+"""
+
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lightrag import LightRAG
+from lightrag.utils import EmbeddingFunc
+
+DOCUMENTS = [
+    " ".join(
+        f"{name} met {other} in {place} on day {day}."
+        for name, other, place in [
+            ("Alice", "Bob", "Paris"),
+            ("Carol", "Dave", "Rome"),
+            ("Eve", "Alice", "Berlin"),
+            ("Frank", "Carol", "Madrid"),
+        ]
+    )
+    for day in range(1, 7)
+] + ["Grace met Heidi in Oslo.", "Ivan met Grace in Vienna."]
+
+
+def _records(text: str) -> list[str]:
+    """An entity per capitalized word, a relation between consecutive ones"""
+    names = list(dict.fromkeys(re.findall(r"\b([A-Z][a-z]+)\b", text)))
+    records = [
+        f'("entity"<|>"{n}"<|>"person"<|>"{n} appears in: {text.strip()[:30]}")'
+        for n in names
+    ]
+    for a, b in zip(names, names[1:]):
+        records.append(
+            f'("relationship"<|>"{a}"<|>"{b}"<|>"{a} is next to {b}"<|>"nearby"<|>1)'
+        )
+    return records
+
+
+async def mock_llm(prompt, system_prompt=None, history_messages=[], **kwargs):
+    if "Answer YES | NO" in prompt:
+        return "NO"
+    texts = re.split(r"-Text (\d+)-\n", prompt)
+    if len(texts) > 1:
+        # a packed request: the records of each text after its number
+        records = []
+        for number, text in zip(texts[1::2], texts[2::2]):
+            records.append(f'("text"<|>{number})')
+            records.extend(_records(text.split("######################")[0]))
+        return "##".join(records) + "<|COMPLETE|>"
+    return "##".join(_records(prompt.split("Text:")[-1])) + "<|COMPLETE|>"
+
+
+async def mock_embedding(texts):
+    return np.array([[len(t), 1.0, 0.0, 0.0] for t in texts], dtype=float)
+
+
+class TestExtractionWorkers(unittest.IsolatedAsyncioTestCase):
+    async def _build_graph(self, **config) -> tuple[dict, dict]:
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        rag = LightRAG(
+            working_dir=working_dir,
+            llm_model_func=mock_llm,
+            embedding_func=EmbeddingFunc(
+                embedding_dim=4, max_token_size=8192, func=mock_embedding
+            ),
+            chunk_token_size=40,
+            chunk_overlap_token_size=5,
+            enable_llm_cache=False,
+            **config,
+        )
+        try:
+            await rag.ainsert(DOCUMENTS)
+            graph = rag.chunk_entity_relation_graph
+            nodes, edges = {}, {}
+            for node_id in await graph.node_ids():
+                nodes[node_id] = await graph.get_node_record(node_id)
+                for src_id, tgt_id in await graph.get_node_edges(node_id) or []:
+                    key = tuple(sorted((src_id, tgt_id)))
+                    edges[key] = await graph.get_edge_record(src_id, tgt_id)
+        finally:
+            await rag.aclose()
+        return nodes, edges
+
+    async def _assert_same_graph(self, **config):
+        nodes, edges = await self._build_graph(insert_worker_processes=0, **config)
+        self.assertGreater(len(nodes), 10)
+        self.assertGreater(len(edges), 10)
+        for processes in [1, 3]:
+            with self.subTest(insert_worker_processes=processes):
+                worker_nodes, worker_edges = await self._build_graph(
+                    insert_worker_processes=processes, **config
+                )
+                self.assertEqual(worker_nodes.keys(), nodes.keys())
+                for node_id, record in nodes.items():
+                    worker_record = worker_nodes[node_id]
+                    self.assertEqual(worker_record.entity_type, record.entity_type)
+                    self.assertEqual(worker_record.descriptions, record.descriptions)
+                    self.assertEqual(worker_record.source_ids, record.source_ids)
+                self.assertEqual(worker_edges.keys(), edges.keys())
+                for key, record in edges.items():
+                    worker_record = worker_edges[key]
+                    self.assertEqual(worker_record.weight, record.weight)
+                    self.assertEqual(worker_record.descriptions, record.descriptions)
+                    self.assertEqual(worker_record.keywords, record.keywords)
+                    self.assertEqual(worker_record.source_ids, record.source_ids)
+
+    async def test_same_graph_as_in_process(self):
+        await self._assert_same_graph()
+
+    async def test_same_graph_with_packed_chunks(self):
+        await self._assert_same_graph(entity_extract_pack_chunks=3)
+
+
+if __name__ == "__main__":
+    unittest.main()